@@ -0,0 +1,133 @@
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+# --- ONLINE BACKUPS ---
+# Every BACKUP_INTERVAL seconds (and on /backup) bot_state.db is copied with
+# the SQLite online backup API, BACKUP_PAGES_PER_STEP pages at a time with a
+# short pause between steps, so handlers' writes are never held up by a long
+# read. The copy is consistent even while the bot writes, then gzipped into
+# BACKUP_DIR; only the newest BACKUP_KEEP files are kept.
+# A write from another connection restarts a stepped backup; after
+# MAX_RESTARTS of them the copy is finished in one step instead (in WAL mode
+# that read doesn't block writers either, it only holds back checkpoints).
+
+PREFIX = "bot_state-"
+SUFFIX = ".db.gz"
+MAX_RESTARTS = 5
+
+_lock = threading.Lock()   # one backup at a time (scheduled or /backup)
+_task: Optional[asyncio.Task] = None
+
+class BackupBusy(Exception):
+    pass
+
+class _TooManyRestarts(Exception):
+    pass
+
+def _copy(src: sqlite3.Connection, dst: sqlite3.Connection):
+    seen = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        if seen["remaining"] is not None and remaining > seen["remaining"]:
+            seen["restarts"] += 1
+            if seen["restarts"] >= MAX_RESTARTS:
+                raise _TooManyRestarts()
+        seen["remaining"] = remaining
+
+    try:
+        src.backup(dst, pages=config.BACKUP_PAGES_PER_STEP, progress=progress, sleep=config.BACKUP_STEP_SLEEP)
+    except _TooManyRestarts:
+        logger.info(f"Backup restarted {MAX_RESTARTS} times by concurrent writes; copying in one step")
+        src.backup(dst)
+
+def take_backup() -> Dict:
+    """Blocking; run it off the event loop. Returns path, size, db_size, seconds."""
+    if not _lock.acquire(blocking=False):
+        raise BackupBusy("a backup is already running")
+    try:
+        return _take_backup()
+    finally:
+        _lock.release()
+
+def _take_backup() -> Dict:
+    started = time.perf_counter()
+    os.makedirs(config.BACKUP_DIR, exist_ok=True)
+    name = f"{PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    raw = os.path.join(config.BACKUP_DIR, f".{name}.db")
+    path = os.path.join(config.BACKUP_DIR, name + SUFFIX)
+    try:
+        src = sqlite3.connect(db.DB_FILE, timeout=30)
+        dst = sqlite3.connect(raw)
+        try:
+            _copy(src, dst)
+        finally:
+            dst.close()
+            src.close()
+        db_size = os.path.getsize(raw)
+        with open(raw, "rb") as f_in, gzip.open(f"{path}.tmp", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.replace(f"{path}.tmp", path)
+    finally:
+        for leftover in (raw, f"{raw}-journal", f"{raw}-wal", f"{raw}-shm", f"{path}.tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    removed = rotate()
+    result = {
+        "path": path,
+        "size": os.path.getsize(path),
+        "db_size": db_size,
+        "seconds": time.perf_counter() - started,
+        "removed": removed,
+    }
+    logger.info(f"💾 Backup {path}: {result['size'] // 1024} KB "
+                f"(db {db_size // 1024} KB) in {result['seconds']:.2f}s")
+    return result
+
+def list_backups() -> List[str]:
+    """Backup files, oldest first (the timestamped names sort chronologically)."""
+    try:
+        names = os.listdir(config.BACKUP_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(config.BACKUP_DIR, n) for n in names if n.startswith(PREFIX) and n.endswith(SUFFIX))
+
+def rotate() -> int:
+    """Deletes all but the newest BACKUP_KEEP backups; returns how many were removed."""
+    old = list_backups()[:-config.BACKUP_KEEP] if config.BACKUP_KEEP > 0 else []
+    for path in old:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Could not remove old backup {path}: {e}")
+    return len(old)
+
+async def _backup_forever():
+    while True:
+        await asyncio.sleep(config.BACKUP_INTERVAL)
+        try:
+            await asyncio.to_thread(take_backup)
+        except BackupBusy:
+            pass
+        except Exception as e:
+            logger.error(f"Scheduled backup failed: {e}")
+
+def start_scheduler():
+    """Starts the periodic backup task on the running event loop (one process per deployment)."""
+    global _task
+    if config.BACKUP_INTERVAL <= 0 or (config.SHARD_COUNT > 1 and config.SHARD_INDEX != 0):
+        return
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_backup_forever())
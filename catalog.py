@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- COURSE / FAQ / PRICE CATALOG ---
+# Content lives in config.CATALOG_FILE and is compiled once into a Catalog
+# (lookups + ready-made keyboards). The watcher swaps in a new Catalog when the
+# file changes; handlers grab current() once per update so each update sees a
+# single consistent version and in-flight sessions keep working.
+
+class Catalog:
+    def __init__(self, data: Dict, version: int):
+        self.version = version
+        self.courses: Dict[str, Dict] = {}
+        for key, course in data["courses"].items():
+            description = course.get("description", "")
+            if isinstance(description, list):
+                description = "\n".join(description)
+            self.courses[key] = {**course, "description": description}
+
+        self.prices: Dict[str, Dict] = data["prices"]
+        for method_key in config.PAYMENT_METHODS:
+            if "currency" not in self.prices.get(method_key, {}):
+                raise ValueError(f"prices.{method_key} is missing or has no currency")
+        # USD value of one unit of each price currency (for /revenue); currencies without a rate stay unconverted
+        self.usd_rates: Dict[str, float] = {k: float(v) for k, v in data.get("usd_rates", {}).items()}
+
+        # FAQ answers are looked up by the index carried in the callback data
+        self.faqs: Dict[str, List[Tuple[str, str]]] = {
+            key: list(data.get("faqs", {}).get(key, {}).items()) for key in self.courses
+        }
+
+        self.main_menu_keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(c["title"], callback_data=f"course_{key}")] for key, c in self.courses.items()]
+            + [[InlineKeyboardButton("💬 التحدث مع خدمة العملاء", callback_data="support")]]
+        )
+        self.course_keyboards = {
+            key: InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ الانضمام الآن", callback_data=f"join_{key}")],
+                [InlineKeyboardButton("❓ الأسئلة الشائعة", callback_data=f"faq_{key}")],
+                [InlineKeyboardButton("💬 خدمة العملاء", callback_data="support")],
+                [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="start_over")],
+            ])
+            for key in self.courses
+        }
+        self.faq_keyboards = {
+            key: InlineKeyboardMarkup(
+                [[InlineKeyboardButton(q, callback_data=f"question_{key}_{i}")] for i, (q, _) in enumerate(faqs)]
+                + [[InlineKeyboardButton("🔙 العودة لتفاصيل الكورس", callback_data=f"course_{key}")]]
+            )
+            for key, faqs in self.faqs.items()
+        }
+        self.faq_back_keyboards = {
+            key: InlineKeyboardMarkup([[InlineKeyboardButton("🔙 العودة للأسئلة", callback_data=f"faq_{key}")]])
+            for key in self.courses
+        }
+
+    def course_title(self, course_key: str, default: str = "غير محدد") -> str:
+        return self.courses.get(course_key, {}).get("title", default)
+
+    def faq_entry(self, course_key: str, index: int) -> Optional[Tuple[str, str]]:
+        faqs = self.faqs.get(course_key, [])
+        if 0 <= index < len(faqs):
+            return faqs[index]
+        return None
+
+_current: Optional[Catalog] = None
+_file_signature = None
+_reload_lock = threading.Lock()
+
+def _signature(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def load(path: str = None) -> Catalog:
+    """Compiles the catalog file and atomically makes it the current version."""
+    global _current, _file_signature
+    path = path or config.CATALOG_FILE
+    with _reload_lock:
+        signature = _signature(path)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        version = (_current.version + 1) if _current else 1
+        new_catalog = Catalog(data, version)
+        _current, _file_signature = new_catalog, signature
+    logger.info(f"Catalog v{version} loaded from {path} ({len(new_catalog.courses)} courses)")
+    return new_catalog
+
+def current() -> Catalog:
+    if _current is None:
+        return load()
+    return _current
+
+def reload_if_changed(path: str = None) -> bool:
+    global _file_signature
+    path = path or config.CATALOG_FILE
+    try:
+        signature = _signature(path)
+        if signature == _file_signature:
+            return False
+        load(path)
+        return True
+    except Exception as e:
+        # Keep serving the previous version; don't retry until the file changes again
+        logger.error(f"Failed to reload catalog from {path}, keeping v{_current.version if _current else 0}: {e}")
+        try:
+            _file_signature = _signature(path)
+        except OSError:
+            pass
+        return False
+
+def start_watcher(interval: float = None) -> threading.Thread:
+    """Polls the catalog file for changes in a daemon thread."""
+    interval = interval or config.CATALOG_RELOAD_INTERVAL
+
+    def _watch():
+        while True:
+            time.sleep(interval)
+            reload_if_changed()
+
+    thread = threading.Thread(target=_watch, name="catalog-watcher", daemon=True)
+    thread.start()
+    return thread
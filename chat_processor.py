@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import health
+
+logger = logging.getLogger(__name__)
+
+# --- PER-CHAT UPDATE PROCESSOR ---
+# Updates from different chats run concurrently (up to max_concurrent_updates),
+# updates touching the same chat run one at a time in arrival order, so the
+# read-modify-write of user_states never interleaves for one user.
+# An update queues on its chat's lock BEFORE it takes one of the
+# max_concurrent_updates slots: a burst from one chat holds at most one slot,
+# and never stalls other chats behind it. PTB takes its own semaphore before
+# do_process_update, so that one is sized max_queued (updates waiting for their
+# chat) and the real slots are this class's semaphore, taken inside
+# do_process_update after the chat lock. A chat's lock only exists while it
+# has updates in flight.
+
+# Commands that must not queue behind a long-running update of the same chat
+# (e.g. /cancel while that admin's /broadcast is still sending).
+UNORDERED_COMMANDS = {"/cancel"}
+
+def chat_key(update: Update) -> Optional[int]:
+    """The user_states row an update works on; None → no ordering needed."""
+    query = update.callback_query
+    if query and query.data and query.data.startswith(("approve_", "reject_")):
+        # Admin decisions are made idempotent by db.claim_admin_decision, so a
+        # second admin's click is answered immediately instead of queueing
+        return None
+    message = update.effective_message
+    if message and message.text and message.text.split(maxsplit=1)[0].split("@")[0] in UNORDERED_COMMANDS:
+        return None
+    chat = update.effective_chat
+    return chat.id if chat else None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int, max_queued: int = 4096):
+        super().__init__(max(max_queued, max_concurrent_updates))
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._locks: Dict[int, List] = {}
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._locks)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = chat_key(update) if isinstance(update, Update) else None
+        if key is None:
+            await self._run(update, coroutine)
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def _run(self, update, coroutine) -> None:
+        # The chat's turn came first; only now is a slot taken (and the work timed)
+        async with self._slots:
+            token = health.update_started(update)
+            try:
+                await coroutine
+            finally:
+                health.update_finished(token)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._locks:
+            logger.info(f"Update processor shutting down with {len(self._locks)} chats still in flight")
@@ -1,160 +1,344 @@
-import os, time, subprocess, socket
-from datetime import datetime, timezone
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import os, sys, time, signal, sqlite3, logging, subprocess, socket, tempfile, threading, itertools
+
+import db
+import health
+import leases
+import replication
+import standby
 
 # ====== CONFIG ======
-SHEET_NAME = os.getenv("LEADER_SHEET_NAME", "BotLeaderLock")  # Google Sheet
-SHEET_TAB  = os.getenv("LEADER_SHEET_TAB", "Sheet1")          # usually "Sheet1"
-SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "credentials.json")
+# The lease backend (LEASE_BACKEND=sheet | server | sqlite; sheet by default) is configured in leases.py
+LEASE_BACKEND = leases.LEASE_BACKEND
 
-# Unique name for this computer
-INSTANCE_NAME = os.getenv("Badr", socket.gethostname())
+# Unique name for this runner (two runners on one machine must differ)
+INSTANCE_NAME = os.getenv("Badr") or f"{socket.gethostname()}:{os.getpid()}"
 
-# Timing (seconds)
-HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "60"))  # leader writes every 60s
-STALE_AFTER        = int(os.getenv("STALE_AFTER", "180"))        # if no update for 3 min, leader is dead
-CHECK_EVERY        = int(os.getenv("CHECK_EVERY", "30"))         # how often to check leadership
+# Timing (seconds). A dead leader is replaced within about
+# LEASE_TTL + 2 * CHECK_EVERY; the Sheet backend keeps the old slow defaults
+# because every check costs API quota.
+_SHEET = LEASE_BACKEND == "sheet"
+LEASE_TTL    = float(os.getenv("LEASE_TTL", os.getenv("STALE_AFTER", "180" if _SHEET else "6")))
+RENEW_EVERY  = float(os.getenv("RENEW_EVERY", os.getenv("HEARTBEAT_INTERVAL", "60" if _SHEET else "2")))
+CHECK_EVERY  = float(os.getenv("CHECK_EVERY", "30" if _SHEET else "1"))
+# A leader that could not renew for this long stops its bot, so it is down
+# before any standby can consider the lease expired
+STEP_DOWN_AFTER = LEASE_TTL / 2
+# How often the bot re-checks that it is still the leader's bot (fencing.py)
+FENCE_CHECK_INTERVAL = float(os.getenv("FENCE_CHECK_INTERVAL", str(RENEW_EVERY / 2)))
 
 BOT_COMMAND = os.getenv("BOT_COMMAND", "python newbot.py")
+# Keep a warmed-up, non-polling bot on standby nodes; promotion then skips
+# interpreter start, imports, DB/catalog init and Google auth (see standby.py)
+HOT_STANDBY = os.getenv("HOT_STANDBY", "1").strip() not in ("0", "false", "no")
+
+# Health probing of the leader's bot (heartbeat file, see health.py): a
+# heartbeat older than HEALTH_TIMEOUT, a bot reporting a problem, or a bot not
+# ready STARTUP_GRACE seconds after start/promotion makes the leader step down
+# and sit out STEP_DOWN_COOLDOWN so another node takes over. Restarts back off
+# exponentially (BACKOFF_* in config.py); CRASHES_BEFORE_STEP_DOWN crashes in
+# a row also hand leadership over.
+HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "15"))
+STARTUP_GRACE = float(os.getenv("STARTUP_GRACE", "90"))
+STEP_DOWN_COOLDOWN = float(os.getenv("STEP_DOWN_COOLDOWN", str(max(30.0, 3 * LEASE_TTL))))
+CRASHES_BEFORE_STEP_DOWN = int(os.getenv("CRASHES_BEFORE_STEP_DOWN", "3"))
 # =====================
 
-def utc_now_iso():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+_health_files = itertools.count(1)
 
-def parse_iso(s):
-    try:
-        return datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-    except Exception:
-        return None
-
-def get_sheet():
-    scope = ['https://spreadsheets.google.com/feeds',
-             'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name(SERVICE_ACCOUNT_FILE, scope)
-    client = gspread.authorize(creds)
-    sh = client.open(SHEET_NAME)
-    try:
-        ws = sh.worksheet(SHEET_TAB)
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=SHEET_TAB, rows=10, cols=5)
-        ws.update("A1:C1", [["leader_id","heartbeat_utc","note"]])
-    return ws
-
-def read_lock(ws):
-    vals = ws.get_values("A2:C2")
-    if vals and len(vals[0]) > 0:
-        row = vals[0]
-    else:
-        row = []
-    leader_id = row[0] if len(row) > 0 and row[0] else ""
-    heartbeat = row[1] if len(row) > 1 and row[1] else ""
-    note = row[2] if len(row) > 2 and row[2] else ""
-    return leader_id, heartbeat, note
+def _spawn(env_extra: dict, **popen_kwargs) -> subprocess.Popen:
+    health_file = os.path.join(tempfile.gettempdir(), f"bot-health-{os.getpid()}-{next(_health_files)}.json")
+    env = dict(
+        os.environ,
+        BOT_HEALTH_FILE=health_file,
+        FENCING_HOLDER=INSTANCE_NAME,
+        FENCE_CHECK_INTERVAL=str(FENCE_CHECK_INTERVAL),
+        FENCE_MAX_AGE=str(STEP_DOWN_AFTER),
+        **env_extra,
+    )
+    proc = subprocess.Popen(
+        BOT_COMMAND, shell=True, env=env, stdout=subprocess.PIPE,
+        text=True, encoding="utf-8", errors="replace", bufsize=1,
+        start_new_session=os.name == "posix", **popen_kwargs,
+    )
+    proc.takeover = None  # (monotonic time the lease was won, "hot standby" | "cold start")
+    proc.health_file = health_file
+    proc.serving_since = time.monotonic()  # start, or promotion for a standby
+    proc.ready = False
+    threading.Thread(target=_pump_output, args=(proc,), daemon=True).start()
+    return proc
 
-def write_lock(ws, leader_id, heartbeat, note=""):
-    ws.update("A2:C2", [[leader_id, heartbeat, note]])
+def _pump_output(proc: subprocess.Popen):
+    """Passes the bot's stdout through and times the takeover on its ready marker."""
+    for line in proc.stdout:
+        if line.startswith(standby.READY_MARKER):
+            proc.ready = True
+        if line.startswith(standby.READY_MARKER) and proc.takeover:
+            won_at, mode = proc.takeover
+            proc.takeover = None
+            print(f"[{INSTANCE_NAME}] ⚡ Takeover complete: serving {(time.monotonic() - won_at) * 1000:.0f}ms "
+                  f"after winning the lease ({mode})")
+            continue
+        sys.stdout.write(line)
+        sys.stdout.flush()
 
-def is_stale(heartbeat):
-    if not heartbeat:
-        return True
-    dt = parse_iso(heartbeat)
-    if not dt:
+def start_bot(fencing_token: int):
+    """The bot gets the token of this leadership term; it refuses to write once
+    a newer term has registered a higher one (see fencing.py)."""
+    print(f"[{INSTANCE_NAME}] 🚀 Starting bot process (fencing token {fencing_token})…")
+    return _spawn({"FENCING_TOKEN": str(fencing_token)})
+
+def start_standby():
+    print(f"[{INSTANCE_NAME}] 🔥 Starting hot-standby bot process…")
+    return _spawn({"BOT_STANDBY": "1"}, stdin=subprocess.PIPE)
+
+def promote(proc, fencing_token: int) -> bool:
+    """Hands the term's token to a standby bot; False if it is gone."""
+    if proc is None or proc.poll() is not None:
+        return False
+    try:
+        proc.stdin.write(standby.promotion_line(fencing_token, INSTANCE_NAME))
+        proc.stdin.flush()
+        proc.serving_since = time.monotonic()
         return True
-    age = (datetime.now(timezone.utc) - dt).total_seconds()
-    return age > STALE_AFTER
+    except (BrokenPipeError, OSError, ValueError):
+        return False
 
-def start_bot():
-    print(f"[{INSTANCE_NAME}] 🚀 Starting bot process…")
-    return subprocess.Popen(BOT_COMMAND, shell=True)
+def probe_bot(proc):
+    """What is wrong with the serving bot, or None if it is healthy."""
+    if not proc.ready:
+        waited = time.monotonic() - proc.serving_since
+        return f"not ready {waited:.0f}s after start" if waited > STARTUP_GRACE else None
+    return health.read_heartbeat(proc.health_file, HEALTH_TIMEOUT)
+
+def _signal(proc, sig):
+    # BOT_COMMAND runs through a shell that may not exec the bot: signal the
+    # whole process group, or a stopped "bot" would be just the shell
+    if os.name == "posix":
+        os.killpg(proc.pid, sig)
+    else:
+        proc.send_signal(sig)
 
 def stop_bot(proc):
+    if proc is not None:
+        try:
+            os.remove(proc.health_file)
+        except OSError:
+            pass
     if proc and proc.poll() is None:
         print(f"[{INSTANCE_NAME}] ⛔ Stopping bot process…")
         try:
-            proc.terminate()
+            _signal(proc, signal.SIGTERM)
             try:
                 proc.wait(timeout=10)
             except subprocess.TimeoutExpired:
-                proc.kill()
+                _signal(proc, signal.SIGKILL if os.name == "posix" else signal.SIGTERM)
         except Exception as e:
             print(f"[{INSTANCE_NAME}] Error stopping bot: {e}")
 
+class Elector:
+    """Leader side: renew the lease every RENEW_EVERY and give up once renewals
+    have failed for STEP_DOWN_AFTER. Standby side: take the lease when it is
+    free, or when its version has not moved for LEASE_TTL on our own clock."""
+
+    def __init__(self, backend: leases.LeaseBackend, name: str = INSTANCE_NAME):
+        self.backend = backend
+        self.name = name
+        self.lease = None            # our lease while we are leader
+        self.term_token = 0          # lease version we won with: the fencing token of this term
+        self.won_at = 0.0            # monotonic time the lease was won
+        self.hold_off_until = 0.0    # after stepping down, don't contend before this
+        self.renewed_at = 0.0        # monotonic time the last successful renew was sent
+        self.observed = None         # (version, monotonic time first seen) of another holder's lease
+
+    @property
+    def is_leader(self) -> bool:
+        return self.lease is not None
+
+    def tick(self):
+        if self.lease:
+            self._renew()
+        else:
+            self._contend()
+
+    def _renew(self):
+        now = time.monotonic()
+        if now - self.renewed_at < RENEW_EVERY:
+            return
+        try:
+            renewed = self.backend.compare_and_set(self.lease.version, self.name)
+        except Exception as e:
+            print(f"[{self.name}] ❌ Failed to renew lease: {e}")
+            if time.monotonic() - self.renewed_at >= STEP_DOWN_AFTER:
+                print(f"[{self.name}] ⚠️ Could not renew for {STEP_DOWN_AFTER:.0f}s; stepping down")
+                self.lease = None
+            return
+        if renewed is None:
+            print(f"[{self.name}] ⚠️ Lost leadership to {self.backend.read().holder}")
+            self.lease = None
+            return
+        self.lease, self.renewed_at = renewed, now
+
+    def _contend(self):
+        current = self.backend.read()
+        now = time.monotonic()
+        if self.observed is None or self.observed[0] != current.version:
+            self.observed = (current.version, now)
+        if now < self.hold_off_until:
+            return
+        expired = now - self.observed[1] >= LEASE_TTL
+        if current.holder and current.holder != self.name and not expired:
+            return
+        sent = time.monotonic()
+        won = self.backend.compare_and_set(current.version, self.name)
+        if won is None:
+            print(f"[{self.name}] Lost race, leader is {self.backend.read().holder}")
+            return
+        if current.holder:
+            note = f"taking over from {current.holder}, silent for {now - self.observed[1]:.1f}s"
+        else:
+            note = "lease was free"
+        print(f"[{self.name}] 🏆 Became leader ({note}, lease v{won.version})")
+        self.lease, self.renewed_at, self.observed = won, sent, None
+        self.term_token, self.won_at = won.version, time.monotonic()
+        self.advance_past(stored_fencing_token())
+
+    def step_down(self, cooldown: float):
+        """Gives the lease up and sits out `cooldown` so a healthier node takes it."""
+        self.release()
+        self.hold_off_until = time.monotonic() + cooldown
+        print(f"[{self.name}] ⬇️ Stepped down; not contending for {cooldown:.0f}s")
+
+    def release(self):
+        """Hands the lease back so a standby can take over without waiting for the TTL."""
+        if self.lease:
+            try:
+                self.backend.compare_and_set(self.lease.version, "")
+            except Exception as e:
+                print(f"[{self.name}] Failed to release lease: {e}")
+            self.lease = None
+
+    def advance_past(self, floor: int) -> bool:
+        """Makes this term's token higher than `floor`, the highest token the
+        database has registered. The lease store's version can go backwards (a
+        lease server or lease file started over, a blank version cell in the
+        sheet); the bot would then refuse to start with its lower token on every
+        node. Our lease is moved past the floor by CAS. Returns True if the
+        token changed; a lost CAS means the lease is gone."""
+        if not self.lease or self.term_token > floor:
+            return False
+        jumped = self.backend.compare_and_set(self.lease.version, self.name, new_version=floor + 1)
+        if jumped is None:
+            print(f"[{self.name}] ⚠️ Lost leadership while moving the lease past token {floor}")
+            self.lease = None
+            return False
+        print(f"[{self.name}] ⏫ Lease version {self.term_token} is behind the stored fencing token {floor}; "
+              f"now v{jumped.version}")
+        self.lease, self.renewed_at, self.term_token = jumped, time.monotonic(), jumped.version
+        return True
+
+def stored_fencing_token() -> int:
+    """The highest fencing token in the local bot_state.db (0 if there is none yet)."""
+    try:
+        return db.get_fencing_token()
+    except sqlite3.Error:
+        return 0
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
 def main():
-    print(f"Cluster runner up. INSTANCE_NAME={INSTANCE_NAME}")
-    ws = None
-    while not ws:
+    print(f"Cluster runner up. INSTANCE_NAME={INSTANCE_NAME}, backend={LEASE_BACKEND}, ttl={LEASE_TTL:g}s")
+    backend = None
+    while not backend:
         try:
-            ws = get_sheet()
-            print(f"[{INSTANCE_NAME}] ✅ Connected to Google Sheet: {SHEET_NAME}")
+            backend = leases.from_env()
+            print(f"[{INSTANCE_NAME}] ✅ Connected to {LEASE_BACKEND} lease backend")
         except Exception as e:
-            print(f"[{INSTANCE_NAME}] ❌ Failed to connect to sheet: {e}")
+            print(f"[{INSTANCE_NAME}] ❌ Failed to connect to lease backend: {e}")
             time.sleep(10)
 
-    bot_proc = None
-    i_am_leader = False
-    last_hb = 0.0
+    # SIGTERM (service stop) releases the lease like Ctrl+C does
+    signal.signal(signal.SIGTERM, _interrupt)
 
-    while True:
-        try:
-            leader_id, heartbeat, note = read_lock(ws)
-            print(f"[{INSTANCE_NAME}] Current leader={leader_id}, heartbeat={heartbeat}, note={note}")
+    # Ship bot_state.db to the other nodes while leading, take theirs otherwise
+    logging.basicConfig(format=f"[{INSTANCE_NAME}] %(message)s", level=logging.INFO)
+    replicator = replication.Replicator() if replication.enabled() else None
+    if replicator:
+        replicator.start()
+        print(f"[{INSTANCE_NAME}] 🔁 Replicating the database with {', '.join(replication.config.REPLICATION_PEERS)}")
 
-            leader_alive = not is_stale(heartbeat)
+    elector = Elector(backend)
+    bot_proc = None
+    standby_proc = None
+    bot_backoff, standby_backoff = health.Backoff(), health.Backoff()
+    served_term = 0  # term the bot was last started for
+    try:
+        while True:
+            try:
+                elector.tick()
+            except Exception as e:
+                print(f"[{INSTANCE_NAME}] ❌ Error in loop: {e}")
 
-            if i_am_leader:
-                if leader_id != INSTANCE_NAME:
-                    print(f"[{INSTANCE_NAME}] ⚠️ Lost leadership to {leader_id}")
-                    i_am_leader = False
+            if elector.is_leader:
+                if bot_proc is None:
+                    if replicator:
+                        replicator.lead(elector.term_token)
+                    if promote(standby_proc, elector.term_token):
+                        print(f"[{INSTANCE_NAME}] ⚡ Promoted hot standby (fencing token {elector.term_token})")
+                        bot_proc, standby_proc = standby_proc, None
+                        bot_proc.takeover = (elector.won_at, "hot standby")
+                        bot_backoff.started()
+                        served_term = elector.term_token
+                    elif bot_backoff.ready():
+                        stop_bot(standby_proc)
+                        standby_proc = None
+                        bot_proc = start_bot(elector.term_token)
+                        if served_term != elector.term_token:  # not a crash restart
+                            bot_proc.takeover = (elector.won_at, "cold start")
+                        bot_backoff.started()
+                        served_term = elector.term_token
+                elif bot_proc.poll() == standby.STALE_TOKEN_EXIT and elector.advance_past(stored_fencing_token()):
+                    # Refused its token (the lease store went backwards): restart with the new one
                     stop_bot(bot_proc)
                     bot_proc = None
+                elif bot_proc.poll() is not None:
+                    delay = bot_backoff.failed()
+                    print(f"[{INSTANCE_NAME}] 💥 Bot exited ({bot_proc.returncode}); restarting in {delay:.0f}s.")
+                    stop_bot(bot_proc)
+                    bot_proc = None
+                    if bot_backoff.failures >= CRASHES_BEFORE_STEP_DOWN:
+                        elector.step_down(STEP_DOWN_COOLDOWN)
                 else:
-                    now = time.time()
-                    if now - last_hb >= HEARTBEAT_INTERVAL:
-                        hb = utc_now_iso()
-                        print(f"[{INSTANCE_NAME}] ❤️ Sending heartbeat {hb}")
-                        try:
-                            write_lock(ws, INSTANCE_NAME, hb, "leader alive")
-                            print(f"[{INSTANCE_NAME}] ✅ Heartbeat written.")
-                        except Exception as e:
-                            print(f"[{INSTANCE_NAME}] ❌ Failed to write heartbeat: {e}")
-                        last_hb = now
-                    if bot_proc and bot_proc.poll() is not None:
-                        print(f"[{INSTANCE_NAME}] 💥 Bot crashed; restarting.")
-                        bot_proc = start_bot()
-
-            else:
-                if not leader_id or not leader_alive:
-                    print(f"[{INSTANCE_NAME}] 🟢 Attempting to become leader…")
-                    hb = utc_now_iso()
-                    try:
-                        write_lock(ws, INSTANCE_NAME, hb, "taking leadership")
-                    except Exception as e:
-                        print(f"[{INSTANCE_NAME}] ❌ Failed to write leadership claim: {e}")
-                        time.sleep(CHECK_EVERY)
-                        continue
-
-                    new_leader, _, _ = read_lock(ws)
-                    if new_leader == INSTANCE_NAME:
-                        print(f"[{INSTANCE_NAME}] 🏆 Became leader!")
-                        i_am_leader = True
-                        last_hb = time.time()
-                        if bot_proc is None:
-                            bot_proc = start_bot()
-                    else:
-                        print(f"[{INSTANCE_NAME}] Lost race, leader is {new_leader}")
-
-                else:
-                    if bot_proc is not None:
+                    problem = probe_bot(bot_proc)
+                    if problem:
+                        print(f"[{INSTANCE_NAME}] 🩺 Bot unhealthy ({problem}); stepping down.")
                         stop_bot(bot_proc)
                         bot_proc = None
-                    print(f"[{INSTANCE_NAME}] Standby (leader {leader_id} alive).")
+                        bot_backoff.failed()
+                        elector.step_down(STEP_DOWN_COOLDOWN)
+            else:
+                if bot_proc is not None:
+                    stop_bot(bot_proc)
+                    bot_proc = None
+                if replicator:
+                    replicator.follow()
+                if standby_proc is not None and standby_proc.poll() is not None:
+                    delay = standby_backoff.failed()
+                    print(f"[{INSTANCE_NAME}] 💥 Standby bot exited ({standby_proc.returncode}); restarting in {delay:.0f}s.")
+                    stop_bot(standby_proc)
+                    standby_proc = None
+                if HOT_STANDBY and standby_proc is None and standby_backoff.ready():
+                    standby_proc = start_standby()
+                    standby_backoff.started()
 
             time.sleep(CHECK_EVERY)
-
-        except Exception as e:
-            print(f"[{INSTANCE_NAME}] ❌ Error in loop: {e}")
-            time.sleep(10)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_bot(bot_proc)
+        stop_bot(standby_proc)
+        elector.release()
+        print(f"[{INSTANCE_NAME}] Cluster runner stopped.")
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import logging
 
 # --- LOAD ENV FILE ---
@@ -44,6 +45,153 @@ EXPERT_COURSE_DRIVE_FOLDER_ID = os.environ.get("EXPERT_COURSE_DRIVE_FOLDER_ID",
 HIGHSCHOOL_COURSE_DRIVE_FOLDER_ID = os.environ.get("HIGHSCHOOL_COURSE_DRIVE_FOLDER_ID", "")
 CUSTOMER_SUPPORT_USERNAME = os.environ.get("CUSTOMER_SUPPORT_USERNAME", "http://wa.me/249925062970")
 
+# Load the Google client libraries in the background once polling has started
+# (they are otherwise imported lazily on the first Sheets/Drive call).
+PREWARM_GOOGLE_IMPORTS = os.environ.get("PREWARM_GOOGLE_IMPORTS", "1").strip() not in ("0", "false", "no")
+
+# --- (1.05) SERVING MODE ---
+# "polling" (default) or "webhook". Webhook mode runs webhook.py's HTTP server:
+# POST WEBHOOK_PATH (Telegram updates), GET /healthz and GET /readyz.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Public URL Telegram should call (e.g. https://bot.example.com/telegram);
+# empty = don't call setWebhook (the ingress / another worker registers it)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip()
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Shared by every worker behind the same ingress; defaults to a value derived
+# from the bot token so all workers agree without extra configuration
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip() or hashlib.sha256(
+    f"webhook:{BOT_TOKEN}".encode("utf-8")
+).hexdigest()[:32]
+# Point the bot at another Bot API server (a local stand-in for tests, or a
+# self-hosted telegram-bot-api), e.g. http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "").strip()
+
+# --- (1.06) SHARDING ---
+# SHARD_COUNT > 1: `python sharding.py` runs an ingress router on WEBHOOK_PORT
+# that hashes each update's chat_id to one of SHARD_COUNT webhook workers
+# (newbot.py processes listening on SHARD_HOST:SHARD_BASE_PORT + index).
+SHARD_COUNT = max(1, int(os.environ.get("SHARD_COUNT", "1")))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))   # set by the router for each worker
+SHARD_HOST = os.environ.get("SHARD_HOST", "127.0.0.1")
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", "9100"))
+# Seconds the router waits for a worker to accept an update before answering
+# Telegram with 503 (Telegram then redelivers it)
+SHARD_FORWARD_TIMEOUT = float(os.environ.get("SHARD_FORWARD_TIMEOUT", "10"))
+# Each shard's known users file lives here (mounted from the host by the
+# deploy scripts, like known_users.json)
+KNOWN_USERS_SHARD_DIR = os.environ.get("KNOWN_USERS_SHARD_DIR", "known_users")
+# Messages per second a broadcast sends for the whole bot (Telegram allows
+# about 30 per bot token); every shard sends its part at an equal share
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+
+# --- (1.07) FAILOVER FENCING ---
+# Set by cluster_runner.py for standby bots: prepare everything, then wait on
+# stdin for promotion (see standby.py)
+BOT_STANDBY = os.environ.get("BOT_STANDBY", "0").strip() == "1"
+# Set by cluster_runner.py for the bot it starts; 0 = not under a runner, no fencing.
+FENCING_TOKEN = int(os.environ.get("FENCING_TOKEN", "0") or 0)
+FENCING_HOLDER = os.environ.get("FENCING_HOLDER", "")
+# How often the watchdog re-checks leadership, and how long side effects may
+# go on without a successful check
+FENCE_CHECK_INTERVAL = float(os.environ.get("FENCE_CHECK_INTERVAL", "2"))
+FENCE_MAX_AGE = float(os.environ.get("FENCE_MAX_AGE", "3"))
+# A stale bot is asked to stop, then killed if still alive after this many seconds
+FENCE_EXIT_GRACE = float(os.environ.get("FENCE_EXIT_GRACE", "10"))
+
+# --- (1.08) HEALTH ---
+# Heartbeat file the bot rewrites every HEALTH_INTERVAL seconds (set by
+# cluster_runner.py; empty = no file). The bot reports itself unhealthy when the
+# event loop lags more than HEALTH_MAX_LAG seconds or an update has been in
+# flight for more than HEALTH_MAX_UPDATE_AGE seconds (e.g. a hung Google call).
+# The age counts from when the update got its chat's turn; long admin jobs
+# (broadcasts, bulk decisions) run as background tasks and don't count.
+BOT_HEALTH_FILE = os.environ.get("BOT_HEALTH_FILE", "")
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "1"))
+HEALTH_MAX_LAG = float(os.environ.get("HEALTH_MAX_LAG", "5"))
+HEALTH_MAX_UPDATE_AGE = float(os.environ.get("HEALTH_MAX_UPDATE_AGE", "120"))
+# Loop lag is sampled every LAG_SAMPLE_INTERVAL seconds. A loop stuck for
+# SLOW_CALLBACK_SECONDS is logged with the blocking stack; an update running for
+# SLOW_HANDLER_SECONDS with the call it is waiting on (see health.py, /health).
+LAG_SAMPLE_INTERVAL = float(os.environ.get("LAG_SAMPLE_INTERVAL", "0.1"))
+SLOW_CALLBACK_SECONDS = float(os.environ.get("SLOW_CALLBACK_SECONDS", "0.5"))
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_SECONDS", "10"))
+# Crash-loop backoff for restarted bots / shard workers: BACKOFF_BASE, doubling
+# up to BACKOFF_MAX; reset once a process stays up for BACKOFF_RESET seconds
+BACKOFF_BASE = float(os.environ.get("BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.environ.get("BACKOFF_MAX", "60"))
+BACKOFF_RESET = float(os.environ.get("BACKOFF_RESET", "120"))
+
+# --- (1.09) DATABASE REPLICATION ---
+# Other nodes' cluster runners, e.g. http://10.0.0.2:9400,http://10.0.0.3:9400
+# (empty = no replication). The leader's runner ships bot_state.db to them at
+# most every REPLICATION_INTERVAL seconds; every runner accepts snapshots on
+# REPLICATION_LISTEN:REPLICATION_PORT while it is not the leader (see replication.py).
+REPLICATION_PEERS = [url.strip().rstrip("/") for url in os.environ.get("REPLICATION_PEERS", "").split(",") if url.strip()]
+REPLICATION_LISTEN = os.environ.get("REPLICATION_LISTEN", "0.0.0.0")
+REPLICATION_PORT = int(os.environ.get("REPLICATION_PORT", "9400"))
+REPLICATION_INTERVAL = float(os.environ.get("REPLICATION_INTERVAL", "1"))
+REPLICATION_TIMEOUT = float(os.environ.get("REPLICATION_TIMEOUT", "10"))
+REPLICATION_SECRET = os.environ.get("REPLICATION_SECRET", "").strip() or hashlib.sha256(
+    f"replication:{BOT_TOKEN}".encode("utf-8")
+).hexdigest()[:32]
+
+# --- (1.10) BACKUPS ---
+# Gzipped online snapshots of bot_state.db (see backups.py); 0 = only on /backup
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", str(6 * 3600)))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "28"))   # newest files kept; 0 = keep all
+# Pages copied per step and the pause between steps, so writers never wait long
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.environ.get("BACKUP_STEP_SLEEP", "0.005"))
+
+# --- (1.11) METRICS ---
+# Prometheus-format GET /metrics (see metrics.py): on the webhook server in
+# webhook mode, on METRICS_LISTEN:METRICS_PORT in polling mode (0 = no server).
+# METRICS_ENABLED=0 removes the instrumentation altogether.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").strip() not in ("0", "false", "no")
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+
+# --- (1.12) TRACING ---
+# Per-registration timelines (see tracing.py, /trace); spans older than
+# TRACE_RETENTION_DAYS are deleted
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1").strip() not in ("0", "false", "no")
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "2"))
+TRACE_RETENTION_DAYS = float(os.environ.get("TRACE_RETENTION_DAYS", "30"))
+
+# --- (1.13) FUNNEL ---
+# Stage-change events are folded into hourly / daily rollups this often (see
+# funnel.py); /funnel also catches up before answering. 0 = only on /funnel
+FUNNEL_ROLLUP_INTERVAL = float(os.environ.get("FUNNEL_ROLLUP_INTERVAL", "60"))
+
+# --- (1.14) PENDING QUEUE ---
+# /pending lists submitted-but-undecided registrations PENDING_PAGE_SIZE at a
+# time; a bulk approve/reject runs at most BULK_DECISION_CONCURRENCY decisions at once
+PENDING_PAGE_SIZE = int(os.environ.get("PENDING_PAGE_SIZE", "10"))
+BULK_DECISION_CONCURRENCY = int(os.environ.get("BULK_DECISION_CONCURRENCY", "4"))
+# A decision whose pipeline failed can be clicked again; one still "in progress"
+# after DECISION_CLAIM_TTL seconds (its process died mid-run) can be retaken
+DECISION_CLAIM_TTL = float(os.environ.get("DECISION_CLAIM_TTL", "900"))
+
+# --- (1.15) RECEIPTS ---
+# Every RECEIPT_HASH_INTERVAL seconds up to RECEIPT_HASH_BATCH new receipts are
+# downloaded into RECEIPT_ARCHIVE_DIR (content-addressed) and hashed for
+# duplicate detection (see receipts.py). 0 = off. The deploy scripts mount
+# RECEIPT_ARCHIVE_DIR from the host so the archive survives redeploys
+RECEIPT_ARCHIVE_DIR = os.environ.get("RECEIPT_ARCHIVE_DIR", "receipt_archive")
+RECEIPT_HASH_INTERVAL = float(os.environ.get("RECEIPT_HASH_INTERVAL", "20"))
+RECEIPT_HASH_BATCH = int(os.environ.get("RECEIPT_HASH_BATCH", "10"))
+
+# --- (1.16) UPDATE CONCURRENCY ---
+# Max updates processed at once across different chats (same chat is always
+# processed in order). 0 = handle updates one by one. Up to
+# MAX_QUEUED_UPDATES more can wait for their chat's turn (see chat_processor.py)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+MAX_QUEUED_UPDATES = int(os.environ.get("MAX_QUEUED_UPDATES", "4096"))
+
 # --- (1.1) PAYMENT CREDENTIALS ---
 # Fallback strings provided just in case env is missing during dev, but should be in .env
 VODAFONE_EG_NUMBER = os.environ.get("VODAFONE_EG_NUMBER", "00201116209938")
@@ -58,172 +206,143 @@ IBAN_NOTES        = os.environ.get("IBAN_NOTES", "ضع اسمك بالتعليق
 PAYPAL_LINK  = os.environ.get("PAYPAL_LINK", "https://www.paypal.me/asifYusif")
 PAYPAL_NOTES = os.environ.get("PAYPAL_NOTES", "اكتب في الملاحظات: BADR-COURSE + اسمك الكامل")
 
-# --- (2) COURSES / FAQ ---
-COURSES = {
-    "expert": {
-        "title": "🧠 كورس خبير الذاكرة (Memory Expert)",
-        "description": """
-أهلاً وسهلاً في عالم الذاكرة الخارقة! 🧠✨
-معك د. بدر إبراهيم – طبيب، بطل تحدي العقل القوي 2025 🏆
-
-هل تخيلت يوماً أن تمتلك ذاكرة حديدية لا تنسى؟
-هذا الكورس هو بوابتك لتحويل هذا الحلم إلى حقيقة 👇
-
-🎯 كورس "خبير تقنيات الذاكرة"
-دليلك العملي الشامل للتفوق الدراسي واكتساب ذاكرة فولاذية.
-
-🔍 ماذا ستتقن في هذا الكورس؟
-✅ حفظ أي معلومة من المرة الأولى (وداعاً للتكرار الممل!)
-✅ استيعاب وحفظ الكتب والمناهج الدراسية بسرعة وذكاء
-✅ حفظ الأرقام، التواريخ، والأسماء بدقة متناهية
-✅ تطوير ذاكرة سمعية قوية (احفظ ما تسمعه فوراً)
-✅ أساليب مذاكرة ممتعة وفعّالة تقضي على الملل
-✅ تسريع تعلم أي مهارة أو لغة جديدة
-✅ بناء عادات دراسية صلبة تضمن لك التفوق المستمر
-
-💎 لماذا هذا الكورس؟
-🎥 محاضرات مسجلة احترافية (شاهدها في أي وقت)
-📝 تدريبات عملية يومية + مجتمع داعم (قروب خاص)
-📆 متابعة دورية لضمان تقدمك
-📞 لقاءات مباشرة (Live) شهرية مع د. بدر للإجابة على أسئلتك
-💰 السعر الحالي: 17$ فقط (بدلاً من 97$) ⚡️
-🎁 تنبيه: هذا العرض سارٍ لغاية يوم 10 يناير!
-
-🔥 استثمار بسيط اليوم.. يمنحك مهارة تخدمك مدى الحياة!
-
-📩 جاهز للبداية؟
-لا تضيع الفرصة! اضغط على زر "✅ الانضمام الآن" بالأسفل 👇 لتبدأ رحلتك فوراً.
-
-متشوق جداً لرؤيتك داخل الكورس! 🚀
-د. بدر إبراهيم
-        """,
-        "price": 17,
-    },
-    "private": {
-        "title": " التدريب الشخصي (Personal Coaching)",
-        "description": """
-✨ التدريب الشخصي مع د. بدر إبراهيم ✨
-الطريقة الأسرع والأقوى لتطوير ذاكرتك… لأنك حتتدرّب مباشرة مع المدرب خطوة بخطوة.
-
-✅ البرنامج مصمم بالكامل لأهدافك أنت، ومشاكلك الخاصة، ونمط حياتك.
-✅ مناسب لأي شخص يفضّل التدريب المباشر على المحاضرات المسجّلة.
-✅ مرن وسلس – المواعيد بتتحدد حسب وقتك.
-✅ أونلاين عبر Google Meet.
-✅ 4 جلسات تدريبية (جلسة أسبوعياً) + متابعة يومية شخصية طوال فترة البرنامج.
-
-🎯 التدريب الشخصي مثالي إذا كنت:
-- عايز نتائج أسرع بعشر مرات من الكورسات العادية.
-- تفضّل خطة عملية مخصّصة بدل المحتوى العام.
-- حابب تعيش تجربة تدريبية خاصة بك، مع دعم مستمر من المدرب.
-
-💡 خلال الأسابيع الخمسة، حتتعلم وتطبّق تدريبات ذاكرة متدرجة، مصممة خصيصاً لاحتياجاتك، مع تصحيح مباشر وملاحظات شخصية من د. بدر.
-
-💰 السعر: 99 دولار
-قيمة مقابل تجربة تدريبية مخصّصة لك من البداية للنهاية.
-        """,
-        "price": 99,
-    },
+# --- (2) COURSES / FAQ / PRICES ---
+# Course descriptions, FAQs and per-method prices live in the catalog file and
+# are hot-reloaded by catalog.py (no redeploy needed for price/promo changes).
+CATALOG_FILE = os.environ.get("CATALOG_FILE", "catalog.json")
+CATALOG_RELOAD_INTERVAL = int(os.environ.get("CATALOG_RELOAD_INTERVAL", "10"))  # seconds
+
+# --- (2.5) REGISTRATION FLOW ---
+# Courses that register several seats in one order (children / trainees). Each
+# gets its own awaiting_<prefix>_count / awaiting_<prefix>_names /
+# confirm_<prefix>_names stages and <prefix>_count / <prefix>_names fields.
+SEAT_COURSES = {
     "kids": {
-        "title": "👧 تدريب الأطفال (Super Kids Memory)",
-        "description": """
-👧 برنامج تدريب الأطفال على تقنيات الذاكرة (Super Kids Memory)
-
-الأطفال عندهم قدرات مذهلة، لكن نادرًا ما يتم تدريبهم على كيفية استخدام ذاكرتهم بفعالية. هذا البرنامج التفاعلي بيعرّفهم على أقوى تقنيات الذاكرة العالمية بأسلوب ممتع يساعدهم على:
-
-✅ الحفظ بسرعة وفهم أعمق للمعلومات
-✅ رفع التحصيل الأكاديمي والتميز الدراسي
-✅ بناء الثقة بالنفس في التعلم والمذاكرة
-✅ تحويل الدراسة إلى تجربة ممتعة وسلسة
-✅ إشراك الأسرة لضمان أفضل متابعة ودعم
-
-📅 مدة البرنامج: شهران – 8 محاضرات تفاعلية (مرة أسبوعيًا عبر Google Meet)
-تاريخ البدء: يوم السبت الموافق 13 ديسمبر
-📝 متابعة يومية: تمارين قصيرة + دعم عبر واتساب + تقارير أسبوعية
-🎯 الفئة المستهدفة: الأطفال من 8 إلى 14 سنة
-💰 الاستثمار: 25 دولار للطفل
-
-📄 للتفاصيل الكاملة، يمكنك قراءة الملف كاملاً هنا:
-👉 [🎓 برنامج تدريب الأطفال على تقنيات الذاكرة (PDF)](https://drive.google.com/file/d/1pVdep627nq2-JjfYI-SEJDJpq9--NH7X/view?usp=sharing)
-        """,
-        "price": 25,
+        "prefix": "kids",
+        "unit_label": "لكل طفل",
+        "count_prompt": "كم عدد الأطفال المسجّلين؟ (اكتب رقماً، مثال: 1 أو 2 أو 3)",
+        "names_prompt": "ما هي أسماء الأطفال؟ اكتبها مفصولة بفواصل. مثال: أحمد، سارة",
     },
     "highschool": {
-        "title": "🎓 تدريب طلاب الشهادة الثانوية",
-        "description": """
-🎓 أهلاً بك! أنا د. بدر إبراهيم – مدرب ذاكرة وبطل تحدي العقل القوي 2025 🧠🏆
-
-لو ابنك في الثانوية… البرنامج ده بيغيير طريقة مذاكرته تماماً.
-صار الآن متاح في أي وقت… يشاهد الدروس وينضم لورش لايف شهرية ويتابع معنا لحد يوم الامتحان.
-
-هذه كل التفاصيل 👇
-
-🎯 اسم البرنامج:
-كورس تقوية الذاكرة والتفوق الأكاديمي لطلاب الشهادة الثانوية
-
-🔍 ماذا سيتعلم ابنك؟
-• كيف يحفظ أي معلومة من أول مرة
-• طريقة ذكية لحفظ الكتب والمقررات
-• التعامل مع الأرقام والتواريخ بسهولة
-• تقوية الذاكرة السمعية والحفظ من المسموع
-• مذاكرة فعّالة بدون ملل ولا ضغط
-• تعلم المهارات بسرعة وبنظام
-• بناء عادة مذاكرة ثابتة قبل الامتحان
-
-✨ مميزات النسخة الجديدة (الدائمة):
-🎥 5 محاضرات مسجلة جاهزة للمشاهدة فوراً
-167: 🧪 ورش عملية لايف مرة كل شهر
-📝 متابعة يومية داخل قروب تليجرام للإجابة على الأسئلة
-🎯 مساعدة مستمرة في حفظ المواد المختلفة + تجهيز خطة مذاكرة
-📅 دعم مستمر لحد يوم الامتحان
-💰 الرسوم: 17 دولار أمريكي أو 65 ألف جنيه سوداني
-
-📩 للانضمام أرسل: "الانضمام الآن"
-وسأرسل لك خطوات التسجيل والدفع مباشرة.
-
-ابنك يقدر يبدأ اليوم… ويغيّر مستواه خلال أيام قليلة.
-معك د. بدر إبراهيم 🚀
-""",
-        "price": 17
-    }
+        "prefix": "hs",
+        "unit_label": "لكل متدرب",
+        "count_prompt": "كم عدد المتدربين في البرنامج؟ (اكتب رقماً، مثال: 1 أو 2 أو 3)",
+        "names_prompt": "ما هي أسماء المتدربين؟ اكتبها مفصولة بفواصل. مثال: علي، محمد",
+    },
 }
 
-FAQS = {
-     "expert": {
-        "مدة المحاضرات الفيديو؟": "10 ساعات",
-        "عدد المحاضرات؟": "5 محاضرات",
-        "هل المحاضرات مسجلة ام مباشر؟": "المحاضرات مسجلة ولكن هنالك اجتماع شهري عبر قوقل ميت مع المدرب",
-        "كيف نظام المتابعة؟": "يوجد قروب تليجرام عليه دعم يومي من المدرب تقدر ترسل تمارينك و اسئلتك عليه",
-        "مدة الكورس كاملة كم؟": "خمسة اسابيع، عند اشتراكك ستتحصل على دليل فيه جميع التمارين اليومية، ومن المفترض ان تقوم بتحديد يوم في الاسبوع لمشاهدة محاضرة واحدة و بعدها عمل تمرين ذاكرة يومياً خلال الاسبوع",
-        "ما هي هذه التمارين؟": "في نهاية كل محاضرة ستجد التمارين مكتوبة في دليل الكورس، واذا واجهت اي مشكلة يمكنك سؤال المدرب مباشرة",
-        "كم تأخذ هذه التمارين اليومية؟": "من ١٥ دقيقة إلى ٣٠ دقيقة و يمكنك الزيادة ان أردت",
-        "هل مدة الكورس محدودة ؟": "لا، يمكنك الاحتفاظ بالمحاضرات على قوقل درايف مدى الحياة"
+# Courses delivered through Google Drive: Gmail only, typed twice
+GMAIL_COURSES = ["expert", "highschool"]
+
+# --- (2.6) PAYMENT METHODS REGISTRY ---
+# One entry per `pay_<key>` callback, in keyboard order. `details` is shown under
+# the header, `extra_info_stage` is where the user goes after sending the receipt
+# (None → straight to admin review) after being shown `extra_info_prompt`.
+# Prices per method come from the catalog's "prices" section.
+PAYMENT_METHODS = {
+    "paypal": {
+        "button": "PayPal",
+        "name": "PayPal",
+        "header": "الدفع عبر PayPal:",
+        "details": (
+            f"رابط الدفع:  {PAYPAL_LINK}\n"
+            f"ملاحظات:  {PAYPAL_NOTES}\n"
+            "بعد الدفع أرسل صورة الإيصال هنا مباشرة."
+        ),
+        "extra_info_stage": None,
     },
-    "private": {
-          "ما هي مواعيد التدريب الشخصي؟": "أي وقت مناسب لديك يمكنك الاتفاق مباشرة مع المدرب د. بدر ابراهيم، وعند تحديد الوقت المناسب يمكنك البدء بأخذ الجلسات التدريبية.",
-        "كم هي عدد الجلسات التدريبية؟": "خمسة جلسات أو اكثر حسب ما يتطلب الأمر.",
-        "ما الفرق بين التدريب الشخصي وخبير الذاكرة؟": "كورس خبير الذاكرة عام لكل المجالات، ولكن التدريب الشخصي يكون مخصص عشان اهدافك الخاصة و مجالك الاحترافي.",
-        "هل التدريب الشخصي لايف؟": "نعم التدريب الشخصي يكون مباشر مع المدرب، وليس محاضرات تم تسجيلها مسبقاً.",
-        "هل التدريب الشخصي افضل من كورس خبير الذاكرة؟": "ليس بالضرورة، و لكن التدريب الشخصي يجعلك تمتلك المعرفة الكافية لتطبيق تقنيات الذاكرة بسرعة في مجالك.",
-        "هل التدريب الشخصي مخصص لاعمار معينة؟": "لا، التدريب الشخصي ليس مخصص لعمر معين، أي شخص فوق 8 سنوات وحتى 65 عام يمكنه الحصول على تدريب شخصي مخصص لاهدافه.",
-        "ما سعر التدريب الشخصي؟": "149$ دولار أمريكي.",
-        "لماذا هو أغلى من كورس خبير الذاكرة؟": "لأن المدرب يعمل معك مباشرة ويقوم بتخصيص برنامج تدريبي كامل لك أنت فقط!",
-        "متى يكون التدريب الشخصي مناسب؟": "اذا كنت تفضل التدريب المباشر، بدلاً من مشاهدة المحاضرات، وتريد نتائج سريعة بمجال تخصصك.",
-        "كيفية التسجيل؟": "يمكنك الرجوع للقائمة الرئيسية واتباع التعليمات للتسجيل ببرنامج التدريب الشخصي."
+    "bankak": {
+        "button": "بنكك (السودان)",
+        "name": "بنكك (السودان)",
+        "header": "الدفع عبر بنكك (السودان):",
+        "details": (
+            "رقم حساب بنكك:  3277030\n"
+            "باسم:  بدر إبراهيم"
+        ),
+        "extra_info_stage": None,
     },
-    "kids": {
-        "لمن هذا البرنامج؟": "للأطفال من 8 إلى 14 سنة.",
-        "كم السعر؟": "25 دولار للطفل.",
+    "saudi": {
+        "button": "تحويل بنكي (السعودية)",
+        "name": "تحويل بنكي (السعودية)",
+        "header": "الدفع عبر تحويل بنكي مباشر (السعودية):",
+        "details": (
+            "الاسم:  علي محمد فضل الله بادي\n"
+            "البنك:  البنك الأهلي السعودي\n"
+            "الآيبان:  SA2410000011100312428804\n"
+            "رقم الحساب:  11100312428804\n"
+            "رمز سويفت:  NCBKSAJE"
+        ),
+        "extra_info_stage": None,
+    },
+    "uae": {
+        "button": "تحويل بنكي (الإمارات)",
+        "name": "تحويل بنكي (الإمارات)",
+        "header": "الدفع عبر تحويل بنكي مباشر (الإمارات):",
+        "details": (
+            "اسم صاحب الحساب:  MORWAN MOHAMED\n"
+            "اسم البنك:  بنك الماريه المحلي\n"
+            "رقم الحساب:  5270516520000001\n"
+            "الآيبان:  AE570975270516520000001\n"
+            "العملة:  AED"
+        ),
+        "extra_info_stage": None,
+    },
+    "wu_mg": {
+        "button": "Western Union / MoneyGram",
+        "name": "Western Union / MoneyGram",
+        "header": "الدفع عبر Western Union / MoneyGram:",
+        "details": (
+            "الاسم:  BADOR IBRAHIM ALFAKI KHALID\n"
+            "الدولة:  RWANDA\n"
+            "رقم الهاتف:  +250735721744"
+        ),
+        "footer": "ثم أرسل في رسالة واحدة: الاسم الكامل / الدولة / الرقم المرجعي (MTCN).\n",
+        "extra_info_stage": "awaiting_wu_details",
+        "extra_info_prompt": (
+            "تم استلام الإيصال. لإكمال التحقق، أرسل في رسالة واحدة:\n"
+            "- الاسم الكامل المستخدم في الحوالة\n"
+            "- الدولة التي أرسلت منها\n"
+            "- الرقم المرجعي (MTCN or Reference No.)"
+        ),
+    },
+    "rwanda": {
+        "button": "محفظة الهاتف (رواندا)",
+        "name": "محفظة الهاتف (رواندا)",
+        "header": "الدفع عبر محفظة الهاتف (رواندا):",
+        "details": (
+            "مفتاح رواندا:  250\n"
+            "محفظة مومو:  0795342923\n"
+            "محفظة ايرتيل:  0735721744"
+        ),
+        "extra_info_stage": None,
+    },
+    "vodafone_eg": {
+        "button": "فودافون كاش / انستا باي (مصر)",
+        "name": "فودافون كاش / انستا باي (مصر)",
+        "header": "الدفع عبر فودافون كاش / انستا باي (مصر):",
+        "details": (
+            f"رقم فودافون كاش / انستا باي : محمد خالد {VODAFONE_EG_NUMBER}\n"
+            "بعد التحويل، يُرجى إرسال لقطة شاشة (Screenshot) لعملية الدفع لتأكيد الاستلام و منحك الوصول لمحتوى الدورة مباشرة. شكرًا لك 🌟"
+        ),
+        "extra_info_stage": "awaiting_vodafone_details",
+        "extra_info_prompt": (
+            "تم استلام الإيصال بنجاح 👍\n"
+            "الرجاء إرسال في رسالة واحدة:\n"
+            "- الاسم الكامل الذي تم التحويل منه\n"
+            "- رقم المحفظة التي تم التحويل منها"
+        ),
+    },
+    "iban": {
+        "button": "تحويل بنكي عبر IBAN",
+        "name": "تحويل بنكي (IBAN)",
+        "header": "التحويل البنكي عبر IBAN (دولي):",
+        "details": (
+            f"اسم صاحب الحساب:  {IBAN_ACCOUNT_NAME}\n"
+            f"اسم البنك:  {IBAN_BANK_NAME}\n"
+            f"الآيبان (IBAN):  {IBAN_NUMBER}\n"
+            f"سويفت (SWIFT):  {IBAN_SWIFT}\n"
+            f"ملاحظات التحويل:  {IBAN_NOTES}"
+        ),
+        "extra_info_stage": None,
     },
-}
-
-# --- (2.5) DYNAMIC PRICING MAPS ---
-PRICES = {
-    "saudi": {"expert": 65, "private": 375, "kids": 99, "highschool": 65, "currency": "ريال سعودي"},
-    "uae":   {"expert": 65, "private": 370, "kids": 99, "highschool": 65, "currency": "درهم إماراتي"},
-    "wu_mg": {"expert": 19, "private": 99, "kids": 25, "highschool": 17, "currency": "دولار"},
-    "rwanda":{"expert": 25000, "private": 144000, "kids": 36200, "highschool": 25000, "currency": "فرنك رواندي"},
-    "bankak":{"expert": 65000, "private": 385000, "kids": 97000, "highschool": 65000, "currency": "جنيه سوداني"},
-  "vodafone_eg": {"expert": 800, "private": 4675, "kids": 1250, "highschool": 800, "currency": "جنيه مصري"},  # Placeholder
-    "iban":        {"expert": 17,  "private": 99,  "kids": 25, "highschool": 17,   "currency": "دولار"},       # عادة بالدولار
-    "paypal":      {"expert": 17,  "private": 99,  "kids": 25, "highschool": 17, "currency": "دولار"},
 }
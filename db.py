@@ -1,7 +1,12 @@
+import re
 import sqlite3
 import json
+import time
 import logging
-from typing import Dict, Optional
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import config
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -9,16 +14,72 @@ DB_FILE = "bot_state.db"
 
 import datetime
 
+# --- FENCING ---
+# Under cluster_runner each leadership term has a token (fencing.claim() sets
+# FENCING_TOKEN and registers it here). Every write checks, in its own
+# transaction, that no newer term has stored a higher token, so a stale bot
+# that is still running after a failover cannot change anything.
+FENCING_TOKEN = 0
+
+class StaleFencingToken(Exception):
+    pass
+
+def _check_fence(cursor):
+    """Call after the write and before commit: the write lock is held by then,
+    so a newer leader cannot register its token in between."""
+    if not FENCING_TOKEN:
+        return
+    cursor.execute("SELECT token FROM fencing WHERE id = 1")
+    row = cursor.fetchone()
+    if row and row[0] > FENCING_TOKEN:
+        # Release the write lock now rather than whenever the connection is collected
+        cursor.connection.rollback()
+        raise StaleFencingToken(f"fencing token {FENCING_TOKEN} superseded by {row[0]}")
+
+@metrics.timed("db")
+def advance_fencing_token(token: int) -> int:
+    """Stores `token` unless a higher one is already there; returns the stored
+    token. Errors propagate: a bot that can't register its token must not run."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO fencing (id, token, updated_at) VALUES (1, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                token = MAX(fencing.token, excluded.token),
+                updated_at = CASE WHEN excluded.token > fencing.token THEN excluded.updated_at ELSE fencing.updated_at END
+        """, (token, datetime.datetime.now()))
+        cursor.execute("SELECT token FROM fencing WHERE id = 1")
+        stored = cursor.fetchone()[0]
+        conn.commit()
+        return stored
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def get_fencing_token() -> int:
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute("SELECT token FROM fencing WHERE id = 1").fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+@metrics.timed("db")
 def init_db():
     try:
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
+        # WAL lets readers run while another process (shard) writes; it is
+        # persistent, so setting it once at startup covers every connection
+        cursor.execute("PRAGMA journal_mode=WAL")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS user_states (
                 user_id INTEGER PRIMARY KEY,
                 state_data TEXT,
                 last_updated TIMESTAMP,
-                reminder_sent INTEGER DEFAULT 0
+                reminder_sent INTEGER DEFAULT 0,
+                version INTEGER DEFAULT 0
             )
         """)
         
@@ -33,12 +94,362 @@ def init_db():
         except sqlite3.OperationalError:
             pass
 
+        try:
+            cursor.execute("ALTER TABLE user_states ADD COLUMN version INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+
+        # One row per registration request; the PRIMARY KEY is the claim
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS admin_decisions (
+                request_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                action TEXT,
+                admin_id INTEGER,
+                admin_name TEXT,
+                status TEXT DEFAULT 'in_progress',
+                decided_at TIMESTAMP,
+                steps TEXT DEFAULT ''
+            )
+        """)
+        try:
+            # Side effects already done (comma-separated), skipped when a claim is retaken
+            cursor.execute("ALTER TABLE admin_decisions ADD COLUMN steps TEXT DEFAULT ''")
+        except sqlite3.OperationalError:
+            pass
+
+        # Highest fencing token registered by any leadership term (single row)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fencing (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                token INTEGER NOT NULL,
+                updated_at TIMESTAMP
+            )
+        """)
+
+        # Append-only stage transitions (one row per change, never updated);
+        # funnel_hourly / funnel_daily are rolled up from it by funnel.py
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                at REAL NOT NULL,
+                from_stage TEXT,
+                to_stage TEXT NOT NULL,
+                course TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, id)")
+        for table in ("funnel_hourly", "funnel_daily"):
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket TEXT NOT NULL,
+                    course TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    entered INTEGER NOT NULL DEFAULT 0,
+                    exited INTEGER NOT NULL DEFAULT 0,
+                    stage_seconds REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bucket, course, stage)
+                )
+            """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_event_id INTEGER NOT NULL
+            )
+        """)
+
+        # Approval ledger (one row per approved request, with the price charged)
+        # and its per-day totals, kept in step by _insert_approval
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS approvals (
+                request_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                approved_at REAL NOT NULL,
+                day TEXT NOT NULL,
+                course TEXT,
+                seats INTEGER,
+                method_key TEXT,
+                currency TEXT,
+                list_amount REAL,
+                discount_percent REAL,
+                coupon_code TEXT,
+                amount REAL,
+                usd_rate REAL,
+                amount_paid TEXT,
+                admin_id INTEGER
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_approvals_day ON approvals (day)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS revenue_daily (
+                day TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                method_key TEXT NOT NULL,
+                course TEXT NOT NULL,
+                approvals INTEGER NOT NULL DEFAULT 0,
+                amount REAL NOT NULL DEFAULT 0,
+                discount REAL NOT NULL DEFAULT 0,
+                usd_amount REAL NOT NULL DEFAULT 0,
+                unconverted INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, currency, method_key, course)
+            )
+        """)
+
+        # Registrations waiting for an admin decision (/pending), kept by _after_write
+        new_queue = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pending_approvals'").fetchone() is None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pending_approvals (
+                user_id INTEGER PRIMARY KEY,
+                since REAL NOT NULL,
+                course TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_since ON pending_approvals (since)")
+        if new_queue:
+            for user_id, state_data, last_updated in cursor.execute(
+                    "SELECT user_id, state_data, last_updated FROM user_states").fetchall():
+                try:
+                    state = json.loads(state_data)
+                except ValueError:
+                    continue
+                if _stage_of(state) == PENDING_STAGE:
+                    cursor.execute("INSERT INTO pending_approvals (user_id, since, course) VALUES (?, ?, ?)",
+                                   (user_id, _timestamp(last_updated), state.get("course")))
+
+        # Every receipt received (receipts.py), kept after the state is deleted: the
+        # same file has the same file_unique_id whoever sends it; content_hash (sha256
+        # of the bytes, also the file's name in the archive), size and the
+        # thumbnail's hash are filled in by the background archiver
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS receipts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                file_unique_id TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                is_photo INTEGER NOT NULL,
+                received_at REAL NOT NULL,
+                content_hash TEXT,
+                hash_attempts INTEGER NOT NULL DEFAULT 0,
+                ext TEXT,
+                size INTEGER,
+                thumb_file_id TEXT,
+                thumb_hash TEXT,
+                request_id TEXT
+            )
+        """)
+        for column in ("ext TEXT", "size INTEGER", "thumb_file_id TEXT", "thumb_hash TEXT", "request_id TEXT"):
+            try:
+                cursor.execute(f"ALTER TABLE receipts ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_file ON receipts (file_unique_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_user ON receipts (user_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_request ON receipts (request_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_hash ON receipts (content_hash) WHERE content_hash IS NOT NULL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_unhashed ON receipts (id) WHERE content_hash IS NULL")
+
+        # Full-text search over registrations (/find)
+        _create_search_index(cursor)
+
+        # Registration traces (tracing.py): one row per handler step, plus one
+        # per external call inside it (same step / step_at)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS trace_spans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                trace_id TEXT NOT NULL,
+                user_id INTEGER,
+                step TEXT,
+                step_at REAL,
+                name TEXT,
+                started_at REAL,
+                duration_ms REAL,
+                status TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_trace ON trace_spans (trace_id, started_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_user ON trace_spans (user_id, started_at)")
+
         conn.commit()
         conn.close()
         logger.info("Database initialized successfully.")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
 
+# --- STAGE EVENTS ---
+START_STAGE = "start"   # stage of a state without one (right after /start)
+
+def _timestamp(value) -> float:
+    """user_states.last_updated (stored by the sqlite3 datetime adapter) as a Unix time."""
+    try:
+        return datetime.datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return time.time()
+
+def _stage_of(state: Dict) -> str:
+    return state.get("stage") or START_STAGE
+
+def _log_transition(cursor, user_id: int, old: Optional[Dict], new_stage: str, course: Optional[str]):
+    """Appends to `events` when a write moves the user to another stage (old None = no row before)."""
+    old_stage = _stage_of(old) if old is not None else None
+    if old_stage == new_stage:
+        return
+    cursor.execute(
+        "INSERT INTO events (user_id, at, from_stage, to_stage, course) VALUES (?, ?, ?, ?, ?)",
+        (user_id, time.time(), old_stage, new_stage, course),
+    )
+
+def _after_write(cursor, user_id: int, old_data: Optional[str], state: Dict, stage: str = None):
+    """Keeps the side tables in step with a user_states write, in the same transaction.
+    old_data is the row's state_data before the write (None = no row); `stage`
+    overrides the state's own (the outcome of a deleted registration)."""
+    old = None
+    if old_data is not None:
+        try:
+            old = json.loads(old_data)
+        except ValueError:
+            old = None
+    new_stage = stage or _stage_of(state)
+    _log_transition(cursor, user_id, old, new_stage, state.get("course"))
+    _track_pending(cursor, user_id, old, new_stage, state.get("course"))
+    if FTS_AVAILABLE:
+        _index_user(cursor, user_id, old, state, new_stage)
+
+# --- PENDING QUEUE ---
+PENDING_STAGE = "completed"   # registration.COMPLETED: receipt sent, waiting for an admin
+
+def _track_pending(cursor, user_id: int, old: Optional[Dict], new_stage: str, course: Optional[str]):
+    """pending_approvals holds exactly the users whose state is at PENDING_STAGE."""
+    if new_stage == PENDING_STAGE:
+        if old is None or _stage_of(old) != PENDING_STAGE:
+            cursor.execute("INSERT OR REPLACE INTO pending_approvals (user_id, since, course) VALUES (?, ?, ?)",
+                           (user_id, time.time(), course))
+    elif old is not None and _stage_of(old) == PENDING_STAGE:
+        cursor.execute("DELETE FROM pending_approvals WHERE user_id = ?", (user_id,))
+
+@metrics.timed("db")
+def get_pending_page(offset: int, limit: int) -> Tuple[int, list]:
+    """(total, [(user_id, since, state), ...]) oldest submission first."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM pending_approvals").fetchone()[0]
+        rows = conn.execute("""
+            SELECT p.user_id, p.since, u.state_data
+            FROM pending_approvals p JOIN user_states u ON u.user_id = p.user_id
+            ORDER BY p.since, p.user_id LIMIT ? OFFSET ?
+        """, (limit, offset)).fetchall()
+        return total, [(user_id, since, json.loads(state_data)) for user_id, since, state_data in rows]
+    finally:
+        conn.close()
+
+# --- SEARCH INDEX ---
+# search_index (FTS5, rowid = user_id) holds the searchable fields of every
+# registration, including finished ones whose state was deleted, with the
+# current stage / outcome. Text is normalized the same way when indexed and
+# when searched (Arabic diacritics and letter variants folded, phone numbers
+# also indexed by their last 9 digits) so /find matches what admins type.
+FTS_AVAILABLE = False   # set by init_db when this SQLite build has FTS5
+SEARCH_COLUMNS = ("name", "email", "phone", "username", "seat_names", "details")
+
+_ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_ARABIC_FOLDS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي",
+                               "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+                               "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9"})
+PHONE_SUFFIX_DIGITS = 9
+
+def normalize_search_text(text) -> str:
+    if not text:
+        return ""
+    if isinstance(text, list):
+        text = " ".join(str(t) for t in text)
+    return _ARABIC_DIACRITICS.sub("", str(text)).translate(_ARABIC_FOLDS).lower()
+
+def _phone_terms(text) -> str:
+    digits = re.sub(r"\D", "", normalize_search_text(text))
+    if not digits:
+        return ""
+    return f"{digits} {digits[-PHONE_SUFFIX_DIGITS:]}" if len(digits) > PHONE_SUFFIX_DIGITS else digits
+
+def _search_doc(state: Dict) -> Tuple[str, ...]:
+    return (
+        normalize_search_text(state.get("name")),
+        normalize_search_text(state.get("email")),
+        f"{normalize_search_text(state.get('whatsapp'))} {_phone_terms(state.get('whatsapp'))}".strip(),
+        normalize_search_text(state.get("telegram_username")),
+        normalize_search_text(state.get("kids_names") or state.get("hs_names")),
+        normalize_search_text(" ".join(str(state.get(k) or "") for k in ("wu_details", "vodafone_details"))).strip(),
+    )
+
+def _index_user(cursor, user_id: int, old: Optional[Dict], state: Dict, stage: str):
+    doc = _search_doc(state)
+    if old is not None and doc == _search_doc(old) and stage == _stage_of(old) \
+            and state.get("course") == old.get("course"):
+        return
+    cursor.execute("DELETE FROM search_index WHERE rowid = ?", (user_id,))
+    display = {k: state.get(k) for k in ("name", "email", "whatsapp", "telegram_username")}
+    cursor.execute(f"""
+        INSERT INTO search_index (rowid, {", ".join(SEARCH_COLUMNS)}, stage, course, updated_at, display)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, *doc, stage, state.get("course"), time.time(), json.dumps(display, ensure_ascii=False)))
+
+def _match_query(query: str) -> str:
+    """User text -> FTS5 query: every word must match, as a prefix."""
+    terms = []
+    for word in re.split(r"[\W_]+", normalize_search_text(query)):
+        if not word:
+            continue
+        if word.isdigit() and len(word) > PHONE_SUFFIX_DIGITS:
+            # A phone number typed with another prefix (0…, +249…) or a long reference number
+            terms.append(f'("{word}"* OR "{word[-PHONE_SUFFIX_DIGITS:]}"*)')
+        else:
+            terms.append(f'"{word}"*')
+    return " ".join(terms)
+
+@metrics.timed("db")
+def search_registrations(query: str, limit: int = 10) -> list:
+    """Best matches first: dicts with user_id, stage, course, updated_at and the
+    registration's name, email, whatsapp, telegram_username as entered."""
+    match = _match_query(query)
+    if not match or not FTS_AVAILABLE:
+        return []
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute("""
+            SELECT rowid, stage, course, updated_at, display
+            FROM search_index WHERE search_index MATCH ? ORDER BY rank LIMIT ?
+        """, (match, limit)).fetchall()
+    finally:
+        conn.close()
+    return [{"user_id": user_id, "stage": stage, "course": course, "updated_at": updated_at, **json.loads(display)}
+            for user_id, stage, course, updated_at, display in rows]
+
+def _create_search_index(cursor):
+    global FTS_AVAILABLE
+    try:
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                {", ".join(SEARCH_COLUMNS)},
+                stage UNINDEXED, course UNINDEXED, updated_at UNINDEXED, display UNINDEXED,
+                tokenize = "unicode61 remove_diacritics 2"
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Full-text search disabled (this SQLite has no FTS5): {e}")
+        return
+    FTS_AVAILABLE = True
+    if cursor.execute("SELECT 1 FROM search_index LIMIT 1").fetchone() is None:
+        # First start with the index: add the registrations in progress
+        rows = cursor.execute("SELECT user_id, state_data FROM user_states").fetchall()
+        for user_id, state_data in rows:
+            try:
+                _index_user(cursor, user_id, None, json.loads(state_data), _stage_of(json.loads(state_data)))
+            except ValueError:
+                pass
+        if rows:
+            logger.info(f"Search index built for {len(rows)} registrations")
+
+@metrics.timed("db")
 def get_user_state(user_id: int) -> Dict:
     try:
         conn = sqlite3.connect(DB_FILE)
@@ -55,6 +466,7 @@ def get_user_state(user_id: int) -> Dict:
         logger.error(f"Failed to get user state for {user_id}: {e}")
         return {}
 
+@metrics.timed("db")
 def update_user_state(user_id: int, state_data: Dict):
     try:
         conn = sqlite3.connect(DB_FILE)
@@ -62,31 +474,215 @@ def update_user_state(user_id: int, state_data: Dict):
         
         json_data = json.dumps(state_data)
         now = datetime.datetime.now()
+        cursor.execute("SELECT state_data FROM user_states WHERE user_id = ?", (user_id,))
+        old = cursor.fetchone()
         
-        # We use INSERT OR REPLACE. We must provide values for all columns we care about,
-        # otherwise they might get reset to default or NULL.
+        # Unconditional write (use mutate_user_state for read-modify-write).
         # last_updated -> NOW
         # reminder_sent -> 0 (User active, so reset reminder flag)
+        # version -> bumped so in-flight compare-and-swap writers notice
         cursor.execute("""
-            INSERT OR REPLACE INTO user_states (user_id, state_data, last_updated, reminder_sent)
-            VALUES (?, ?, ?, 0)
+            INSERT INTO user_states (user_id, state_data, last_updated, reminder_sent, version)
+            VALUES (?, ?, ?, 0, 1)
+            ON CONFLICT(user_id) DO UPDATE SET
+                state_data = excluded.state_data,
+                last_updated = excluded.last_updated,
+                reminder_sent = 0,
+                version = user_states.version + 1
         """, (user_id, json_data, now))
+        _after_write(cursor, user_id, old[0] if old else None, state_data)
         
+        _check_fence(cursor)
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"Failed to update user state for {user_id}: {e}")
 
-def delete_user_state(user_id: int):
+# --- OPTIMISTIC CONCURRENCY ---
+@metrics.timed("db")
+def get_user_state_versioned(user_id: int) -> Tuple[Dict, Optional[int]]:
+    """Returns (state, version); version is None when the user has no row yet."""
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT state_data, version FROM user_states WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+
+        if row:
+            return json.loads(row[0]), row[1] or 0
+        return {}, None
+    except Exception as e:
+        logger.error(f"Failed to get user state for {user_id}: {e}")
+        return {}, None
+
+@metrics.timed("db")
+def compare_and_set_user_state(user_id: int, state_data: Dict, expected_version: Optional[int]) -> bool:
+    """Writes state_data only if the row is still at expected_version (None = must not exist).
+    Returns False when another writer got there first."""
     try:
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
+
+        json_data = json.dumps(state_data)
+        now = datetime.datetime.now()
+
+        # The row being replaced (a concurrent write changes the version and fails the swap)
+        cursor.execute("SELECT state_data FROM user_states WHERE user_id = ? AND COALESCE(version, 0) = ?",
+                       (user_id, expected_version))
+        old = cursor.fetchone()
+
+        if expected_version is None:
+            cursor.execute("""
+                INSERT OR IGNORE INTO user_states (user_id, state_data, last_updated, reminder_sent, version)
+                VALUES (?, ?, ?, 0, 1)
+            """, (user_id, json_data, now))
+        else:
+            cursor.execute("""
+                UPDATE user_states
+                SET state_data = ?, last_updated = ?, reminder_sent = 0, version = version + 1
+                WHERE user_id = ? AND COALESCE(version, 0) = ?
+            """, (json_data, now, user_id, expected_version))
+        swapped = cursor.rowcount == 1
+        if swapped:
+            _after_write(cursor, user_id, old[0] if old else None, state_data)
+
+        _check_fence(cursor)
+        conn.commit()
+        conn.close()
+        return swapped
+    except StaleFencingToken:
+        raise  # not a conflict: retrying can never succeed
+    except Exception as e:
+        logger.error(f"Failed to update user state for {user_id}: {e}")
+        return False
+
+@metrics.timed("db")
+def mutate_user_state(user_id: int, mutate: Callable[[Dict], Optional[bool]], retries: int = 5) -> Optional[Dict]:
+    """Read-modify-write with compare-and-swap. `mutate(state)` edits the dict in
+    place (return False to skip the write) and is re-run on a fresh copy whenever
+    a concurrent writer wins. Returns the committed state, or None if skipped/failed.
+    Exceptions raised by `mutate` propagate without writing."""
+    for _ in range(retries):
+        state, version = get_user_state_versioned(user_id)
+        if mutate(state) is False:
+            return None
+        if compare_and_set_user_state(user_id, state, version):
+            return state
+        logger.info(f"State conflict for {user_id}, retrying")
+        metrics.count("db_retries_total", name="mutate_user_state")
+    logger.error(f"Gave up updating state for {user_id} after {retries} conflicts")
+    return None
+
+@metrics.timed("db")
+def delete_user_state(user_id: int, outcome: str = "deleted"):
+    """Removes the user's state; the events log keeps the outcome ("approved", "rejected"…)."""
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT state_data FROM user_states WHERE user_id = ?", (user_id,))
+        old = cursor.fetchone()
         cursor.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        if old:
+            _after_write(cursor, user_id, old[0], json.loads(old[0]), stage=outcome)
+        _check_fence(cursor)
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"Failed to delete user state for {user_id}: {e}")
 
+# --- ADMIN DECISIONS ---
+@metrics.timed("db")
+def claim_admin_decision(request_id: str, user_id: int, action: str, admin_id: int, admin_name: str) -> Optional[Dict]:
+    """Atomically claims a registration request for one admin.
+    Returns None if this admin won, otherwise the existing decision.
+    A "failed" claim, or one left "in_progress" longer than DECISION_CLAIM_TTL
+    (its process died), is taken over instead of blocking the request forever;
+    once some of its steps are done it keeps its action, so the retry only
+    finishes what the first run started (see get_admin_decision's "steps")."""
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        now = datetime.datetime.now()
+        expired = now - datetime.timedelta(seconds=config.DECISION_CLAIM_TTL)
+        cursor.execute("""
+            INSERT INTO admin_decisions (request_id, user_id, action, admin_id, admin_name, status, decided_at)
+            VALUES (?, ?, ?, ?, ?, 'in_progress', ?)
+            ON CONFLICT(request_id) DO UPDATE SET
+                user_id = excluded.user_id, admin_id = excluded.admin_id, admin_name = excluded.admin_name,
+                action = CASE WHEN COALESCE(admin_decisions.steps, '') = '' THEN excluded.action
+                              ELSE admin_decisions.action END,
+                status = 'in_progress', decided_at = excluded.decided_at
+            WHERE admin_decisions.status = 'failed'
+               OR (admin_decisions.status = 'in_progress' AND admin_decisions.decided_at < ?)
+        """, (request_id, user_id, action, admin_id, admin_name, now, expired))
+        won = cursor.rowcount == 1
+        _check_fence(cursor)
+        conn.commit()
+        conn.close()
+        if won:
+            return None
+        return get_admin_decision(request_id) or {"action": "?", "admin_name": "?", "status": "in_progress"}
+    except Exception as e:
+        logger.error(f"Failed to claim decision {request_id}: {e}")
+        # Fail closed: never run the approval pipeline twice
+        return {"action": "?", "admin_name": "?", "status": "error"}
+
+@metrics.timed("db")
+def get_admin_decision(request_id: str) -> Optional[Dict]:
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT user_id, action, admin_id, admin_name, status, decided_at, steps
+            FROM admin_decisions WHERE request_id = ?
+        """, (request_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row:
+            keys = ("user_id", "action", "admin_id", "admin_name", "status", "decided_at")
+            decision = dict(zip(keys, row))
+            decision["steps"] = set(filter(None, (row[6] or "").split(",")))
+            return decision
+        return None
+    except Exception as e:
+        logger.error(f"Failed to get decision {request_id}: {e}")
+        return None
+
+@metrics.timed("db")
+def add_decision_step(request_id: str, step: str):
+    """Records that one side effect of the decision is done (raises: the caller
+    must not go on as if a retry would know)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE admin_decisions
+            SET steps = CASE WHEN COALESCE(steps, '') = '' THEN ? ELSE steps || ',' || ? END
+            WHERE request_id = ?
+        """, (step, step, request_id))
+        _check_fence(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def finish_admin_decision(request_id: str, status: str = "done", approval: Optional[Dict] = None):
+    """Marks the decision finished; `approval` (a ledger entry, see revenue.approval_entry)
+    is recorded in the same transaction, so a decision is never done without it."""
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("UPDATE admin_decisions SET status = ? WHERE request_id = ?", (status, request_id))
+        if approval is not None and not _insert_approval(cursor, approval):
+            logger.info(f"Approval {request_id} was already in the revenue ledger")
+        _check_fence(cursor)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Failed to finish decision {request_id}: {e}")
+
+@metrics.timed("db")
 def get_abandoned_users(hours_threshold=2) -> list[tuple[int, Dict]]:
     """Returns list of (user_id, state_data) for users inactive > threshold hours."""
     abandoned = []
@@ -119,16 +715,19 @@ def get_abandoned_users(hours_threshold=2) -> list[tuple[int, Dict]]:
         logger.error(f"Failed to get abandoned users: {e}")
     return abandoned
 
+@metrics.timed("db")
 def mark_reminder_sent(user_id: int):
     try:
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
         cursor.execute("UPDATE user_states SET reminder_sent = 1 WHERE user_id = ?", (user_id,))
+        _check_fence(cursor)
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"Failed to mark reminder sent for {user_id}: {e}")
 
+@metrics.timed("db")
 def get_incomplete_users() -> list[int]:
     """Returns list of user_ids who have NOT completed the registration."""
     user_ids = []
@@ -152,6 +751,7 @@ def get_incomplete_users() -> list[int]:
         logger.error(f"Failed to get incomplete users: {e}")
     return user_ids
 
+@metrics.timed("db")
 def get_stats_counts() -> Dict[str, int]:
     """Returns total users and counts per course."""
     stats = {"total": 0, "courses": {}}
@@ -185,6 +785,7 @@ def get_stats_counts() -> Dict[str, int]:
     
     return stats
 
+@metrics.timed("db")
 def get_funnel_stats() -> Dict[str, int]:
     """Returns counts of users at each stage."""
     stage_counts = {}
@@ -209,7 +810,79 @@ def get_funnel_stats() -> Dict[str, int]:
     
     return stage_counts
 
+ROLLUPS = {"funnel_hourly": "%Y-%m-%d %H:00", "funnel_daily": "%Y-%m-%d"}   # table -> local-time bucket
+
+@metrics.timed("db")
+def rollup_events(batch: int = 5000) -> int:
+    """Folds events newer than the last rollup into funnel_hourly / funnel_daily:
+    per (bucket, course, stage) how many entered and left the stage, and the
+    seconds spent in it by those who left. Returns how many events were folded."""
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")   # one rollup at a time across shards
+        row = cursor.execute("SELECT last_event_id FROM rollup_state WHERE name = 'funnel'").fetchone()
+        last_id = row[0] if row else 0
+        rows = cursor.execute("""
+            SELECT e.id, e.at, e.from_stage, e.to_stage, e.course,
+                   (SELECT p.at FROM events p WHERE p.user_id = e.user_id AND p.id < e.id
+                    ORDER BY p.id DESC LIMIT 1)
+            FROM events e WHERE e.id > ? ORDER BY e.id LIMIT ?
+        """, (last_id, batch)).fetchall()
+        if not rows:
+            conn.rollback()
+            return 0
+
+        totals: Dict[tuple, list] = {}   # (table, bucket, course, stage) -> [entered, exited, seconds]
+        for _, at, from_stage, to_stage, course, prev_at in rows:
+            when = datetime.datetime.fromtimestamp(at)
+            for table, fmt in ROLLUPS.items():
+                bucket = when.strftime(fmt)
+                totals.setdefault((table, bucket, course or "", to_stage), [0, 0, 0.0])[0] += 1
+                if from_stage:
+                    left = totals.setdefault((table, bucket, course or "", from_stage), [0, 0, 0.0])
+                    left[1] += 1
+                    left[2] += at - prev_at if prev_at else 0.0
+        for table in ROLLUPS:
+            cursor.executemany(f"""
+                INSERT INTO {table} (bucket, course, stage, entered, exited, stage_seconds)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(bucket, course, stage) DO UPDATE SET
+                    entered = entered + excluded.entered,
+                    exited = exited + excluded.exited,
+                    stage_seconds = stage_seconds + excluded.stage_seconds
+            """, [key[1:] + tuple(v) for key, v in totals.items() if key[0] == table])
+        cursor.execute("""
+            INSERT INTO rollup_state (name, last_event_id) VALUES ('funnel', ?)
+            ON CONFLICT(name) DO UPDATE SET last_event_id = excluded.last_event_id
+        """, (rows[-1][0],))
+        _check_fence(cursor)
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def get_funnel_rollup(table: str, since_bucket: str, course: str = None) -> list:
+    """(course, stage, entered, exited, stage_seconds) summed over buckets >= since_bucket."""
+    if table not in ROLLUPS:
+        raise ValueError(f"unknown rollup {table}")
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        query = f"""
+            SELECT course, stage, SUM(entered), SUM(exited), SUM(stage_seconds)
+            FROM {table} WHERE bucket >= ?
+        """
+        params = [since_bucket]
+        if course is not None:
+            query += " AND course = ?"
+            params.append(course)
+        return conn.execute(query + " GROUP BY course, stage", params).fetchall()
+    finally:
+        conn.close()
+
 # --- COUPONS ---
+@metrics.timed("db")
 def add_coupon(code: str, discount_percent: int, usage_limit: int = 0, course_key: str = None):
     """usage_limit=0 means infinite. course_key=None means valid for all courses."""
     try:
@@ -237,11 +910,13 @@ def add_coupon(code: str, discount_percent: int, usage_limit: int = 0, course_ke
             INSERT OR REPLACE INTO coupons (code, discount_percent, usage_count, usage_limit, course_key) 
             VALUES (?, ?, 0, ?, ?)
         """, (code.upper().strip(), discount_percent, usage_limit, course_key))
+        _check_fence(cursor)
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"Failed to add coupon: {e}")
 
+@metrics.timed("db")
 def get_coupon(code: str, user_course: str = None) -> Optional[int]:
     """Returns discount percent if valid, under limit, and matches course (if specified).
     Returns None if invalid, expired, or wrong course."""
@@ -266,6 +941,7 @@ def get_coupon(code: str, user_course: str = None) -> Optional[int]:
         logger.error(f"Failed to get coupon: {e}")
         return None
 
+@metrics.timed("db")
 def redeem_coupon(code: str):
     """Increments usage count for a coupon."""
     if not code: return
@@ -273,21 +949,25 @@ def redeem_coupon(code: str):
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
         cursor.execute("UPDATE coupons SET usage_count = usage_count + 1 WHERE code = ?", (code.upper().strip(),))
+        _check_fence(cursor)
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"Failed to redeem coupon: {e}")
 
+@metrics.timed("db")
 def delete_coupon(code: str):
     try:
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
         cursor.execute("DELETE FROM coupons WHERE code = ?", (code.upper().strip(),))
+        _check_fence(cursor)
         conn.commit()
         conn.close()
     except Exception as e:
         logger.error(f"Failed to delete coupon: {e}")
 
+@metrics.timed("db")
 def list_coupons() -> Dict[str, Dict]:
     result = {}
     try:
@@ -317,3 +997,258 @@ def list_coupons() -> Dict[str, Dict]:
     except Exception as e:
         logger.error(f"Failed to list coupons: {e}")
     return result
+
+# --- TRACES ---
+@metrics.timed("db")
+def add_trace_spans(rows: list):
+    """rows: (trace_id, user_id, step, step_at, name, started_at, duration_ms, status)"""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO trace_spans (trace_id, user_id, step, step_at, name, started_at, duration_ms, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        _check_fence(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def prune_trace_spans(before: float) -> int:
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM trace_spans WHERE started_at < ?", (before,))
+        _check_fence(cursor)
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def get_latest_trace_id(user_id: int) -> Optional[str]:
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute(
+            "SELECT trace_id FROM trace_spans WHERE user_id = ? ORDER BY started_at DESC LIMIT 1", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def get_trace_spans(trace_id: str) -> list:
+    """(step, step_at, name, started_at, duration_ms, status) rows, oldest first."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        return conn.execute("""
+            SELECT step, step_at, name, started_at, duration_ms, status
+            FROM trace_spans WHERE trace_id = ? ORDER BY started_at
+        """, (trace_id,)).fetchall()
+    finally:
+        conn.close()
+
+# --- REVENUE ---
+def _insert_approval(cursor, entry: Dict) -> bool:
+    """Appends an approval to the ledger and adds it to revenue_daily, in the
+    caller's transaction. Returns False if the request was already recorded."""
+    cursor.execute("""
+        INSERT OR IGNORE INTO approvals (request_id, user_id, approved_at, day, course, seats, method_key,
+            currency, list_amount, discount_percent, coupon_code, amount, usd_rate, amount_paid, admin_id)
+        VALUES (:request_id, :user_id, :approved_at, :day, :course, :seats, :method_key,
+            :currency, :list_amount, :discount_percent, :coupon_code, :amount, :usd_rate, :amount_paid, :admin_id)
+    """, entry)
+    if cursor.rowcount != 1:
+        return False
+    rate = entry["usd_rate"]
+    cursor.execute("""
+        INSERT INTO revenue_daily (day, currency, method_key, course, approvals, amount, discount, usd_amount, unconverted)
+        VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)
+        ON CONFLICT(day, currency, method_key, course) DO UPDATE SET
+            approvals = approvals + 1,
+            amount = amount + excluded.amount,
+            discount = discount + excluded.discount,
+            usd_amount = usd_amount + excluded.usd_amount,
+            unconverted = unconverted + excluded.unconverted
+    """, (entry["day"], entry["currency"] or "", entry["method_key"] or "", entry["course"] or "",
+          entry["amount"] or 0, (entry["list_amount"] or 0) - (entry["amount"] or 0),
+          (entry["amount"] or 0) * rate if rate is not None else 0, 0 if rate is not None else 1))
+    return True
+
+@metrics.timed("db")
+def get_revenue(first_day: str, last_day: str) -> list:
+    """(currency, method_key, course, approvals, amount, discount, usd_amount, unconverted)
+    summed over first_day..last_day (YYYY-MM-DD, inclusive)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        return conn.execute("""
+            SELECT currency, method_key, course, SUM(approvals), SUM(amount), SUM(discount),
+                   SUM(usd_amount), SUM(unconverted)
+            FROM revenue_daily WHERE day BETWEEN ? AND ?
+            GROUP BY currency, method_key, course
+        """, (first_day, last_day)).fetchall()
+    finally:
+        conn.close()
+
+# --- RECEIPTS ---
+@metrics.timed("db")
+def add_receipt(user_id: int, file_unique_id: str, file_id: str, is_photo: bool,
+                ext: str = None, thumb_file_id: str = None) -> int:
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO receipts (user_id, file_unique_id, file_id, is_photo, received_at, ext, thumb_file_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, file_unique_id, file_id, int(is_photo), time.time(), ext, thumb_file_id))
+        _check_fence(cursor)
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def delete_receipt(receipt_id: int):
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM receipts WHERE id = ?", (receipt_id,))
+        _check_fence(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def find_duplicate_receipts(receipt_id: int, limit: int = 3) -> list:
+    """Other receipts with the same file or (once hashed) the same bytes, oldest
+    first: [{user_id, received_at, match: "file" | "content"}]. Index lookups only."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute("SELECT file_unique_id, content_hash FROM receipts WHERE id = ?", (receipt_id,)).fetchone()
+        if row is None:
+            return []
+        file_unique_id, content_hash = row
+        rows = conn.execute("""
+            SELECT user_id, received_at, 'file' FROM receipts WHERE file_unique_id = ? AND id != ?
+            UNION ALL
+            SELECT user_id, received_at, 'content' FROM receipts
+            WHERE content_hash = ? AND id != ? AND file_unique_id != ?
+            ORDER BY 2 LIMIT ?
+        """, (file_unique_id, receipt_id, content_hash, receipt_id, file_unique_id, limit)).fetchall()
+        return [{"user_id": u, "received_at": at, "match": match} for u, at, match in rows]
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def get_unhashed_receipts(limit: int, max_attempts: int) -> list:
+    """(id, user_id, file_id, ext, thumb_file_id) of receipts not archived yet."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        return conn.execute("""
+            SELECT id, user_id, file_id, ext, thumb_file_id FROM receipts
+            WHERE content_hash IS NULL AND hash_attempts < ? ORDER BY id LIMIT ?
+        """, (max_attempts, limit)).fetchall()
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def set_receipt_hash(receipt_id: int, content_hash: Optional[str], size: int = None, thumb_hash: str = None):
+    """Records the archived receipt (its content hash); None counts a failed attempt."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        if content_hash is None:
+            cursor.execute("UPDATE receipts SET hash_attempts = hash_attempts + 1 WHERE id = ?", (receipt_id,))
+        else:
+            cursor.execute("UPDATE receipts SET content_hash = ?, size = ?, thumb_hash = ? WHERE id = ?",
+                           (content_hash, size, thumb_hash, receipt_id))
+        _check_fence(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def set_receipt_request(receipt_id: int, request_id: str):
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE receipts SET request_id = ? WHERE id = ?", (request_id, receipt_id))
+        _check_fence(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+RECEIPT_COLUMNS = ("id", "user_id", "file_id", "is_photo", "received_at", "content_hash", "ext", "size",
+                   "thumb_hash", "request_id")
+
+@metrics.timed("db")
+def get_receipts(user_id: int = None, request_id: str = None, limit: int = 10) -> list:
+    """A user's (or one request's) receipts, newest first, as dicts of RECEIPT_COLUMNS."""
+    column, value = ("request_id", request_id) if request_id else ("user_id", user_id)
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute(f"SELECT {', '.join(RECEIPT_COLUMNS)} FROM receipts WHERE {column} = ? ORDER BY id DESC LIMIT ?",
+                            (value, limit)).fetchall()
+        return [dict(zip(RECEIPT_COLUMNS, row)) for row in rows]
+    finally:
+        conn.close()
+
+# --- EXPORT ---
+# Generators: rows are fetched EXPORT_CHUNK at a time and the connection stays
+# open until the caller has consumed (or closed) the generator.
+EXPORT_CHUNK = 500
+
+def iter_user_states(since: str = None, until: str = None) -> Iterator[Tuple[int, Dict, str]]:
+    """(user_id, state, last_updated) for rows updated in [since, until) (YYYY-MM-DD bounds, optional)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.execute("""
+            SELECT user_id, state_data, last_updated FROM user_states
+            WHERE last_updated >= ? AND last_updated < ?
+            ORDER BY user_id
+        """, (since or "0000-00-00", until or "9999-12-31"))   # full dates: a bare "9999" would compare as a number
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                return
+            for user_id, state_data, last_updated in rows:
+                try:
+                    yield user_id, json.loads(state_data), last_updated
+                except ValueError:
+                    logger.warning(f"Skipping unreadable state of {user_id}")
+    finally:
+        conn.close()
+
+def iter_approvals(first_day: str, last_day: str) -> Iterator[Dict]:
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    try:
+        cursor = conn.execute("SELECT * FROM approvals WHERE day BETWEEN ? AND ? ORDER BY approved_at",
+                              (first_day, last_day))
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+    finally:
+        conn.close()
+
+@metrics.timed("db")
+def get_coupon_usage(first_day: str, last_day: str) -> list:
+    """(code, discount_percent, usage_count, usage_limit, course_key, approvals in range, amount in range)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        try:
+            return conn.execute("""
+                SELECT c.code, c.discount_percent, c.usage_count, c.usage_limit, c.course_key,
+                       COUNT(a.request_id), COALESCE(SUM(a.amount), 0)
+                FROM coupons c
+                LEFT JOIN approvals a ON a.coupon_code = c.code AND a.day BETWEEN ? AND ?
+                GROUP BY c.code ORDER BY c.code
+            """, (first_day, last_day)).fetchall()
+        except sqlite3.OperationalError:
+            return []   # no coupon created yet (the table is created lazily)
+    finally:
+        conn.close()
@@ -10,6 +10,8 @@ docker build --no-cache -t paymentbot .
 
 # Create the database file if it doesn't exist (prevents Docker from creating a directory)
 touch /root/paymentbot/bot_state.db
+[ -s /root/paymentbot/known_users.json ] || echo "[]" > /root/paymentbot/known_users.json
+mkdir -p /root/paymentbot/backups /root/paymentbot/receipt_archive /root/paymentbot/known_users
 
 # Run with volume mount to preserve database
 docker run -d \
@@ -17,6 +19,10 @@ docker run -d \
   --restart always \
   --env-file .env \
   -v /root/paymentbot/bot_state.db:/app/bot_state.db \
+  -v /root/paymentbot/known_users.json:/app/known_users.json \
+  -v /root/paymentbot/known_users:/app/known_users \
+  -v /root/paymentbot/backups:/app/backups \
+  -v /root/paymentbot/receipt_archive:/app/receipt_archive \
   paymentbot
 
 echo "✅ Deployment complete! Database preserved."
@@ -0,0 +1,155 @@
+import os
+import csv
+import gzip
+import json
+import logging
+import tempfile
+from datetime import date, timedelta
+from typing import Dict, Iterator, List
+
+import db
+import registration
+
+logger = logging.getLogger(__name__)
+
+# --- EXPORTS ---
+# /export writes one dataset to a temporary file and sends it as a document:
+#   registrations  user_states rows (in-progress registrations, one per user)
+#   approvals      the revenue ledger (approved requests)
+#   coupons        every coupon with its approvals in the range
+# Rows come from db generators in chunks and go straight into a gzipped CSV
+# (or a Parquet file, row group by row group, when pyarrow is installed), so
+# the result set is never held in memory.
+
+DATASETS = ("registrations", "approvals", "coupons")
+PARQUET_BATCH = db.EXPORT_CHUNK * 4
+
+REGISTRATION_COLUMNS = [
+    "user_id", "last_updated", "stage", "course", "name", "email", "whatsapp", "telegram_username",
+    "seats", "seat_names", "payment_method_key", "coupon_code", "discount_percent",
+    "quoted_amount", "quoted_currency", "amount_paid", "wu_details", "vodafone_details",
+    "request_id", "trace_id",
+]
+APPROVAL_COLUMNS = [
+    "request_id", "user_id", "approved_at", "day", "course", "seats", "method_key", "currency",
+    "list_amount", "discount_percent", "coupon_code", "amount", "usd_rate", "amount_paid", "admin_id",
+]
+COUPON_COLUMNS = [
+    "code", "discount_percent", "usage_count", "usage_limit", "course_key", "approvals_in_range", "amount_in_range",
+]
+
+class ExportFilter:
+    """Day range (inclusive, YYYY-MM-DD) plus optional course / stage."""
+
+    def __init__(self, first_day: str = "0000-00-00", last_day: str = "9999-12-31",
+                 course: str = None, stage: str = None):
+        self.first_day = first_day
+        self.last_day = last_day
+        self.course = course
+        self.stage = stage
+
+    def day_after_last(self) -> str:
+        try:
+            return (date.fromisoformat(self.last_day) + timedelta(days=1)).isoformat()
+        except (ValueError, OverflowError):
+            return "9999-12-31"
+
+def _registration_rows(flt: ExportFilter) -> Iterator[List]:
+    for user_id, state, last_updated in db.iter_user_states(flt.first_day, flt.day_after_last()):
+        if flt.course and state.get("course") != flt.course:
+            continue
+        if flt.stage and (state.get("stage") or db.START_STAGE) != flt.stage:
+            continue
+        quote = state.get("quote") or {}
+        names = state.get("kids_names") or state.get("hs_names")
+        yield [
+            user_id, last_updated, state.get("stage") or db.START_STAGE, state.get("course"), state.get("name"),
+            state.get("email"), state.get("whatsapp"), state.get("telegram_username"),
+            registration.seat_count(state) or None, ", ".join(names) if isinstance(names, list) else names,
+            state.get("payment_method_key"), state.get("coupon_code"), state.get("discount_percent"),
+            quote.get("amount"), quote.get("currency"), state.get("amount_paid"), state.get("wu_details"),
+            state.get("vodafone_details"), state.get("request_id"), state.get("trace_id"),
+        ]
+
+def _approval_rows(flt: ExportFilter) -> Iterator[List]:
+    for row in db.iter_approvals(flt.first_day, flt.last_day):
+        if flt.course and row["course"] != flt.course:
+            continue
+        yield [row[c] for c in APPROVAL_COLUMNS]
+
+def _coupon_rows(flt: ExportFilter) -> Iterator[List]:
+    for row in db.get_coupon_usage(flt.first_day, flt.last_day):
+        if flt.course and row[4] not in (None, flt.course):
+            continue
+        yield list(row)
+
+_SOURCES = {
+    "registrations": (REGISTRATION_COLUMNS, _registration_rows),
+    "approvals": (APPROVAL_COLUMNS, _approval_rows),
+    "coupons": (COUPON_COLUMNS, _coupon_rows),
+}
+
+def _write_csv(path: str, columns: List[str], rows: Iterator[List]) -> int:
+    count = 0
+    # utf-8-sig so Excel opens the Arabic text correctly
+    with gzip.open(path, "wt", encoding="utf-8-sig", newline="", compresslevel=6) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def _write_parquet(path: str, columns: List[str], rows: Iterator[List]) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Every column as text: the sources mix types (e.g. free-text amount_paid)
+    schema = pa.schema([(c, pa.string()) for c in columns])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= PARQUET_BATCH:
+                count += _write_batch(writer, schema, columns, batch)
+                batch = []
+        count += _write_batch(writer, schema, columns, batch)
+    return count
+
+def _write_batch(writer, schema, columns, batch) -> int:
+    import pyarrow as pa
+
+    if batch:
+        arrays = [[None if v is None else (v if isinstance(v, str) else json.dumps(v, ensure_ascii=False))
+                   for v in col] for col in zip(*batch)]
+        writer.write_table(pa.Table.from_arrays([pa.array(a, pa.string()) for a in arrays], schema=schema))
+    return len(batch)
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def write_export(dataset: str, flt: ExportFilter, fmt: str = "csv") -> Dict:
+    """Blocking; run it off the event loop. Returns path (a temp file the caller
+    removes), filename and rows."""
+    columns, source = _SOURCES[dataset]
+    suffix = ".parquet" if fmt == "parquet" else ".csv.gz"
+    fd, path = tempfile.mkstemp(prefix=f"export-{dataset}-", suffix=suffix)
+    os.close(fd)
+    try:
+        writer = _write_parquet if fmt == "parquet" else _write_csv
+        rows = writer(path, columns, source(flt))
+    except BaseException:
+        os.remove(path)
+        raise
+    parts = [dataset, flt.first_day if flt.first_day != "0000-00-00" else "all"]
+    if flt.last_day not in (flt.first_day, "9999-12-31"):
+        parts.append(flt.last_day)
+    parts += [p for p in (flt.course, flt.stage) if p]
+    filename = "_".join(parts) + suffix
+    logger.info(f"📤 Exported {rows} {dataset} rows to {path} ({os.path.getsize(path) // 1024} KB)")
+    return {"path": path, "filename": filename, "rows": rows, "size": os.path.getsize(path)}
@@ -0,0 +1,123 @@
+import os
+import time
+import signal
+import logging
+import threading
+from typing import Optional
+
+from telegram.request import HTTPXRequest
+
+import config
+import db
+import leases
+import metrics
+import tracing
+from db import StaleFencingToken
+
+logger = logging.getLogger(__name__)
+
+# --- FENCING TOKENS ---
+# cluster_runner.py starts the bot with the token of its leadership term
+# (FENCING_TOKEN, strictly increasing across terms) and its own name
+# (FENCING_HOLDER). The bot:
+#   - registers the token in the DB at startup and refuses to start if a newer
+#     term already registered a higher one; every DB write re-checks it (db._check_fence)
+#   - checks before every Telegram request (polling included) and Google call
+#   - runs a watchdog that confirms the lease is still held by its runner and
+#     the DB has no higher token; once stale it stops itself, and is killed
+#     FENCE_EXIT_GRACE seconds later if the graceful stop hangs.
+# The pre-request check is in-memory: it fails once the watchdog found the
+# token stale or has not confirmed it for FENCE_MAX_AGE seconds.
+# The token is the lease version, which can go backwards if the lease store
+# starts over. A bot refused at startup exits with standby.STALE_TOKEN_EXIT;
+# the runner, which holds the lease, moves it past the stored token and
+# restarts the bot instead of counting a crash (cluster_runner.Elector.advance_past).
+
+_stale_reason: Optional[str] = None
+_confirmed_at = time.monotonic()
+
+def enabled() -> bool:
+    return config.FENCING_TOKEN > 0
+
+def claim():
+    """Registers this term's token before the bot starts polling."""
+    global _confirmed_at
+    if not enabled():
+        return
+    db.FENCING_TOKEN = config.FENCING_TOKEN
+    stored = db.advance_fencing_token(config.FENCING_TOKEN)
+    if stored > config.FENCING_TOKEN:
+        raise StaleFencingToken(f"fencing token {config.FENCING_TOKEN} superseded by {stored}")
+    _confirmed_at = time.monotonic()
+    logger.info(f"🔒 Running with fencing token {config.FENCING_TOKEN} (holder {config.FENCING_HOLDER})")
+
+def check():
+    """Raises StaleFencingToken unless this bot is still known to be the leader's."""
+    if not enabled():
+        return
+    if _stale_reason:
+        raise StaleFencingToken(_stale_reason)
+    age = time.monotonic() - _confirmed_at
+    if age > config.FENCE_MAX_AGE:
+        raise StaleFencingToken(f"leadership not confirmed for {age:.1f}s")
+
+def _find_stale_reason(backend) -> Optional[str]:
+    stored = db.get_fencing_token()
+    if stored > config.FENCING_TOKEN:
+        return f"fencing token {config.FENCING_TOKEN} superseded by {stored}"
+    if backend is not None:
+        holder = backend.read().holder
+        if holder != config.FENCING_HOLDER:
+            return f"lease now held by {holder or 'nobody'}"
+    return None
+
+def _shut_down(reason: str):
+    global _stale_reason
+    _stale_reason = reason
+    logger.error(f"⛔ Stale leader ({reason}); shutting down")
+    killer = threading.Timer(config.FENCE_EXIT_GRACE, os._exit, args=(75,))
+    killer.daemon = True
+    killer.start()
+    # run_polling / the webhook server stop gracefully on SIGTERM
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def start_watchdog() -> Optional[threading.Thread]:
+    if not enabled():
+        return None
+    try:
+        backend = leases.from_env() if config.FENCING_HOLDER else None
+    except Exception as e:
+        logger.error(f"Fencing watchdog can't reach the lease backend, checking the DB token only: {e}")
+        backend = None
+
+    def _watch():
+        global _confirmed_at
+        while True:
+            time.sleep(config.FENCE_CHECK_INTERVAL)
+            try:
+                reason = _find_stale_reason(backend)
+                if reason is None:
+                    _confirmed_at = time.monotonic()
+            except Exception as e:
+                logger.warning(f"Fencing check failed: {e}")
+                reason = None
+                age = time.monotonic() - _confirmed_at
+                if age > config.FENCE_MAX_AGE + config.FENCE_EXIT_GRACE:
+                    reason = f"leadership not confirmed for {age:.0f}s"
+            if reason:
+                _shut_down(reason)
+                return
+
+    thread = threading.Thread(target=_watch, name="fencing-watchdog", daemon=True)
+    thread.start()
+    return thread
+
+class FencedRequest(HTTPXRequest):
+    """Bot API transport that refuses to talk to Telegram once the token is stale.
+    Also times every request per Bot API method (telegram_api_* metrics, trace spans)."""
+
+    async def do_request(self, url, *args, **kwargs):
+        check()
+        method = url.rsplit("/", 1)[-1]
+        with metrics.timer("telegram_api", method), tracing.span_block(f"telegram.{method}"):
+            return await super().do_request(url, *args, **kwargs)
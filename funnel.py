@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+# --- FUNNEL ROLLUPS ---
+# Every stage change is appended to the `events` table by db.py (and the
+# admin decision when the state is deleted). Every FUNNEL_ROLLUP_INTERVAL
+# seconds the new events are folded into hourly and daily aggregates, so
+# /funnel reads a few hundred pre-summed rows instead of scanning the raw log.
+# The log itself is never rewritten: rollups can be rebuilt from it by
+# clearing funnel_hourly / funnel_daily / rollup_state.
+
+# Headline conversion steps per course: picked a course -> sent a receipt -> approved
+STARTED = "awaiting_name"
+SUBMITTED = "completed"
+APPROVED = "approved"
+
+_task: Optional[asyncio.Task] = None
+
+def catch_up() -> int:
+    """Folds every pending event (blocking; run it off the event loop)."""
+    total = 0
+    while True:
+        folded = db.rollup_events()
+        total += folded
+        if folded == 0:
+            return total
+
+def report(days: int = 7, course: str = None, hourly: bool = False) -> Dict:
+    """Per-course conversion and per-stage traffic over the last `days` (hours when hourly)."""
+    catch_up()
+    if hourly:
+        table, since = "funnel_hourly", (datetime.now() - timedelta(hours=days)).strftime("%Y-%m-%d %H:00")
+    else:
+        table, since = "funnel_daily", (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+    courses: Dict[str, Dict] = {}
+    stages: Dict[str, Dict] = {}
+    for course_key, stage, entered, exited, seconds in db.get_funnel_rollup(table, since, course):
+        per_course = courses.setdefault(course_key, {})
+        per_course[stage] = per_course.get(stage, 0) + entered
+        row = stages.setdefault(stage, {"entered": 0, "exited": 0, "seconds": 0.0})
+        row["entered"] += entered
+        row["exited"] += exited
+        row["seconds"] += seconds
+
+    conversion = {}
+    for course_key, counts in courses.items():
+        started = counts.get(STARTED, 0)
+        if not started or not course_key:
+            continue
+        conversion[course_key] = {
+            "started": started,
+            "submitted": counts.get(SUBMITTED, 0),
+            "approved": counts.get(APPROVED, 0),
+            "rate": counts.get(APPROVED, 0) / started,
+        }
+    for row in stages.values():
+        row["avg_seconds"] = row["seconds"] / row["exited"] if row["exited"] else None
+    return {"since": since, "conversion": conversion, "stages": stages}
+
+async def _rollup_forever():
+    while True:
+        await asyncio.sleep(config.FUNNEL_ROLLUP_INTERVAL)
+        try:
+            await asyncio.to_thread(catch_up)
+        except Exception as e:
+            logger.error(f"Funnel rollup failed: {e}")
+
+def start_scheduler():
+    """Starts the periodic rollup on the running event loop (one process per deployment)."""
+    global _task
+    if config.FUNNEL_ROLLUP_INTERVAL <= 0 or (config.SHARD_COUNT > 1 and config.SHARD_INDEX != 0):
+        return
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_rollup_forever())
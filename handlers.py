@@ -1,27 +1,82 @@
+import os
+import asyncio
 import logging
+import secrets
+import datetime
 import html as _html
+from typing import Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import ContextTypes
 
 import config
+import catalog
 import utils
 import db
+import registration
+import sharding
+import backups
+import metrics
+import health
+import tracing
+import funnel
+import revenue
+import export
+import receipts
 
 logger = logging.getLogger(__name__)
 
-# Broadcast control flag
+# Broadcast control flags (per process; sharded workers fan out via sharding.py)
 broadcast_cancelled = False
+broadcast_running = False
+_broadcast_task: Optional[asyncio.Task] = None   # the /broadcast job started on this process
+
+# Who a broadcast goes to; each shard sends to its own part of the list
+BROADCAST_AUDIENCES = {
+    "all": utils.load_known_users,
+    "unpaid": db.get_incomplete_users,
+}
+
+# Static keyboards are built once at import time and shared by every update
+PAYMENT_METHODS_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🎟️ لدي كوبون خصم", callback_data="coupon_request")]]
+    + [
+        [InlineKeyboardButton(method["button"], callback_data=f"pay_{key}")]
+        for key, method in config.PAYMENT_METHODS.items()
+    ]
+)
+
+def callback_action(data: str) -> str:
+    """Metric label for a callback: its prefix ("pay", "course", "approve"…), not the full data."""
+    return (data or "").split("_", 1)[0] or "unknown"
+
+def _decision_user(update, context):
+    """Trace owner of an approve_/reject_ callback: the registration decided on."""
+    try:
+        return int(update.callback_query.data.split("_")[1])
+    except (IndexError, ValueError):
+        return None
+
+def _callback_user(update, context):
+    """Admin decisions are traced by handle_admin_decision itself (under the user, not the admin)."""
+    data = update.callback_query.data or ""
+    if data.startswith("approve_") or data.startswith("reject_") or data.startswith("pending_"):
+        return None
+    return update.callback_query.message.chat.id
 
 # --- (4) COMMANDS ---
+@metrics.handler()
+@tracing.step()
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     utils.save_known_user(chat_id)
     
-    # Initialize/Reset user state in DB
-    user_state = {"telegram_username": update.effective_user.username}
+    # Initialize/Reset user state in DB (a new registration: a new trace)
+    user_state = {"telegram_username": update.effective_user.username, "trace_id": tracing.new_trace_id()}
     db.update_user_state(chat_id, user_state)
+    tracing.bind(chat_id, user_state)
 
     welcome_message = """
 أهلاً وسهلاً في عالم تقوية الذاكرة! 🚀
@@ -34,14 +89,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
  إليك البرامج المتاحة حالياً:
     """
-    keyboard = [
-        [InlineKeyboardButton(config.COURSES["expert"]["title"], callback_data="course_expert")],
-        [InlineKeyboardButton(config.COURSES["private"]["title"], callback_data="course_private")],
-        [InlineKeyboardButton(config.COURSES["kids"]["title"], callback_data="course_kids")],
-        [InlineKeyboardButton(config.COURSES["highschool"]["title"], callback_data="course_highschool")],
-        [InlineKeyboardButton("💬 التحدث مع خدمة العملاء", callback_data="support")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = catalog.current().main_menu_keyboard
 
     if update.message:
         await update.message.reply_text(welcome_message, reply_markup=reply_markup)
@@ -60,18 +108,7 @@ async def ask_payment_method(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if discount > 0:
         msg_intro = f"🎉 **تم تفعيل الخصم بنسبة {discount}%!**\nالآن اختر طريقة الدفع لإتمام العملية بالسعر الجديد:"
         
-    keyboard = [
-        [InlineKeyboardButton("🎟️ لدي كوبون خصم", callback_data="coupon_request")],
-        [InlineKeyboardButton("PayPal", callback_data="pay_paypal")],
-        [InlineKeyboardButton("بنكك (السودان)", callback_data="pay_bankak")],
-        [InlineKeyboardButton("تحويل بنكي (السعودية)", callback_data="pay_saudi")],
-        [InlineKeyboardButton("تحويل بنكي (الإمارات)", callback_data="pay_uae")],
-        [InlineKeyboardButton("Western Union / MoneyGram", callback_data="pay_wu_mg")],
-        [InlineKeyboardButton("محفظة الهاتف (رواندا)", callback_data="pay_rwanda")],
-        [InlineKeyboardButton("فودافون كاش / انستا باي (مصر)", callback_data="pay_vodafone_eg")],
-        [InlineKeyboardButton("تحويل بنكي عبر IBAN", callback_data="pay_iban")],
-    ]
-    await context.bot.send_message(chat_id=chat_id, text=msg_intro, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    await context.bot.send_message(chat_id=chat_id, text=msg_intro, reply_markup=PAYMENT_METHODS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
 
 async def ask_payment_method_callback(query, context, user_state):
     """Version for use with callback queries (edits message instead of sending new)"""
@@ -81,249 +118,63 @@ async def ask_payment_method_callback(query, context, user_state):
     if discount > 0:
         msg_intro = f"🎉 **تم تفعيل الخصم بنسبة {discount}%!**\nالآن اختر طريقة الدفع لإتمام العملية بالسعر الجديد:"
         
-    keyboard = [
-        [InlineKeyboardButton("🎟️ لدي كوبون خصم", callback_data="coupon_request")],
-        [InlineKeyboardButton("PayPal", callback_data="pay_paypal")],
-        [InlineKeyboardButton("بنكك (السودان)", callback_data="pay_bankak")],
-        [InlineKeyboardButton("تحويل بنكي (السعودية)", callback_data="pay_saudi")],
-        [InlineKeyboardButton("تحويل بنكي (الإمارات)", callback_data="pay_uae")],
-        [InlineKeyboardButton("Western Union / MoneyGram", callback_data="pay_wu_mg")],
-        [InlineKeyboardButton("محفظة الهاتف (رواندا)", callback_data="pay_rwanda")],
-        [InlineKeyboardButton("فودافون كاش / انستا باي (مصر)", callback_data="pay_vodafone_eg")],
-        [InlineKeyboardButton("تحويل بنكي عبر IBAN", callback_data="pay_iban")],
-    ]
-    await query.edit_message_text(text=msg_intro, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    await query.edit_message_text(text=msg_intro, reply_markup=PAYMENT_METHODS_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
 
 # --- (4.5) TEXT HANDLER (stages) ---
+@metrics.handler()
+@tracing.step()
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     text = update.message.text.strip()
 
-    # LOAD STATE
-    user_state = db.get_user_state(chat_id)
+    started = False
+    transition = None
+
+    def _advance(user_state):
+        nonlocal started, transition
+        started = bool(user_state)
+        if not started:
+            return False
+        metrics.label(stage=user_state.get("stage") or "none")
+        health.annotate(stage=user_state.get("stage"))
+        tracing.bind(chat_id, user_state)
+        tracing.note(user_state.get("stage"))
+        transition = registration.advance(user_state.get("stage"), text, user_state)
+        if transition is None:
+            return False
+
+    # Exactly one (compare-and-swap) state write per transition
+    try:
+        committed = db.mutate_user_state(chat_id, _advance)
+    except registration.InvalidInput as e:
+        await update.message.reply_text(e.message, reply_markup=e.reply_markup)
+        return
 
-    if not user_state:
+    if not started:
         await update.message.reply_text("يرجى البدء أولاً عبر الأمر /start")
         return
+    if transition is None:
+        await update.message.reply_text("لست متأكداً مما يجب فعله. ابدأ من جديد باختيار أحد الكورسات: /start")
+        return
+    if committed is None:
+        logger.error(f"Could not save stage {transition.stage} for {chat_id}")
+        return
 
-    stage = user_state.get("stage")
-    course_selected = user_state.get("course")
-
-    if stage == "awaiting_name":
-        user_state["name"] = text
-        user_state["stage"] = "awaiting_email"
-        db.update_user_state(chat_id, user_state)
-        await update.message.reply_text("ممتاز! الآن يرجى إدخال عنوان بريدك الإلكتروني:")
-
-    elif stage == "awaiting_email":
-        # General structure check
-        if "@" not in text or "." not in text:
-            await update.message.reply_text("يرجى إدخال بريد إلكتروني صحيح (مثال: name@example.com):")
-            return
-
-        # Special logic for Expert and Highschool courses: must be @gmail.com AND double confirmed
-        if course_selected in ["expert", "highschool"]:
-            if not text.lower().endswith("@gmail.com"):
-                await update.message.reply_text("يرجى إدخال بريد إلكتروني من Gmail فقط (مثال: name@gmail.com):")
-                return
-            
-            # Store temporarily and ask for confirmation
-            user_state["temp_email"] = text
-            user_state["stage"] = "awaiting_email_confirmation"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text("لتأكيد البريد الإلكتروني، يرجى كتابته مرة أخرى:")
-            return
-
-        # For other courses: accept any valid email structure and proceed
-        user_state["email"] = text
-        user_state["stage"] = "awaiting_whatsapp"
-        db.update_user_state(chat_id, user_state)
-        await update.message.reply_text("يرجى إدخال رقم الواتساب مع مفتاح الدولة (مثال: +966500000000):")
-
-    elif stage == "awaiting_email_confirmation":
-        first_email = user_state.get("temp_email", "")
-        if text.strip().lower() == first_email.strip().lower():
-            # Emails match
-            user_state["email"] = first_email
-            user_state.pop("temp_email", None)
-            
-            # Proceed to WhatsApp
-            user_state["stage"] = "awaiting_whatsapp"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text("يرجى إدخال رقم الواتساب مع مفتاح الدولة (مثال: +966500000000):")
-        else:
-            # Mismatch - ask to start over
-            user_state["stage"] = "awaiting_email"
-            user_state.pop("temp_email", None)
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text("عذراً، البريد الإلكتروني غير متطابق.\nيرجى إدخال البريد الإلكتروني من البداية:")
-
-    elif stage == "awaiting_whatsapp":
-        user_state["whatsapp"] = text
-        
-        # Branch based on course type
-        if course_selected == "kids":
-            user_state["stage"] = "awaiting_kids_count"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text("كم عدد الأطفال المسجّلين؟ (اكتب رقماً، مثال: 1 أو 2 أو 3)")
-        elif course_selected == "highschool":
-            user_state["stage"] = "awaiting_hs_count"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text("كم عدد المتدربين في البرنامج؟ (اكتب رقماً، مثال: 1 أو 2 أو 3)")
-        else:
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await ask_payment_method(update, context)
-
-    elif stage == "awaiting_kids_count":
-        # validate integer >0
-        try:
-            k = int(text)
-            if k <= 0:
-                raise ValueError()
-        except ValueError:
-            await update.message.reply_text("من فضلك اكتب عدداً صحيحاً أكبر من صفر. مثال: 1 أو 2 أو 3")
-            return
-        user_state["kids_count"] = k
-        user_state["stage"] = "awaiting_kids_names"
-        db.update_user_state(chat_id, user_state)
-        await update.message.reply_text("ما هي أسماء الأطفال؟ اكتبها مفصولة بفواصل. مثال: أحمد، سارة")
-    elif stage == "awaiting_hs_count":
-        # validate integer >0
-        try:
-            k = int(text)
-            if k <= 0:
-                raise ValueError()
-        except ValueError:
-            await update.message.reply_text("من فضلك اكتب عدداً صحيحاً أكبر من صفر. مثال: 1 أو 2 أو 3")
-            return
-        user_state["hs_count"] = k
-        user_state["stage"] = "awaiting_hs_names"
-        db.update_user_state(chat_id, user_state)
-        await update.message.reply_text("ما هي أسماء المتدربين؟ اكتبها مفصولة بفواصل. مثال: علي، محمد")
-
-    elif stage == "awaiting_kids_names":
-        # store names; optional check on count
-        names = [n.strip() for n in text.split(",") if n.strip()]
-        user_state["kids_names"] = ", ".join(names)
-        expected = user_state.get("kids_count", 0)
-        if expected and len(names) != expected:
-            await update.message.reply_text(
-                f"تنبّه: كتبت {len(names)} اسم/أسماء بينما العدد هو {expected}. "
-                "لو صحيح اضغط موافق، أو اكتب الأسماء من جديد.\n\nاكتب: موافق  — أو  أعد إدخال الأسماء."
-            )
-            user_state["stage"] = "confirm_kids_names"
-            db.update_user_state(chat_id, user_state)
-            return
-        # proceed
-        user_state["stage"] = "awaiting_payment_choice"
-        db.update_user_state(chat_id, user_state)
-        await ask_payment_method(update, context)
-    elif stage == "awaiting_hs_names":
-        names = [n.strip() for n in text.split(",") if n.strip()]
-        user_state["hs_names"] = ", ".join(names)
-        expected = user_state.get("hs_count", 0)
-        if expected and len(names) != expected:
-            await update.message.reply_text(
-                f"تنبّه: كتبت {len(names)} اسم/أسماء بينما العدد هو {expected}. "
-                "لو صحيح اضغط موافق، أو اكتب الأسماء من جديد.\n\nاكتب: موافق  — أو  أعد إدخال الأسماء."
-            )
-            user_state["stage"] = "confirm_hs_names"
-            db.update_user_state(chat_id, user_state)
-            return
-        user_state["stage"] = "awaiting_payment_choice"
-        db.update_user_state(chat_id, user_state)
-        await ask_payment_method(update, context)
-
-    elif stage == "confirm_kids_names":
-        if text.strip().lower() in ["موافق", "ok", "تمام", "نعم", "yes"]:
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await ask_payment_method(update, context)
-        else:
-            # treat as new names input
-            names = [n.strip() for n in text.split(",") if n.strip()]
-            user_state["kids_names"] = ", ".join(names)
-            expected = user_state.get("kids_count", 0)
-            if expected and len(names) != expected:
-                await update.message.reply_text(
-                    f"ما زال العدد لا يطابق ({len(names)} اسم مقابل {expected}). "
-                    "لو مناسب اكتب: موافق — أو أعد إدخال الأسماء."
-                )
-                db.update_user_state(chat_id, user_state)
-                return
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await ask_payment_method(update, context)
-    elif stage == "confirm_hs_names":
-        if text.strip().lower() in ["موافق", "ok", "تمام", "نعم", "yes"]:
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await ask_payment_method(update, context)
-        else:
-            names = [n.strip() for n in text.split(",") if n.strip()]
-            user_state["hs_names"] = ", ".join(names)
-            expected = user_state.get("hs_count", 0)
-            if expected and len(names) != expected:
-                await update.message.reply_text(
-                    f"ما زال العدد لا يطابق ({len(names)} اسم مقابل {expected}). "
-                    "لو مناسب اكتب: موافق — أو أعد إدخال الأسماء."
-                )
-                db.update_user_state(chat_id, user_state)
-                return
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await ask_payment_method(update, context)
-
-    elif stage == "awaiting_amount":
-        user_state["amount_paid"] = text
-        user_state["stage"] = "completed"
-        db.update_user_state(chat_id, user_state)
-        await forward_to_admin(update, context)
-
-    elif stage == "awaiting_wu_details":
-        user_state["wu_details"] = text
-        user_state["stage"] = "completed"
-        db.update_user_state(chat_id, user_state)
-        await forward_to_admin(update, context)
-
-    elif stage == "awaiting_vodafone_details":
-        user_state["vodafone_details"] = text
-        user_state["stage"] = "completed"
-        db.update_user_state(chat_id, user_state)
-        await forward_to_admin(update, context)
-
-    elif stage == "awaiting_coupon":
-        # Check for skip first
-        if text == "تخطي":
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await ask_payment_method(update, context)
-            return
-            
-        # Validate coupon with user's selected course
-        user_course = user_state.get("course")
-        discount = db.get_coupon(text, user_course)
-        if discount:
-            user_state["discount_percent"] = discount
-            user_state["coupon_code"] = text.upper()
-            user_state["stage"] = "awaiting_payment_choice"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text(f"✅ كود صحيح! تم تطبيق خصم {discount}% بنجاح.")
-            await ask_payment_method(update, context)
-        else:
-            # Wrong coupon - show error and give payment options with skip button
-            skip_btn = [[InlineKeyboardButton("⏭️ تخطي والمتابعة", callback_data="skip_coupon")]]
-            await update.message.reply_text(
-                "❌ الكوبون غير صحيح أو منتهي الصلاحية.\nيرجى إعادة كتابة الكوبون بالشكل الصحيح أو اضغط على تخطي:",
-                reply_markup=InlineKeyboardMarkup(skip_btn)
-            )
-
+    if transition.message:
+        await update.message.reply_text(transition.message)
+    if transition.prompt:
+        await enter_stage(update, context, transition.stage)
 
-    else:
-        await update.message.reply_text("لست متأكداً مما يجب فعله. ابدأ من جديد باختيار أحد الكورسات: /start")
+async def enter_stage(update: Update, context: ContextTypes.DEFAULT_TYPE, stage: str):
+    """Sends the entry prompt (or runs the entry action) of `stage`."""
+    action = STAGE_ACTIONS.get(stage)
+    if action:
+        await action(update, context)
+    elif stage in registration.PROMPTS:
+        await update.message.reply_text(registration.PROMPTS[stage])
 
 # --- (7) ADMIN HANDLERS ---
+@tracing.span()
 async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
@@ -336,10 +187,36 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("📤 تم استلام كافة المعلومات وجاري مراجعتها. سنقوم بالرد عليك قريباً جداً.")
 
+    # Identifies this submission; admins' decision buttons claim it exactly once
+    request_id = secrets.token_hex(4)
+
+    def _save_request(state):
+        if state.get("stage") != registration.COMPLETED:
+            return False   # cancelled / restarted meanwhile: don't recreate or overwrite it
+        state["request_id"] = request_id
+    db.mutate_user_state(chat_id, _save_request)
+
+    def _update_request(**fields):
+        # A decision can land (and delete the state) while the sends below are in
+        # flight: only the state of this very request is updated, never recreated
+        def _update(state):
+            if state.get("request_id") != request_id:
+                return False
+            state.update(fields)
+        db.mutate_user_state(chat_id, _update)
+
+    # Same receipt already sent (by anyone): flagged in the caption
+    if user_info.get("receipt_id"):
+        try:
+            user_info["receipt_duplicates"] = db.find_duplicate_receipts(user_info["receipt_id"])
+        except Exception as e:
+            logger.warning(f"Duplicate receipt lookup failed for {chat_id}: {e}")
+
     try:
-        row_index = utils.save_to_google_sheet(user_info)
+        row_index = await asyncio.to_thread(utils.save_to_google_sheet, user_info)
         user_info["sheet_row"] = row_index
-        db.update_user_state(chat_id, user_info)
+        # The sheet call can take seconds; only touch sheet_row so nothing written meanwhile is lost
+        _update_request(sheet_row=row_index)
     except Exception as e:
         for admin_id in config.ADMIN_IDS:
             try:
@@ -347,8 +224,57 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 pass
 
+    caption = _request_caption(user_info)
+
+    keyboard = [[InlineKeyboardButton("✅ قبول", callback_data=f"approve_{chat_id}_{request_id}"),
+                 InlineKeyboardButton("❌ رفض", callback_data=f"reject_{chat_id}_{request_id}")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    # [admin_id, message_id, kind] of every copy, so a decision can update them all
+    admin_messages = []
+
+    try:
+        file_id = user_info.get("receipt_file_id")
+        if not file_id:
+            raise ValueError("File ID for receipt is missing.")
+
+        # Send to all admins
+        for admin_id in config.ADMIN_IDS:
+            try:
+                if user_info.get("receipt_is_photo"):
+                    sent = await context.bot.send_photo(
+                        chat_id=admin_id, photo=file_id, caption=caption, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+                    )
+                else:
+                    sent = await context.bot.send_document(
+                        chat_id=admin_id, document=file_id, caption=caption, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+                    )
+                admin_messages.append([admin_id, sent.message_id, "caption"])
+            except Exception as admin_err:
+                logger.warning(f"Failed to send to admin {admin_id}: {admin_err}")
+    except Exception as e:
+        logger.error(f"Failed to send receipt notification for user {chat_id}: {e}")
+        error_message_for_admin = f"""⚠️ فشل في إرسال إشعار طلب التسجيل للمستخدم {chat_id}.
+
+البيانات:
+{caption}
+"""
+        for admin_id in config.ADMIN_IDS:
+            try:
+                sent = await context.bot.send_message(chat_id=admin_id, text=error_message_for_admin, parse_mode=None, reply_markup=reply_markup)
+                admin_messages.append([admin_id, sent.message_id, "text"])
+            except Exception:
+                pass
+
+    _update_request(admin_messages=admin_messages, receipt_duplicates=user_info.get("receipt_duplicates"))
+    if user_info.get("receipt_id"):
+        # The archived receipt stays findable by request after the state is deleted
+        db.set_receipt_request(user_info["receipt_id"], request_id)
+
+def _request_caption(user_info: dict) -> str:
+    """The admins' copy of a registration request (HTML)."""
     course_key = user_info.get("course")
-    course_title = config.COURSES.get(course_key, {}).get("title", "غير محدد")
+    course_title = catalog.current().course_title(course_key)
 
     caption = f"""<b>📩 طلب تسجيل جديد:</b>
 
@@ -384,106 +310,141 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <b>تفاصيل فودافون كاش:</b>
 <code>{_html.escape(user_info.get('vodafone_details') or '')}</code>
 """
+    caption += receipts.warning_html(user_info.get("receipt_duplicates"))
+    return caption
 
-    keyboard = [[InlineKeyboardButton("✅ قبول", callback_data=f"approve_{chat_id}"),
-                 InlineKeyboardButton("❌ رفض", callback_data=f"reject_{chat_id}")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    try:
-        file_id = user_info.get("receipt_file_id")
-        if not file_id:
-            raise ValueError("File ID for receipt is missing.")
-
-        # Send to all admins
-        for admin_id in config.ADMIN_IDS:
-            try:
-                if user_info.get("receipt_is_photo"):
-                    await context.bot.send_photo(
-                        chat_id=admin_id, photo=file_id, caption=caption, parse_mode=ParseMode.HTML, reply_markup=reply_markup
-                    )
-                else:
-                    await context.bot.send_document(
-                        chat_id=admin_id, document=file_id, caption=caption, parse_mode=ParseMode.HTML, reply_markup=reply_markup
-                    )
-            except Exception as admin_err:
-                logger.warning(f"Failed to send to admin {admin_id}: {admin_err}")
-    except Exception as e:
-        logger.error(f"Failed to send receipt notification for user {chat_id}: {e}")
-        error_message_for_admin = f"""⚠️ فشل في إرسال إشعار طلب التسجيل للمستخدم {chat_id}.
-
-البيانات:
-{caption}
-"""
-        for admin_id in config.ADMIN_IDS:
-            try:
-                await context.bot.send_message(chat_id=admin_id, text=error_message_for_admin, parse_mode=None, reply_markup=reply_markup)
-            except Exception:
-                pass
+# Stages whose entry is an action rather than a plain prompt
+STAGE_ACTIONS = {
+    registration.PAYMENT_CHOICE: ask_payment_method,
+    registration.COMPLETED: forward_to_admin,
+}
 
 # --- (8) RECEIPT HANDLER ---
+@metrics.handler()
+@tracing.step()
 async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # Load state
     user_state = db.get_user_state(chat_id)
+    tracing.bind(chat_id, user_state)
 
     if not user_state or user_state.get("stage") != "awaiting_receipt":
         await update.message.reply_text("يرجى إكمال خطوات التسجيل أولاً قبل إرسال الإيصال. ابدأ من /start")
         return
 
-    file_id = None
     is_photo = False
     if update.message.photo:
-        file_id = update.message.photo[-1].file_id
+        received = update.message.photo[-1]
         is_photo = True
+        # Smallest size Telegram generated; archived as the thumbnail
+        thumb = update.message.photo[0] if len(update.message.photo) > 1 else None
+        ext = receipts.receipt_ext(None, None, True)
     elif update.message.document:
-        file_id = update.message.document.file_id
+        received = update.message.document
         is_photo = False
+        thumb = received.thumbnail
+        ext = receipts.receipt_ext(received.file_name, received.mime_type, False)
     else:
         await update.message.reply_text("صيغة الملف غير مدعومة. أرسل الإيصال كصورة (PNG/JPEG) أو ملف PDF.")
         return
+    file_id = received.file_id
+
+    # Indexed (duplicates, archive) before the state points at it; see receipts.py
+    receipt_id = db.add_receipt(chat_id, received.file_unique_id, file_id, is_photo,
+                                ext=ext, thumb_file_id=thumb.file_id if thumb else None)
+    method = None
+
+    def _store_receipt(user_state):
+        nonlocal method
+        if user_state.get("stage") != "awaiting_receipt":
+            # Moved on concurrently (e.g. a second receipt already got through)
+            return False
+        user_state["receipt_file_id"] = file_id
+        user_state["receipt_is_photo"] = is_photo
+        user_state["receipt_id"] = receipt_id
+        user_state.pop("receipt_duplicates", None)
+
+        method = config.PAYMENT_METHODS.get(user_state.get("payment_method_key"))
+        if method is None and user_state.get("payment_method_info", {}).get("requires_extra_info"):
+            # States saved before the registry only kept the friendly name
+            name = user_state.get("payment_method", "")
+            is_vodafone = "فودافون" in name or "vodafone" in name.lower()
+            method = config.PAYMENT_METHODS["vodafone_eg" if is_vodafone else "wu_mg"]
+
+        if method and method.get("extra_info_stage"):
+            user_state["stage"] = method["extra_info_stage"]
+        else:
+            # Skip the amount step - go directly to admin review
+            user_state["stage"] = "completed"
 
-    user_state["receipt_file_id"] = file_id
-    user_state["receipt_is_photo"] = is_photo
-    db.update_user_state(chat_id, user_state)
+    user_state = db.mutate_user_state(chat_id, _store_receipt)
 
-    payment_method_info = user_state.get("payment_method_info", {})
-    if payment_method_info.get("requires_extra_info"):
-        method = user_state.get("payment_method", "")
-        if "فودافون" in method or "vodafone" in method.lower():
-            user_state["stage"] = "awaiting_vodafone_details"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text(
-                "تم استلام الإيصال بنجاح 👍\n"
-                "الرجاء إرسال في رسالة واحدة:\n"
-                "- الاسم الكامل الذي تم التحويل منه\n"
-                "- رقم المحفظة التي تم التحويل منها"
-            )
-        else:
-            user_state["stage"] = "awaiting_wu_details"
-            db.update_user_state(chat_id, user_state)
-            await update.message.reply_text(
-                "تم استلام الإيصال. لإكمال التحقق، أرسل في رسالة واحدة:\n"
-                "- الاسم الكامل المستخدم في الحوالة\n"
-                "- الدولة التي أرسلت منها\n"
-                "- الرقم المرجعي (MTCN or Reference No.)"
-            )
+    if user_state is None:
+        logger.warning(f"Receipt from {chat_id} was not saved (stage changed or write failed)")
+        db.delete_receipt(receipt_id)
+        return
+
+    if user_state["stage"] != "completed":
+        await update.message.reply_text(method["extra_info_prompt"])
     else:
-        # Skip the amount step - go directly to admin review
-        user_state["stage"] = "completed"
-        db.update_user_state(chat_id, user_state)
         await update.message.reply_text("تم استلام الإيصال! 👍\n📤 جاري مراجعة طلبك...")
         await forward_to_admin(update, context)
 
 # --- (10) APPROVAL FLOW (ADMIN DECISION) ---
+DECISION_LABELS = {"approve": "✅ Approved", "reject": "❌ Rejected"}
+
+def _already_handled_text(decision: dict) -> str:
+    label = DECISION_LABELS.get(decision.get("action"), decision.get("action"))
+    if decision.get("status") == "in_progress":
+        return f"⏳ هذا الطلب قيد المعالجة الآن بواسطة {decision.get('admin_name')} ({label})."
+    return f"ℹ️ تم التعامل مع هذا الطلب مسبقاً بواسطة {decision.get('admin_name')} ({label})."
+
+async def _update_admin_copies(context, query, admin_messages, footer: str, user_info: dict = None):
+    """Appends `footer` to every admin's copy of the request (buttons removed), in parallel.
+    Without a clicked copy (bulk decisions) the text is rebuilt from user_info."""
+    copies = [tuple(c) for c in (admin_messages or [])]
+    parse_mode = None
+    if query is not None:
+        message = query.message
+        is_caption = message.caption is not None
+        text = f"{message.caption if is_caption else message.text}\n\n--- {footer} ---"
+        if not any(c[0] == message.chat.id and c[1] == message.message_id for c in copies):
+            copies.append((message.chat.id, message.message_id, "caption" if is_caption else "text"))
+    else:
+        text = f"{_request_caption(user_info)}\n--- {_html.escape(footer)} ---"
+        parse_mode = ParseMode.HTML
+
+    async def _edit(admin_id, message_id, kind):
+        if kind == "text":
+            await context.bot.edit_message_text(chat_id=admin_id, message_id=message_id, text=text, parse_mode=parse_mode)
+        else:
+            await context.bot.edit_message_caption(chat_id=admin_id, message_id=message_id, caption=text,
+                                                   parse_mode=parse_mode)
+
+    results = await asyncio.gather(*(_edit(*c) for c in copies), return_exceptions=True)
+    for (admin_id, _, _), result in zip(copies, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to update decision message for admin {admin_id}: {result}")
+
+@metrics.handler()
+@tracing.step(user=_decision_user)
 async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    action, user_chat_id_str = query.data.split("_", 1)
+    # approve_<user>_<request> (buttons sent before request ids: approve_<user>)
+    action, rest = query.data.split("_", 1)
+    user_chat_id_str, _, request_id = rest.partition("_")
     user_chat_id = int(user_chat_id_str)
 
     # Load state
     user_info = db.get_user_state(user_chat_id)
+    tracing.bind(user_chat_id, user_info)
+    request_id = request_id or user_info.get("request_id") or f"user-{user_chat_id}"
     if not user_info:
+        decision = db.get_admin_decision(request_id)
+        if decision:
+            await query.answer(_already_handled_text(decision), show_alert=True)
+            return
         await query.answer("❌ بيانات هذا المستخدم غير موجودة (ربما تمت معالجة الطلب).", show_alert=True)
         try:
             await query.edit_message_caption(caption=f"{query.message.caption}\n\n--- ⚠️ تعذر العثور على بيانات الطلب ---")
@@ -491,106 +452,348 @@ async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TY
             pass
         return
 
+    # First click wins; every later click (any admin) gets answered right away
+    admin_name = query.from_user.full_name or str(query.from_user.id)
+    decision = await _decide(context, action, user_chat_id, user_info, request_id, query.from_user.id, admin_name, query)
+    if decision:
+        await query.answer(_already_handled_text(decision), show_alert=True)
+
+async def _decide(context, action: str, user_chat_id: int, user_info: dict, request_id: str,
+                  admin_id: int, admin_name: str, query=None) -> Optional[dict]:
+    """Claims the request and runs the whole decision pipeline (side effects, ledger,
+    admin copies, state cleanup). Returns the earlier decision instead when the
+    request was already claimed. `query` is the clicked button, None in bulk runs."""
+    decision = await asyncio.to_thread(db.claim_admin_decision, request_id, user_chat_id, action, admin_id, admin_name)
+    if decision:
+        return decision
+
+    # A retaken claim (failed / abandoned run) skips the steps already done, and
+    # keeps its action once any were
+    earlier = await asyncio.to_thread(db.get_admin_decision, request_id) or {}
+    action = earlier.get("action") or action
+    try:
+        await _run_admin_decision(query, context, action, user_chat_id, user_info, request_id, earlier.get("steps") or set())
+    except Exception:
+        await asyncio.to_thread(db.finish_admin_decision, request_id, "failed")
+        raise
+    approval = None
+    if action == "approve":
+        try:
+            approval = revenue.approval_entry(request_id, user_chat_id, user_info, admin_id)
+        except Exception as e:
+            logger.error(f"Failed to price approval {request_id} for the revenue ledger: {e}")
+    # The ledger row is written in the same transaction that marks the decision done
+    await asyncio.to_thread(db.finish_admin_decision, request_id, "done", approval)
+
+    status_msg = DECISION_LABELS.get(action, action)
+    await _update_admin_copies(
+        context, query, user_info.get("admin_messages"), f"تم التعامل مع الطلب: {status_msg} بواسطة {admin_name}",
+        user_info=user_info,
+    )
+
+    # Clean up state after final decision (the events log keeps the outcome)
+    db.delete_user_state(user_chat_id, outcome=f"{action}d")
+    return None
+
+async def _run_admin_decision(query, context: ContextTypes.DEFAULT_TYPE, action: str, user_chat_id: int,
+                              user_info: dict, request_id: str, done: set):
+    """The approval/rejection side effects. Each step is recorded once done, so a
+    retaken claim (see _decide) runs only the steps not in `done`."""
     sheet_row = user_info.get("sheet_row")
-    status_msg = ""
+    status_msg = DECISION_LABELS.get(action, "")
+
+    async def _did(step: str):
+        done.add(step)
+        await asyncio.to_thread(db.add_decision_step, request_id, step)
 
     if action == "approve":
         course_key = user_info.get("course", "expert")
         
         # Redeem coupon if used
         coupon_code = user_info.get("coupon_code")
-        if coupon_code:
+        if coupon_code and "coupon" not in done:
             db.redeem_coupon(coupon_code)
+            await _did("coupon")
 
-        # لو الكورس هو خبير الذاكرة أو طلاب الثانوية → نعطي صلاحية تلقائياً على فولدر الدرايف
-        if course_key == "expert":
-            email = (user_info.get("email") or "").strip()
-            if email:
-                ok = utils.grant_expert_drive_access(email)
-                if not ok:
-                    # ننبّه الأدمن لو ما قدرنا ندي صلاحية
-                    for admin_id in config.ADMIN_IDS:
-                        try:
-                            await context.bot.send_message(
-                                admin_id,
-                                f"⚠️ لم يتم منح صلاحية Google Drive تلقائياً للإيميل: {email}.\n"
-                                f"يرجى التحقق يدوياً من مشاركة فولدر الكورس."
-                            )
-                        except Exception:
-                            pass
-            else:
+        if "drive" not in done:
+            await _grant_drive_access(context, course_key, user_chat_id, user_info)
+            await _did("drive")
+
+        # إرسال رسائل الترحيب / التعليمات حسب نوع الكورس
+        if "messages" not in done:
+            msgs = utils.build_approval_messages_by_course(course_key, user_info)
+            await utils.send_messages_sequence(context, user_chat_id, msgs)
+            await _did("messages")
+        if query is not None:
+            await query.answer("✅ تم القبول وإرسال رسالة التأكيد المناسبة.", show_alert=True)
+    elif action == "reject":
+        rejection_reason = "قد يكون السبب مشكلة في إيصال الدفع أو عدم وضوحه."
+        if "messages" not in done:
+            await context.bot.send_message(
+                user_chat_id,
+                f"❌ تم رفض طلبك. {rejection_reason} يرجى التواصل مع خدمة العملاء للمزيد من المعلومات: {config.CUSTOMER_SUPPORT_USERNAME}",
+            )
+            await _did("messages")
+        if query is not None:
+            await query.answer("تم الرفض بنجاح.", show_alert=True)
+
+    if sheet_row and "sheet" not in done:
+        try:
+            await asyncio.to_thread(utils.update_status_in_sheet, sheet_row, status_msg)
+        except Exception as e:
+            for admin_id in config.ADMIN_IDS:
+                try:
+                    await context.bot.send_message(admin_id, f"⚠️ لم يتم تحديث الحالة في Google Sheets للمستخدم {user_chat_id}: {str(e)}")
+                except Exception:
+                    pass
+        await _did("sheet")
+
+async def _grant_drive_access(context, course_key: str, user_chat_id: int, user_info: dict):
+    """Shares the course's Drive folder (expert / highschool); admins are told when it can't be done."""
+    # لو الكورس هو خبير الذاكرة أو طلاب الثانوية → نعطي صلاحية تلقائياً على فولدر الدرايف
+    if course_key == "expert":
+        email = (user_info.get("email") or "").strip()
+        if email:
+            ok = await asyncio.to_thread(utils.grant_expert_drive_access, email)
+            if not ok:
+                # ننبّه الأدمن لو ما قدرنا ندي صلاحية
                 for admin_id in config.ADMIN_IDS:
                     try:
                         await context.bot.send_message(
                             admin_id,
-                            f"⚠️ لا يوجد بريد إلكتروني مسجل لهذا المستخدم ({user_chat_id})، "
-                            "لذلك لم يتم منح صلاحية الدرايف تلقائياً."
+                            f"⚠️ لم يتم منح صلاحية Google Drive تلقائياً للإيميل: {email}.\n"
+                            f"يرجى التحقق يدوياً من مشاركة فولدر الكورس."
                         )
                     except Exception:
                         pass
-        elif course_key == "highschool":
-            email = (user_info.get("email") or "").strip()
-            if email:
-                ok = utils.grant_highschool_drive_access(email)
-                if not ok:
-                    for admin_id in config.ADMIN_IDS:
-                        try:
-                            await context.bot.send_message(
-                                admin_id,
-                                f"⚠️ لم يتم منح صلاحية Google Drive تلقائياً للإيميل: {email}.\n"
-                                f"يرجى التحقق يدوياً من مشاركة فولدر الكورس."
-                            )
-                        except Exception:
-                            pass
-            else:
+        else:
+            for admin_id in config.ADMIN_IDS:
+                try:
+                    await context.bot.send_message(
+                        admin_id,
+                        f"⚠️ لا يوجد بريد إلكتروني مسجل لهذا المستخدم ({user_chat_id})، "
+                        "لذلك لم يتم منح صلاحية الدرايف تلقائياً."
+                    )
+                except Exception:
+                    pass
+    elif course_key == "highschool":
+        email = (user_info.get("email") or "").strip()
+        if email:
+            ok = await asyncio.to_thread(utils.grant_highschool_drive_access, email)
+            if not ok:
                 for admin_id in config.ADMIN_IDS:
                     try:
                         await context.bot.send_message(
                             admin_id,
-                            f"⚠️ لا يوجد بريد إلكتروني مسجل لهذا المستخدم ({user_chat_id})، "
-                            "لذلك لم يتم منح صلاحية الدرايف تلقائياً."
+                            f"⚠️ لم يتم منح صلاحية Google Drive تلقائياً للإيميل: {email}.\n"
+                            f"يرجى التحقق يدوياً من مشاركة فولدر الكورس."
                         )
                     except Exception:
                         pass
-
-        # إرسال رسائل الترحيب / التعليمات حسب نوع الكورس
-        msgs = utils.build_approval_messages_by_course(course_key, user_info)
-        await utils.send_messages_sequence(context, user_chat_id, msgs)
-        status_msg = "✅ Approved"
-        await query.answer("✅ تم القبول وإرسال رسالة التأكيد المناسبة.", show_alert=True)
-    elif action == "reject":
-        rejection_reason = "قد يكون السبب مشكلة في إيصال الدفع أو عدم وضوحه."
-        await context.bot.send_message(
-            user_chat_id,
-            f"❌ تم رفض طلبك. {rejection_reason} يرجى التواصل مع خدمة العملاء للمزيد من المعلومات: {config.CUSTOMER_SUPPORT_USERNAME}",
-        )
-        status_msg = "❌ Rejected"
-        await query.answer("تم الرفض بنجاح.", show_alert=True)
-
-    if sheet_row:
-        try:
-            utils.update_status_in_sheet(sheet_row, status_msg)
-        except Exception as e:
+        else:
             for admin_id in config.ADMIN_IDS:
                 try:
-                    await context.bot.send_message(admin_id, f"⚠️ لم يتم تحديث الحالة في Google Sheets للمستخدم {user_chat_id}: {str(e)}")
+                    await context.bot.send_message(
+                        admin_id,
+                        f"⚠️ لا يوجد بريد إلكتروني مسجل لهذا المستخدم ({user_chat_id})، "
+                        "لذلك لم يتم منح صلاحية الدرايف تلقائياً."
+                    )
                 except Exception:
                     pass
 
+# --- (10.5) PENDING QUEUE / BULK DECISIONS ---
+# Bulk selections waiting for the admin's confirmation: token -> (action, user_ids, page)
+_bulk_selections = {}
+MAX_BULK_SELECTIONS = 50
+BULK_ACTIONS = {"approve": "قبول", "reject": "رفض"}
+
+def _waited(since: float) -> str:
+    minutes = int((datetime.datetime.now().timestamp() - since) // 60)
+    if minutes < 60:
+        return f"{minutes}د"
+    if minutes < 48 * 60:
+        return f"{minutes // 60}س"
+    return f"{minutes // 1440} يوم"
+
+def _pending_view(page: int):
+    size = max(1, config.PENDING_PAGE_SIZE)
+    total, rows = db.get_pending_page(page * size, size)
+    pages = max(1, (total + size - 1) // size)
+    if page >= pages and total:
+        page = pages - 1
+        total, rows = db.get_pending_page(page * size, size)
+
+    if not total:
+        return "✅ لا توجد طلبات بانتظار المراجعة.", None, []
+    msg = f"📥 <b>طلبات بانتظار المراجعة:</b> {total} (صفحة {page + 1}/{pages})\n"
+    cat = catalog.current()
+    for i, (user_id, since, state) in enumerate(rows, start=page * size + 1):
+        quote = state.get("quote") or {}
+        amount = f" · {quote['amount']:,} {quote['currency']}" if quote.get("amount") is not None else ""
+        msg += (f"\n{i}. <b>{_html.escape(state.get('name') or '—')}</b> — <code>{user_id}</code>\n"
+                f"   {_html.escape(cat.course_title(state.get('course'), state.get('course') or '—'))} · "
+                f"{_html.escape(state.get('payment_method') or '—')}{_html.escape(amount)} · ⏱️ {_waited(since)}\n")
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"pending_page_{page - 1}"))
+    nav.append(InlineKeyboardButton(f"🔄 {page + 1}/{pages}", callback_data=f"pending_page_{page}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"pending_page_{page + 1}"))
+    bulk = [InlineKeyboardButton(f"✅ قبول الصفحة ({len(rows)})", callback_data=f"pending_bulk_approve_{page}"),
+            InlineKeyboardButton(f"❌ رفض الصفحة ({len(rows)})", callback_data=f"pending_bulk_reject_{page}")]
+    return msg, InlineKeyboardMarkup([nav, bulk]), [user_id for user_id, _, _ in rows]
+
+def _confirm_bulk(action: str, user_ids: list, page: int):
+    token = secrets.token_hex(4)
+    _bulk_selections[token] = (action, user_ids, page)
+    while len(_bulk_selections) > MAX_BULK_SELECTIONS:
+        _bulk_selections.pop(next(iter(_bulk_selections)))
+    ids = ", ".join(str(u) for u in user_ids[:30]) + (" …" if len(user_ids) > 30 else "")
+    msg = (f"⚠️ <b>تأكيد {BULK_ACTIONS[action]} {len(user_ids)} طلب؟</b>\n\n<code>{ids}</code>\n\n"
+           "سيتم تنفيذ نفس خطوات القبول/الرفض لكل مستخدم (الرسائل، الدرايف، الشيت).")
+    markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"✅ تأكيد ال{BULK_ACTIONS[action]}", callback_data=f"pending_go_{token}"),
+        InlineKeyboardButton("🔙 إلغاء", callback_data=f"pending_page_{page}"),
+    ]])
+    return msg, markup
+
+@tracing.step(name="bulk_decision", user=lambda context, action, user_id, *args: user_id)
+async def _bulk_decide_one(context, action: str, user_id: int, admin_id: int, admin_name: str) -> Optional[str]:
+    """Runs one decision of a bulk run; returns why it was skipped, or None once decided."""
+    user_info = db.get_user_state(user_id)
+    tracing.bind(user_id, user_info)
+    if not user_info or user_info.get("stage") != registration.COMPLETED:
+        return "لم يعد بانتظار المراجعة"
+    request_id = user_info.get("request_id") or f"user-{user_id}"
+    decision = await _decide(context, action, user_id, user_info, request_id, admin_id, admin_name)
+    return _already_handled_text(decision) if decision else None
+
+async def _bulk_decide(context, action: str, user_ids: list, admin_id: int, admin_name: str) -> dict:
+    """The decision pipeline for every user, at most BULK_DECISION_CONCURRENCY at a time."""
+    limit = asyncio.Semaphore(max(1, config.BULK_DECISION_CONCURRENCY))
+    result = {"done": [], "skipped": [], "failed": []}
+
+    async def _one(user_id):
+        async with limit:
+            try:
+                skipped = await _bulk_decide_one(context, action, user_id, admin_id, admin_name)
+            except Exception as e:
+                logger.error(f"Bulk {action} of {user_id} failed: {e}")
+                result["failed"].append((user_id, str(e)))
+                return
+            if skipped:
+                result["skipped"].append((user_id, skipped))
+            else:
+                result["done"].append(user_id)
+
+    await asyncio.gather(*(_one(user_id) for user_id in user_ids))
+    return result
+
+def _bulk_report(action: str, result: dict, seconds: float) -> str:
+    msg = (f"📋 <b>نتيجة ال{BULK_ACTIONS[action]} الجماعي</b> ({seconds:.0f}s)\n\n"
+           f"✅ تم: {len(result['done'])}\n⏭️ تم تخطيه: {len(result['skipped'])}\n❌ فشل: {len(result['failed'])}\n")
+    for title, rows in (("⏭️ المتخطاة", result["skipped"]), ("❌ الفاشلة", result["failed"])):
+        if rows:
+            msg += f"\n<b>{title}:</b>\n"
+            for user_id, reason in rows[:20]:
+                msg += f"- <code>{user_id}</code>: {_html.escape(reason[:120])}\n"
+            if len(rows) > 20:
+                msg += f"… و{len(rows) - 20} أخرى\n"
+    return msg
+
+async def _bulk_job(context, query, action: str, user_ids: list, page: int, admin_name: str):
+    started = datetime.datetime.now()
+    result = await _bulk_decide(context, action, user_ids, query.from_user.id, admin_name)
+    seconds = (datetime.datetime.now() - started).total_seconds()
+    await query.message.reply_text(_bulk_report(action, result, seconds), parse_mode=ParseMode.HTML)
+    msg, markup, _ = _pending_view(page)
     try:
-        await query.edit_message_caption(caption=f"{query.message.caption}\n\n--- تم التعامل مع الطلب: {status_msg} ---")
-    except Exception:
-        pass
+        await query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except Exception as e:
+        logger.debug(f"Pending page not refreshed after the bulk run: {e}")
 
-    # Clean up state after final decision
-    db.delete_user_state(user_chat_id)
+@metrics.handler()
+async def admin_pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/pending [page]: submitted registrations waiting for a decision, oldest first."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    page = int(context.args[0]) - 1 if context.args and context.args[0].isdigit() and int(context.args[0]) > 0 else 0
+    msg, markup, _ = _pending_view(page)
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+@metrics.handler()
+async def admin_bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/bulk approve|reject <user_id> [...]: asks for confirmation, then decides them all."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    args = context.args or []
+    if len(args) < 2 or args[0] not in BULK_ACTIONS or not all(a.isdigit() for a in args[1:]):
+        await update.message.reply_text("الاستخدام: /bulk approve|reject <user_id> <user_id> ...")
+        return
+    user_ids = list(dict.fromkeys(int(a) for a in args[1:]))
+    msg, markup = _confirm_bulk(args[0], user_ids, 0)
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+async def handle_pending_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """pending_page_<n> / pending_bulk_<action>_<n> / pending_go_<token> (admins only)."""
+    query = update.callback_query
+    if query.from_user.id not in config.ADMIN_IDS:
+        await query.answer()
+        return
+    _, kind, rest = query.data.split("_", 2)
+
+    if kind == "page":
+        await query.answer()
+        msg, markup, _ = _pending_view(int(rest))
+        try:
+            await query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+        except Exception as e:
+            logger.debug(f"Pending page unchanged: {e}")   # "message is not modified" on refresh
+        return
+
+    if kind == "bulk":
+        action, page = rest.split("_")
+        _, _, user_ids = _pending_view(int(page))
+        if not user_ids:
+            await query.answer("لا توجد طلبات في هذه الصفحة.", show_alert=True)
+            return
+        await query.answer()
+        msg, markup = _confirm_bulk(action, user_ids, int(page))
+        await query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
+        return
+
+    if kind == "go":
+        selection = _bulk_selections.pop(rest, None)
+        if selection is None:
+            await query.answer("انتهت صلاحية هذا التأكيد، افتح /pending من جديد.", show_alert=True)
+            return
+        action, user_ids, page = selection
+        await query.answer()
+        await query.edit_message_text(f"⏳ جاري {BULK_ACTIONS[action]} {len(user_ids)} طلب...")
+        admin_name = query.from_user.full_name or str(query.from_user.id)
+        _in_background(context, _bulk_job(context, query, action, user_ids, page, admin_name))
+        return
+
+    await query.answer()
 
 # --- (5) CALLBACKS (General) ---
+@metrics.handler(labels=lambda update, context: {"action": callback_action(update.callback_query.data)})
+@tracing.step(user=_callback_user)
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    data = query.data
+
+    # Admin decisions answer the query themselves (with an alert)
+    if data.startswith("approve_") or data.startswith("reject_"):
+        await handle_admin_decision(update, context)
+        return
+    if data.startswith("pending_"):
+        await handle_pending_callback(update, context)
+        return
+
     await query.answer()
     chat_id = query.message.chat.id
-    data = query.data
 
     # Load state
     user_state = db.get_user_state(chat_id)
@@ -598,92 +801,91 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
          # Initialize if empty for some reason (e.g. user clicks button after db checks)
          user_state = {"telegram_username": query.from_user.username}
          # but actually we probably should leave it empty or minimal
-         db.update_user_state(chat_id, user_state)
+         # (insert-only: never clobber a row another update created meanwhile)
+         db.compare_and_set_user_state(chat_id, user_state, None)
+    health.annotate(stage=user_state.get("stage"))
+    tracing.bind(chat_id, user_state)
+    tracing.note(callback_action(data))
 
     if data.startswith("course_"):
         course_key = data.split("_")[1]
-        user_state["course"] = course_key
-        db.update_user_state(chat_id, user_state)
+        db.mutate_user_state(chat_id, lambda state: state.update(course=course_key))
         
-        course = config.COURSES[course_key]
-        buttons = [
-            [InlineKeyboardButton("✅ الانضمام الآن", callback_data=f"join_{course_key}")],
-            [InlineKeyboardButton("❓ الأسئلة الشائعة", callback_data=f"faq_{course_key}")],
-            [InlineKeyboardButton("💬 خدمة العملاء", callback_data="support")],
-            [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="start_over")],
-        ]
-        await query.edit_message_text(text=course["description"], reply_markup=InlineKeyboardMarkup(buttons), parse_mode=None)
+        cat = catalog.current()
+        course = cat.courses.get(course_key)
+        if not course:
+            await query.edit_message_text("عذراً، هذا الكورس غير متاح حالياً. ابدأ من جديد: /start")
+            return
+        await query.edit_message_text(text=course["description"], reply_markup=cat.course_keyboards[course_key], parse_mode=None)
 
     elif data.startswith("join_"):
-        user_state["stage"] = "awaiting_name"
-        db.update_user_state(chat_id, user_state)
+        db.mutate_user_state(chat_id, lambda state: state.update(stage="awaiting_name"))
         await query.edit_message_text("ممتاز! لبدء التسجيل، يرجى إرسال اسمك الكامل:")
 
     elif data.startswith("faq_"):
         course_key = data.split("_")[1]
-        faq_buttons = []
-        for i, q in enumerate(config.FAQS[course_key]):
-            faq_buttons.append([InlineKeyboardButton(q, callback_data=f"question_{course_key}_{i}")])
-        faq_buttons.append([InlineKeyboardButton("🔙 العودة لتفاصيل الكورس", callback_data=f"course_{course_key}")])
-        await query.edit_message_text("اختر السؤال الذي يهمك:", reply_markup=InlineKeyboardMarkup(faq_buttons))
+        faq_keyboard = catalog.current().faq_keyboards.get(course_key)
+        if faq_keyboard is None:
+            return
+        await query.edit_message_text("اختر السؤال الذي يهمك:", reply_markup=faq_keyboard)
 
     elif data.startswith("question_"):
         parts = data.split("_")
         course_key, q_index = parts[1], int(parts[2])
-        question = list(config.FAQS[course_key].keys())[q_index]
-        answer = config.FAQS[course_key][question]
-        back_button = [[InlineKeyboardButton("🔙 العودة للأسئلة", callback_data=f"faq_{course_key}")]]
-        await query.edit_message_text(f"❓  السؤال: \n{question}\n\n💬  الإجابة: \n{answer}", reply_markup=InlineKeyboardMarkup(back_button))
+        cat = catalog.current()
+        entry = cat.faq_entry(course_key, q_index)
+        if entry is None:
+            # FAQ list changed since the buttons were sent
+            return
+        question, answer = entry
+        await query.edit_message_text(f"❓  السؤال: \n{question}\n\n💬  الإجابة: \n{answer}", reply_markup=cat.faq_back_keyboards[course_key])
 
     elif data == "coupon_request":
-        user_state["stage"] = "awaiting_coupon"
-        db.update_user_state(chat_id, user_state)
+        db.mutate_user_state(chat_id, lambda state: state.update(stage="awaiting_coupon"))
         skip_btn = [[InlineKeyboardButton("⏭️ تخطي", callback_data="skip_coupon")]]
         await query.edit_message_text("🎟️ الرجاء إدخال كود الكوبون:", reply_markup=InlineKeyboardMarkup(skip_btn))
 
     elif data == "skip_coupon":
-        user_state["stage"] = "awaiting_payment_choice"
-        db.update_user_state(chat_id, user_state)
+        user_state = db.mutate_user_state(chat_id, lambda state: state.update(stage="awaiting_payment_choice")) or user_state
         await ask_payment_method_callback(query, context, user_state)
 
     elif data.startswith("pay_"):
         method_key = data.replace("pay_", "")  # 'bankak'/'saudi'/'uae'/'wu_mg'/'rwanda'
-        course_key = user_state.get("course")
-        discount_percent = user_state.get("discount_percent", 0)
 
-        if not course_key:
+        def _choose_method(user_state):
+            course_key = user_state.get("course")
+            if not course_key:
+                return False
+
+            # Dynamic payment text with per-course pricing
+            payment_text = utils.build_payment_text(
+                method_key,
+                course_key,
+                seats=registration.seat_count(user_state),
+                discount_percent=user_state.get("discount_percent", 0)
+            )
+
+            # Save a human-friendly method tag
+            user_state["payment_method"] = utils.payment_method_name(method_key)
+            user_state["payment_method_key"] = method_key
+            # The price as quoted, for the revenue ledger (prices may change before approval)
+            user_state["quote"] = utils.quote_price(
+                method_key,
+                course_key,
+                seats=registration.seat_count(user_state),
+                discount_percent=user_state.get("discount_percent", 0)
+            )
+            user_state["payment_method_info"] = {
+                "text": payment_text,
+                "requires_extra_info": bool(config.PAYMENT_METHODS.get(method_key, {}).get("extra_info_stage")),
+            }
+            user_state["stage"] = "awaiting_receipt"
+
+        user_state = db.mutate_user_state(chat_id, _choose_method)
+        if user_state is None:
             await query.edit_message_text("عذراً، انتهت صلاحية الجلسة. يرجى البدء من جديد: /start")
             return
-
-        # Dynamic payment text with per-course pricing
-        payment_text = utils.build_payment_text(
-            method_key,
-            course_key,
-            kids_count=user_state.get("kids_count"),
-            hs_count=user_state.get("hs_count"),
-            discount_percent=discount_percent
-        )
-
-        # Save a human-friendly method tag
-        friendly_map = {
-            "paypal": "PayPal",
-            "bankak": "بنكك (السودان)",
-            "saudi": "تحويل بنكي (السعودية)",
-            "uae": "تحويل بنكي (الإمارات)",
-            "wu_mg": "Western Union / MoneyGram",
-            "rwanda": "محفظة الهاتف (رواندا)",
-               "vodafone_eg": "فودافون كاش / انستا باي (مصر)",
-            "iban": "تحويل بنكي (IBAN)",
-        }
-        user_state["payment_method"] = friendly_map.get(method_key, method_key)
-        user_state["payment_method_info"] = {"text": payment_text, "requires_extra_info": (method_key in ["wu_mg", "vodafone_eg"])
-}
-        user_state["stage"] = "awaiting_receipt"
-        db.update_user_state(chat_id, user_state)
-        await query.edit_message_text(payment_text, parse_mode=None)
-
-    elif data.startswith("approve_") or data.startswith("reject_"):
-        await handle_admin_decision(update, context)
+        await query.edit_message_text(user_state["payment_method_info"]["text"], parse_mode=None)
 
     elif data == "support":
         await query.message.reply_text(f"للتواصل مع خدمة العملاء مباشرة: {config.CUSTOMER_SUPPORT_USERNAME}")
@@ -691,9 +893,91 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "start_over":
         await start_command(update, context)
 
-async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def send_broadcast(bot, user_ids, text: str) -> dict:
+    """Sends `text` to each user until done or /cancel, at this shard's share of
+    BROADCAST_RATE (every shard sends with the same bot token)."""
+    global broadcast_cancelled, broadcast_running
+    broadcast_cancelled = False
+    broadcast_running = True
+    result = {"sent": 0, "failed": 0, "cancelled": False}
+    interval = config.SHARD_COUNT / config.BROADCAST_RATE if config.BROADCAST_RATE > 0 else 0
+    loop = asyncio.get_running_loop()
+    next_send = loop.time()
+    try:
+        for user_id in user_ids:
+            if broadcast_cancelled:
+                result["cancelled"] = True
+                break
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_send = max(next_send, loop.time()) + interval
+            try:
+                try:
+                    await bot.send_message(chat_id=user_id, text=text)
+                except RetryAfter as e:
+                    # Over the limit anyway (other traffic): wait as told, then one more try
+                    retry_after = (e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta)
+                                   else e.retry_after)
+                    await asyncio.sleep(retry_after)
+                    next_send = loop.time() + interval
+                    await bot.send_message(chat_id=user_id, text=text)
+                result["sent"] += 1
+            except Exception as e:
+                logger.warning(f"Failed to send broadcast to {user_id}: {e}")
+                result["failed"] += 1
+    finally:
+        broadcast_running = False
+    return result
+
+async def _broadcast(context: ContextTypes.DEFAULT_TYPE, audience: str, user_ids, text: str) -> dict:
+    if config.SHARD_COUNT > 1:
+        return await sharding.broadcast(audience, text)
+    return await send_broadcast(context.bot, user_ids, text)
+
+def _unreachable_note(result: dict) -> str:
+    if not result.get("unreachable"):
+        return ""
+    shards = ", ".join(str(i) for i in result["unreachable"])
+    return f"\n⚠️ تعذر الوصول إلى الأجزاء (shards): {shards}"
+
+def cancel_local_broadcast():
     global broadcast_cancelled
-    
+    broadcast_cancelled = True
+
+def _in_background(context: ContextTypes.DEFAULT_TYPE, coroutine) -> asyncio.Task:
+    """Runs a long admin job (a broadcast, bulk decisions) outside the update
+    that started it. The update finishes right away, so a job that sends for
+    minutes does not count as an update stuck in flight (health.py), and it
+    does not hold the admin's chat or a concurrency slot."""
+    return context.application.create_task(coroutine)
+
+async def _broadcast_job(context: ContextTypes.DEFAULT_TYPE, message, audience: str, user_ids, text: str,
+                         done_text: str):
+    try:
+        result = await _broadcast(context, audience, user_ids, text)
+    except Exception as e:
+        logger.error(f"Broadcast to {audience} failed: {e}")
+        await message.reply_text(f"❌ فشل البث: {e}")
+        return
+    if result["cancelled"]:
+        await message.reply_text(
+            f"🛑 تم إيقاف البث!\n- أُرسلت إلى: {result['sent']}\n- فشل: {result['failed']}" + _unreachable_note(result)
+        )
+        return
+    await message.reply_text(done_text.format(**result) + _unreachable_note(result))
+
+def _start_broadcast(context: ContextTypes.DEFAULT_TYPE, message, audience: str, user_ids, text: str,
+                     done_text: str) -> bool:
+    """False if a broadcast started here is still running."""
+    global _broadcast_task
+    if _broadcast_task is not None and not _broadcast_task.done():
+        return False
+    _broadcast_task = _in_background(context, _broadcast_job(context, message, audience, user_ids, text, done_text))
+    return True
+
+@metrics.handler()
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # السماح فقط للأدمن
     if update.effective_user.id not in config.ADMIN_IDS:
         return
@@ -704,28 +988,16 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("الرجاء كتابة الرسالة بعد الأمر. مثال: `/broadcast أهلاً بكم`")
         return
 
-    known_users = utils.load_known_users()
-    sent_count = 0
-    failed_count = 0
-    broadcast_cancelled = False
+    known_users = BROADCAST_AUDIENCES["all"]()
 
+    started = _start_broadcast(context, update.message, "all", known_users, message_to_send,
+                               "📢 تم إرسال البث!\n\n- أُرسلت إلى: {sent} مستخدم\n- فشل الإرسال إلى: {failed} مستخدم")
+    if not started:
+        await update.message.reply_text("⏳ يوجد بث قيد الإرسال بالفعل. انتظر انتهاءه أو استخدم /cancel.")
+        return
     await update.message.reply_text(f"📢 جاري بدء البث إلى {len(known_users)} مستخدم...\nاستخدم /cancel لإيقاف البث.")
 
-    for user_id in known_users:
-        if broadcast_cancelled:
-            await update.message.reply_text(f"🛑 تم إيقاف البث!\n- أُرسلت إلى: {sent_count}\n- فشل: {failed_count}")
-            return
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message_to_send)
-            sent_count += 1
-        except Exception as e:
-            logger.warning(f"Failed to send broadcast to {user_id}: {e}")
-            failed_count += 1
-
-    await update.message.reply_text(
-        f"📢 تم إرسال البث!\n\n- أُرسلت إلى: {sent_count} مستخدم\n- فشل الإرسال إلى: {failed_count} مستخدم"
-    )
-
+@metrics.handler()
 async def broadcast_unpaid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Broadcasts a message only to users who haven't completed registration."""
     if update.effective_user.id not in config.ADMIN_IDS:
@@ -737,42 +1009,31 @@ async def broadcast_unpaid_command(update: Update, context: ContextTypes.DEFAULT
         return
 
     # Get target users
-    target_users = db.get_incomplete_users()
+    target_users = BROADCAST_AUDIENCES["unpaid"]()
     
     if not target_users:
         await update.message.reply_text("لا يوجد مستخدمين غير مكتملين لإرسال الرسالة لهم.")
         return
 
-    sent_count = 0
-    failed_count = 0
-    broadcast_cancelled = False
-
+    started = _start_broadcast(context, update.message, "unpaid", target_users, message_to_send,
+                               "📢 تم الإرسال بنجاح!\n\n- تم الوصول إلى: {sent} مستخدم محتمل\n- فشل: {failed}")
+    if not started:
+        await update.message.reply_text("⏳ يوجد بث قيد الإرسال بالفعل. انتظر انتهاءه أو استخدم /cancel.")
+        return
     await update.message.reply_text(f"📢 جاري إرسال العرض لـ {len(target_users)} مستخدم (غير مكتمل)...\nاستخدم /cancel لإيقاف البث.")
 
-    for user_id in target_users:
-        if broadcast_cancelled:
-            await update.message.reply_text(f"🛑 تم إيقاف البث!\n- أُرسلت إلى: {sent_count}\n- فشل: {failed_count}")
-            return
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message_to_send)
-            sent_count += 1
-        except Exception as e:
-            logger.warning(f"Failed to send broadcast to {user_id}: {e}")
-            failed_count += 1
-
-    await update.message.reply_text(
-        f"📢 تم الإرسال بنجاح!\n\n- تم الوصول إلى: {sent_count} مستخدم محتمل\n- فشل: {failed_count}"
-    )
-
+@metrics.handler()
 async def cancel_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel ongoing broadcast"""
-    global broadcast_cancelled
     if update.effective_user.id not in config.ADMIN_IDS:
         return
     
-    broadcast_cancelled = True
+    cancel_local_broadcast()
+    if config.SHARD_COUNT > 1:
+        await sharding.cancel_broadcast()
     await update.message.reply_text("🛑 جاري إيقاف البث...")
 
+@metrics.handler()
 async def admin_add_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Usage: /add_coupon CODE PERCENT [COURSE]"""
     if update.effective_user.id not in config.ADMIN_IDS:
@@ -799,6 +1060,7 @@ async def admin_add_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("خطأ في الصيغة.\nمثال: `/add_coupon SALE20 20`\nأو: `/add_coupon EXPERT50 50 expert`")
 
+@metrics.handler()
 async def admin_add_gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Usage: /add_gift CODE PERCENT [LIMIT] (Default 1)"""
     if update.effective_user.id not in config.ADMIN_IDS:
@@ -822,6 +1084,7 @@ async def admin_add_gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("خطأ في الصيغة. مثال: `/add_gift GL78 100 1`")
 
+@metrics.handler()
 async def admin_del_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Usage: /del_coupon CODE"""
     if update.effective_user.id not in config.ADMIN_IDS:
@@ -835,6 +1098,7 @@ async def admin_del_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.delete_coupon(code)
     await update.message.reply_text(f"🗑️ تم حذف الكوبون {code.upper()}")
 
+@metrics.handler()
 async def admin_list_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in config.ADMIN_IDS:
         return
@@ -855,6 +1119,7 @@ async def admin_list_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
 
+@metrics.handler()
 async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in config.ADMIN_IDS:
         return
@@ -873,19 +1138,71 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         for c_key, count in courses.items():
             if c_key == "unknown": continue
-            c_title = config.COURSES.get(c_key, {}).get("title", c_key)
+            c_title = catalog.current().course_title(c_key, c_key)
             msg += f"- {c_title}: **{count}**\n"
+
+    if config.SHARD_COUNT > 1:
+        # Registration counts come from the shared DB; runtime counters live in each shard
+        msg += "\n🧩 **الأجزاء (shards):**\n"
+        for index, shard in enumerate(await sharding.collect_stats()):
+            if shard is None:
+                msg += f"- shard {index}: ⚠️ لا يستجيب\n"
+                continue
+            busy = " 📢" if shard["broadcasting"] else ""
+            msg += (f"- shard {index}: {shard['known_users']} مستخدم، {shard['updates']} تحديث، "
+                    f"{shard['active_chats']} محادثة نشطة{busy}\n")
             
     await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
 
+@metrics.handler()
 async def admin_funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in config.ADMIN_IDS:
         return
 
-    funnel = db.get_funnel_stats()
+    # /funnel [N | Nh] [course] | /funnel now
+    args = list(context.args or [])
+    if args and args[0] == "now":
+        await _funnel_now(update)
+        return
+    days, hourly, course = 7, False, None
+    if args and args[0].rstrip("hH").isdigit():
+        hourly = args[0][-1] in "hH"
+        days = max(1, int(args.pop(0).rstrip("hH")))
+    if args:
+        course = args[0]
+
+    report = await asyncio.to_thread(funnel.report, days, course, hourly)
+    period = f"آخر {days} ساعة" if hourly else f"آخر {days} يوم"
+    msg = f"📉 **تحليل سلوك المستخدمين (Funnel)** - {period}\n\n"
+
+    if not report["stages"]:
+        msg += "- لا يوجد بيانات بعد.\n"
+        await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    msg += "🎯 **التحويل حسب الكورس** (بدأ ← أرسل الإيصال ← تمت الموافقة):\n"
+    if not report["conversion"]:
+        msg += "- لا يوجد تسجيلات بدأت في هذه الفترة.\n"
+    for c_key, conv in sorted(report["conversion"].items(), key=lambda x: x[1]["started"], reverse=True):
+        c_title = catalog.current().course_title(c_key, c_key)
+        msg += (f"- {c_title}: {conv['started']} ← {conv['submitted']} ← {conv['approved']} "
+                f"(**{conv['rate'] * 100:.0f}%**)\n")
+
+    msg += "\n📍 **المراحل** (دخلوا / غادروا / متوسط البقاء):\n"
+    for stage, row in sorted(report["stages"].items(), key=lambda x: x[1]["entered"], reverse=True):
+        avg = row["avg_seconds"]
+        stay = "-" if avg is None else (f"{avg / 60:.0f}د" if avg >= 60 else f"{avg:.0f}ث")
+        msg += f"- `{stage}`: **{row['entered']}** / {row['exited']} / {stay}\n"
+    msg += "\nالوضع الحالي: /funnel now"
+
+    await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+
+async def _funnel_now(update: Update):
+    """Where users are right now (a scan of the live states)."""
+    funnel_now = await asyncio.to_thread(db.get_funnel_stats)
     
     # Sort stages by logical order (approximate) could be complex, so just list them by count desc
-    sorted_stages = sorted(funnel.items(), key=lambda x: x[1], reverse=True)
+    sorted_stages = sorted(funnel_now.items(), key=lambda x: x[1], reverse=True)
     
     msg = f"📉 **تحليل سلوك المستخدمين (Funnel)**\n"
     msg += "أين يتوقف المستخدمون حالياً؟\n\n"
@@ -894,10 +1211,286 @@ async def admin_funnel_command(update: Update, context: ContextTypes.DEFAULT_TYP
         msg += "- لا يوجد بيانات بعد.\n"
     else:
         for stage, count in sorted_stages:
-            msg += f"📍 {stage}: **{count}**\n"
+            msg += f"📍 `{stage}`: **{count}**\n"
             
     await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
 
+@metrics.handler()
+async def admin_revenue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/revenue [today | yesterday | Nd | YYYY-MM | YYYY-MM-DD[..YYYY-MM-DD] | all]"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+
+    period = revenue.parse_range(context.args[0] if context.args else None)
+    if period is None:
+        await update.message.reply_text(
+            "الاستخدام: /revenue [today | yesterday | 7d | 2025-01 | 2025-01-01..2025-01-31 | all]")
+        return
+    first_day, last_day, label = period
+    report = await asyncio.to_thread(revenue.report, first_day, last_day)
+    total = report["total"]
+
+    msg = f"💰 <b>الإيرادات</b> - {_html.escape(label)}\n\n"
+    if not total["approvals"]:
+        msg += "- لا توجد طلبات مقبولة في هذه الفترة."
+        await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+        return
+
+    msg += f"✅ الطلبات المقبولة: <b>{total['approvals']}</b>\n"
+    msg += f"💵 الإجمالي بالدولار: <b>{total['usd']:,.2f}$</b>"
+    if total["unconverted"]:
+        msg += f" (+ {total['unconverted']} طلب بعملات بلا سعر صرف)"
+    msg += "\n\n🪙 <b>حسب العملة:</b>\n"
+    for currency, row in sorted(report["currencies"].items(), key=lambda x: x[1]["approvals"], reverse=True):
+        msg += f"- {_html.escape(currency or '؟')}: {row['amount']:,.0f} ({row['approvals']} طلب"
+        if row["discount"]:
+            msg += f"، خصومات {row['discount']:,.0f}"
+        msg += ")\n"
+    msg += "\n💳 <b>حسب طريقة الدفع:</b>\n"
+    for method_key, row in sorted(report["methods"].items(), key=lambda x: x[1]["approvals"], reverse=True):
+        msg += f"- {_html.escape(utils.payment_method_name(method_key) or '؟')}: {row['approvals']} طلب"
+        msg += f" ({row['usd']:,.2f}$)\n" if row["usd"] else "\n"
+    msg += "\n📚 <b>حسب الكورس:</b>\n"
+    for c_key, count in sorted(report["courses"].items(), key=lambda x: x[1], reverse=True):
+        msg += f"- {_html.escape(catalog.current().course_title(c_key, c_key or '؟'))}: {count}\n"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+
+FIND_STATUS = {"approved": "✅ مقبول", "rejected": "❌ مرفوض", "deleted": "🗑️ محذوف",
+               "completed": "⏳ بانتظار المراجعة", "start": "🆕 بدأ البوت"}
+
+@metrics.handler()
+async def admin_find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/find <name | email | phone | @username | details>: ranked registrations, finished ones included."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("الاستخدام: /find <اسم أو إيميل أو رقم واتساب أو يوزر>")
+        return
+    if not db.FTS_AVAILABLE:
+        await update.message.reply_text("❌ البحث غير متاح: نسخة SQLite على الخادم لا تدعم FTS5.")
+        return
+
+    matches = await asyncio.to_thread(db.search_registrations, query, 10)
+    if not matches:
+        await update.message.reply_text(f"🔍 لا توجد نتائج لـ «{query}».")
+        return
+
+    msg = f"🔍 <b>نتائج البحث عن</b> «{_html.escape(query)}»:\n"
+    for m in matches:
+        status = FIND_STATUS.get(m["stage"], f"📍 {m['stage']}")
+        when = datetime.datetime.fromtimestamp(m["updated_at"]).strftime("%Y-%m-%d %H:%M")
+        msg += (f"\n👤 <b>{_html.escape(m['name'] or '—')}</b> — <code>{m['user_id']}</code>\n"
+                f"   {_html.escape(catalog.current().course_title(m['course'], m['course'] or '—'))} · {status} · {when}\n")
+        contact = [c for c in (m["email"], m["whatsapp"],
+                               f"@{m['telegram_username']}" if m["telegram_username"] else "") if c]
+        if contact:
+            msg += f"   {_html.escape(' · '.join(contact))}\n"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+
+def _receipt_line(r: dict) -> str:
+    when = datetime.datetime.fromtimestamp(r["received_at"]).strftime("%Y-%m-%d %H:%M")
+    stored = f"📦 {max(1, (r['size'] or 0) // 1024)} KB" if r["content_hash"] else "⏳ لم يُؤرشف بعد"
+    request = f" · طلب <code>{_html.escape(r['request_id'])}</code>" if r["request_id"] else ""
+    return f"#{r['id']} · {when}{request} · {stored}"
+
+@metrics.handler()
+async def admin_receipt_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/receipt <user_id | request_id>: the archived receipts (newest in full, thumbnails of the rest)."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    if not context.args:
+        await update.message.reply_text("الاستخدام: /receipt <user_id أو رقم الطلب>")
+        return
+    key = context.args[0].strip()
+    if key.isdigit():
+        found = await asyncio.to_thread(db.get_receipts, user_id=int(key))
+    else:
+        found = await asyncio.to_thread(db.get_receipts, request_id=key)
+    if not found:
+        await update.message.reply_text(f"🧾 لا توجد إيصالات لـ «{key}».")
+        return
+
+    latest = found[0]
+    caption = f"🧾 <b>إيصالات</b> <code>{latest['user_id']}</code>:\n" + "\n".join(_receipt_line(r) for r in found)
+    path = receipts.archived_file(latest)
+    # From the archive; Telegram's copy only while the archiver hasn't got to it
+    if path:
+        with open(path, "rb") as f:
+            if latest["is_photo"]:
+                await update.message.reply_photo(photo=f, caption=caption, parse_mode=ParseMode.HTML)
+            else:
+                await update.message.reply_document(document=f, filename=os.path.basename(path),
+                                                    caption=caption, parse_mode=ParseMode.HTML)
+    elif latest["is_photo"]:
+        await update.message.reply_photo(photo=latest["file_id"], caption=caption, parse_mode=ParseMode.HTML)
+    else:
+        await update.message.reply_document(document=latest["file_id"], caption=caption, parse_mode=ParseMode.HTML)
+
+    thumbs = [(r, receipts.archived_file(r, thumb=True)) for r in found[1:]]
+    thumbs = [(r, p) for r, p in thumbs if p]
+    if len(thumbs) >= 2:
+        media = []
+        for r, p in thumbs[:10]:
+            with open(p, "rb") as f:
+                media.append(InputMediaPhoto(f.read(), caption=f"#{r['id']}"))
+        await update.message.reply_media_group(media=media)
+    elif thumbs:
+        with open(thumbs[0][1], "rb") as f:
+            await update.message.reply_photo(photo=f, caption=f"#{thumbs[0][0]['id']}")
+
+EXPORT_USAGE = ("الاستخدام: /export [registrations | approvals | coupons] [all | 7d | 2025-01 | 2025-01-01..2025-01-31] "
+                "[course=expert] [stage=awaiting_receipt] [parquet]")
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024   # Bot API upload limit
+
+@metrics.handler()
+async def admin_export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends a dataset as a gzipped CSV (or Parquet) document; see export.py."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+
+    dataset, period, fmt, course, stage = "registrations", revenue.parse_range("all"), "csv", None, None
+    for arg in context.args or []:
+        if arg in export.DATASETS:
+            dataset = arg
+        elif arg in ("csv", "parquet"):
+            fmt = arg
+        elif arg.startswith("course="):
+            course = arg.split("=", 1)[1]
+        elif arg.startswith("stage="):
+            stage = arg.split("=", 1)[1]
+        elif revenue.parse_range(arg):
+            period = revenue.parse_range(arg)
+        else:
+            await update.message.reply_text(EXPORT_USAGE)
+            return
+    if fmt == "parquet" and not export.parquet_available():
+        await update.message.reply_text("❌ تصدير Parquet يحتاج مكتبة pyarrow على الخادم. استخدم csv.")
+        return
+
+    flt = export.ExportFilter(period[0], period[1], course=course, stage=stage)
+    try:
+        result = await asyncio.to_thread(export.write_export, dataset, flt, fmt)
+    except Exception as e:
+        logger.error(f"Export of {dataset} failed: {e}")
+        await update.message.reply_text(f"❌ فشل التصدير: {e}")
+        return
+    try:
+        if result["size"] > MAX_DOCUMENT_BYTES:
+            await update.message.reply_text(
+                f"❌ الملف أكبر من حد تيليجرام ({result['size'] // (1024 * 1024)} MB). ضيّق الفترة أو أضف فلتراً.")
+            return
+        with open(result["path"], "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=result["filename"],
+                caption=f"📤 {dataset}: {result['rows']} صف ({period[2]})",
+            )
+    finally:
+        os.remove(result["path"])
+
+@metrics.handler()
+async def admin_backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Takes an online backup of bot_state.db now."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+
+    await update.message.reply_text("⏳ جاري أخذ نسخة احتياطية من قاعدة البيانات...")
+    try:
+        result = await asyncio.to_thread(backups.take_backup)
+    except backups.BackupBusy:
+        await update.message.reply_text("⚠️ هناك نسخة احتياطية قيد التنفيذ بالفعل، حاول بعد قليل.")
+        return
+    except Exception as e:
+        logger.error(f"Backup failed: {e}")
+        await update.message.reply_text(f"❌ فشل أخذ النسخة الاحتياطية: {e}")
+        return
+
+    msg = (f"💾 تم أخذ نسخة احتياطية\n"
+           f"📁 {result['path']}\n"
+           f"📦 الحجم: {result['size'] / 1024:.1f} KB (القاعدة {result['db_size'] / 1024:.1f} KB)\n"
+           f"⏱️ المدة: {result['seconds']:.2f} ث\n"
+           f"🗂️ النسخ المحفوظة: {len(backups.list_backups())}")
+    if result["removed"]:
+        msg += f" (تم حذف {result['removed']} قديمة)"
+    await update.message.reply_text(msg)
+
+@metrics.handler()
+async def admin_health_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Event-loop lag, in-flight updates and the latest blocking / slow-update reports."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+
+    snap = health.snapshot()
+    lag = health.lag_summary(300)
+    uptime = int(health.uptime())
+    msg = "🩺 <b>صحة البوت</b>"
+    if config.SHARD_COUNT > 1:
+        msg += f" (shard {config.SHARD_INDEX})"
+    msg += (f"\n\n{'⚠️ ' + _html.escape(snap['problem']) if snap['problem'] else '✅ لا توجد مشاكل حالياً'}\n"
+            f"⏱️ مدة التشغيل: {uptime // 3600}h {uptime % 3600 // 60}m\n"
+            f"🔁 تأخر الـ event loop (آخر 5 دقائق): متوسط {lag['avg_ms']}ms، p99 {lag['p99_ms']}ms، "
+            f"أقصى {lag['max_ms']}ms، توقفات ≥{config.SLOW_CALLBACK_SECONDS:g}s: {lag['stalls']}\n"
+            f"📨 تحديثات قيد المعالجة: {snap['in_flight']} (الأقدم {snap['oldest_update_s']}s)، "
+            f"إجمالي المعالَجة: {snap['updates']}\n")
+
+    events = health.recent_events(8)
+    if events:
+        msg += "\n🐢 <b>آخر البطء المسجّل:</b>\n"
+        for event in reversed(events):
+            when = datetime.datetime.fromtimestamp(event["at"]).strftime("%H:%M:%S")
+            kind = "توقف الـ loop" if event["kind"] == "blocked" else "تحديث بطيء"
+            msg += (f"- {when} {kind} {event['seconds']}s — <code>{_html.escape(str(event['handler']))}</code> "
+                    f"chat {event['chat_id']} stage {_html.escape(str(event['stage']))}\n"
+                    f"  ↳ <code>{_html.escape(event['where'])}</code>\n")
+    else:
+        msg += "\n✅ لم يُسجَّل أي بطء منذ بدء التشغيل."
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+
+@metrics.handler()
+async def admin_trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/trace <user_id> [trace_id]: the user's registration timeline, step by step."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    if not context.args:
+        await update.message.reply_text("الاستخدام: /trace <user_id>")
+        return
+    try:
+        user_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ رقم المستخدم غير صحيح.")
+        return
+    trace_id = context.args[1] if len(context.args) > 1 else None
+
+    trace = await asyncio.to_thread(tracing.timeline, user_id, trace_id)
+    if not trace["steps"]:
+        await update.message.reply_text(f"لا يوجد تتبّع مسجّل للمستخدم {user_id}.")
+        return
+
+    steps = trace["steps"]
+    first = steps[0]["started_at"]
+    total = steps[-1]["started_at"] + steps[-1]["duration_ms"] / 1000 - first
+    slowest = max(steps, key=lambda s: s["duration_ms"])
+    header = (f"🧭 <b>تتبّع التسجيل</b> <code>{trace['trace_id']}</code> للمستخدم <code>{user_id}</code>\n"
+              f"الخطوات: {len(steps)}، المدة من أول خطوة لآخرها: {total / 60:.1f} دقيقة\n"
+              f"🐢 أبطأ خطوة: <code>{_html.escape(slowest['name'])}</code> {slowest['duration_ms']:.0f}ms\n\n")
+    lines = []
+    for s in steps:
+        when = datetime.datetime.fromtimestamp(s["started_at"]).strftime("%m-%d %H:%M:%S")
+        mark = "✅" if s["status"] == "ok" else "❌"
+        lines.append(f"{mark} {when} <code>{_html.escape(s['name'])}</code> {s['duration_ms']:.0f}ms"
+                     + ("" if s["status"] == "ok" else f" ({_html.escape(s['status'])})"))
+        for sp in s["spans"]:
+            mark = "" if sp["status"] == "ok" else f" ❌ {_html.escape(sp['status'])}"
+            lines.append(f"    ↳ <code>{_html.escape(sp['name'])}</code> {sp['duration_ms']:.0f}ms{mark}")
+
+    # Newest steps matter most when the timeline doesn't fit one message
+    body = "\n".join(lines)
+    limit = 4000 - len(header)
+    if len(body) > limit:
+        body = "…\n" + body[-limit:].split("\n", 1)[-1]
+    await update.message.reply_text(header + body, parse_mode=ParseMode.HTML)
+
 # --- (11) JOBS (Abandoned Cart) ---
 async def check_abandoned_users_job(context: ContextTypes.DEFAULT_TYPE):
     """Job to check for inactive users and send reminders."""
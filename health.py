@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- BOT HEALTH ---
+# The bot measures its own event-loop lag and how long its oldest update has
+# been in flight, and every HEALTH_INTERVAL writes that to a heartbeat file
+# (BOT_HEALTH_FILE, set by cluster_runner.py). The heartbeat is written from
+# the event loop, so a stalled loop stops it: a stale heartbeat is a failure in
+# itself. Webhook mode serves the same snapshot on /healthz.
+#
+# Blocking calls (sync SQLite, Google clients) freeze every chat at once, so
+# two detectors name the culprit:
+#   - a watchdog thread notices the loop has not ticked for SLOW_CALLBACK_SECONDS
+#     and logs the loop thread's stack (the blocking frame) with the update it
+#     was serving: handler, chat_id, stage
+#   - updates in flight for longer than SLOW_HANDLER_SECONDS are logged with
+#     the await chain they are stuck in
+# Both land in recent_events() for the admin /health command.
+
+_state = {"loop_lag_ms": 0.0, "updates": 0, "last_update_at": None, "started_at": time.time()}
+_in_flight: Dict[object, Dict] = {}   # token -> {started, task, handler, chat_id, stage, reported}
+_heartbeat_task: Optional[asyncio.Task] = None
+_sampler_task: Optional[asyncio.Task] = None
+
+_lag_samples: deque = deque(maxlen=6000)   # (monotonic, lag seconds); ~10 minutes at 0.1s
+_events: deque = deque(maxlen=50)          # slow-callback / slow-update records, newest last
+_loop_thread_id: Optional[int] = None
+_last_tick: Optional[float] = None
+_stall: Optional[Dict] = None              # the blocked-loop event still in progress
+
+def describe_update(update) -> str:
+    """Which handler an update goes to (as registered in newbot.py)."""
+    query = getattr(update, "callback_query", None)
+    if query is not None:
+        return f"handle_callback:{(query.data or '').split('_', 1)[0]}"
+    message = getattr(update, "effective_message", None)
+    if message is None:
+        return "other"
+    if message.text and message.text.startswith("/"):
+        return message.text.split(maxsplit=1)[0].split("@")[0]
+    if message.text:
+        return "handle_text"
+    if message.photo or message.document:
+        return "handle_receipt"
+    return "other"
+
+def update_started(update=None) -> object:
+    token = object()
+    chat = getattr(update, "effective_chat", None)
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    _in_flight[token] = {
+        "started": time.monotonic(),
+        "task": task,
+        "handler": describe_update(update) if update is not None else "other",
+        "chat_id": chat.id if chat else None,
+        "stage": None,
+        "reported": False,
+    }
+    return token
+
+def update_finished(token: object):
+    _in_flight.pop(token, None)
+    _state["updates"] += 1
+    _state["last_update_at"] = time.time()
+
+def annotate(**fields):
+    """Adds details (e.g. stage) to the update the current task is serving."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return
+    for entry in list(_in_flight.values()):
+        if entry["task"] is task:
+            entry.update(fields)
+            return
+
+def uptime() -> float:
+    return time.time() - _state["started_at"]
+
+def in_flight() -> int:
+    return len(_in_flight)
+
+def snapshot() -> Dict:
+    now = time.monotonic()
+    oldest = max((now - entry["started"] for entry in list(_in_flight.values())), default=0.0)
+    snap = {
+        "pid": os.getpid(),
+        "at": time.time(),
+        "loop_lag_ms": round(_state["loop_lag_ms"], 1),
+        "in_flight": len(_in_flight),
+        "oldest_update_s": round(oldest, 1),
+        "updates": _state["updates"],
+        "last_update_at": _state["last_update_at"],
+    }
+    snap["problem"] = problem(snap)
+    return snap
+
+def problem(snap: Dict) -> Optional[str]:
+    if snap["loop_lag_ms"] > config.HEALTH_MAX_LAG * 1000:
+        return f"event loop lagging {snap['loop_lag_ms']:.0f}ms"
+    if snap["oldest_update_s"] > config.HEALTH_MAX_UPDATE_AGE:
+        return f"an update has been in flight for {snap['oldest_update_s']:.0f}s"
+    return None
+
+def _write_heartbeat(path: str, snap: Dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snap, f)
+    os.replace(tmp, path)   # the runner never sees a half-written file
+
+def max_lag(window: float) -> float:
+    """Worst loop lag (seconds) sampled in the last `window` seconds."""
+    since = time.monotonic() - window
+    return max((lag for at, lag in list(_lag_samples) if at >= since), default=0.0)
+
+def lag_summary(window: float = 300) -> Dict:
+    since = time.monotonic() - window
+    lags = sorted(lag for at, lag in list(_lag_samples) if at >= since)
+    if not lags:
+        return {"samples": 0, "avg_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0, "stalls": 0}
+    return {
+        "samples": len(lags),
+        "avg_ms": round(sum(lags) / len(lags) * 1000, 1),
+        "p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 1),
+        "max_ms": round(lags[-1] * 1000, 1),
+        "stalls": sum(1 for lag in lags if lag >= config.SLOW_CALLBACK_SECONDS),
+    }
+
+def recent_events(limit: int = 10) -> List[Dict]:
+    return list(_events)[-limit:]
+
+_OUR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _frame_line(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+def _stack_of_thread(thread_id: int) -> List:
+    """The thread's current frames, outermost first."""
+    frame = sys._current_frames().get(thread_id)
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1]
+
+def _await_chain(task: asyncio.Task) -> List:
+    """Where a suspended task is waiting: its coroutine's await chain, outermost first."""
+    frames, coro = [], task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+def _serving(task) -> Dict:
+    for entry in list(_in_flight.values()):
+        if task is not None and entry["task"] is task:
+            return entry
+    return {}
+
+def _record(kind: str, seconds: float, entry: Dict, frames: List) -> Dict:
+    stack = [_frame_line(f) for f in frames[-8:]]
+    ours = [f for f in frames if os.path.dirname(os.path.abspath(f.f_code.co_filename)) == _OUR_DIR]
+    event = {
+        "kind": kind,
+        "at": time.time(),
+        "seconds": round(seconds, 2),
+        "handler": entry.get("handler", "-"),
+        "chat_id": entry.get("chat_id"),
+        "stage": entry.get("stage"),
+        "where": _frame_line(ours[-1]) if ours else (stack[-1] if stack else "?"),
+    }
+    _events.append(event)
+    what = "Event loop blocked" if kind == "blocked" else "Slow update"
+    logger.warning(
+        f"🐢 {what} for {seconds:.2f}s: handler={event['handler']} chat_id={event['chat_id']} "
+        f"stage={event['stage']}\n    " + "\n    ".join(stack or ["(no stack)"])
+    )
+    return event
+
+def _watch_loop(loop: asyncio.AbstractEventLoop):
+    """Watchdog thread: reports a loop that stopped ticking, with the frame that holds it."""
+    global _stall
+    interval = config.LAG_SAMPLE_INTERVAL
+    reported_tick = None
+    while not loop.is_closed():
+        time.sleep(interval)
+        tick = _last_tick
+        if tick is None or tick == reported_tick:
+            continue
+        blocked = time.monotonic() - tick - interval
+        if blocked < config.SLOW_CALLBACK_SECONDS:
+            continue
+        reported_tick = tick
+        try:
+            task = asyncio.current_task(loop)
+        except RuntimeError:
+            task = None
+        _stall = _record("blocked", blocked, _serving(task), _stack_of_thread(_loop_thread_id))
+
+async def _sample_lag():
+    global _last_tick, _stall
+    loop = asyncio.get_running_loop()
+    interval = config.LAG_SAMPLE_INTERVAL
+    while True:
+        start = loop.time()
+        _last_tick = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        _lag_samples.append((time.monotonic(), lag))
+        if _stall is not None:
+            _stall["seconds"] = round(lag, 2)   # the stall's full length, now that it is over
+            _stall = None
+
+        now = time.monotonic()
+        for entry in list(_in_flight.values()):
+            age = now - entry["started"]
+            if age >= config.SLOW_HANDLER_SECONDS and not entry["reported"]:
+                entry["reported"] = True
+                task = entry["task"]
+                _record("slow", age, entry, _await_chain(task) if task is not None else [])
+
+async def _heartbeat():
+    interval = config.HEALTH_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        _state["loop_lag_ms"] = max_lag(interval) * 1000
+        if config.BOT_HEALTH_FILE:
+            try:
+                _write_heartbeat(config.BOT_HEALTH_FILE, snapshot())
+            except OSError as e:
+                logger.warning(f"Failed to write heartbeat: {e}")
+
+def start_heartbeat():
+    """Starts the lag monitor, slow-callback watchdog and heartbeat writer on the running event loop."""
+    global _heartbeat_task, _sampler_task, _loop_thread_id
+    loop = asyncio.get_running_loop()
+    if _sampler_task is None or _sampler_task.done():
+        _loop_thread_id = threading.get_ident()
+        _sampler_task = loop.create_task(_sample_lag())
+        threading.Thread(target=_watch_loop, args=(loop,), name="loop-watchdog", daemon=True).start()
+    if _heartbeat_task is None or _heartbeat_task.done():
+        _heartbeat_task = loop.create_task(_heartbeat())
+
+# --- RUNNER SIDE ---
+def read_heartbeat(path: str, max_age: float) -> Optional[str]:
+    """What is wrong with the bot behind `path`, or None if it is healthy."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            snap = json.load(f)
+    except (OSError, ValueError):
+        return "no heartbeat"
+    age = time.time() - snap.get("at", 0)
+    if age > max_age:
+        return f"heartbeat is {age:.0f}s old"
+    return snap.get("problem")
+
+class Backoff:
+    """Exponential restart delay: BACKOFF_BASE, 2x, 4x … up to BACKOFF_MAX,
+    forgotten once the process has stayed up for BACKOFF_RESET."""
+
+    def __init__(self):
+        self.failures = 0
+        self.not_before = 0.0
+        self.started_at = 0.0
+
+    def ready(self) -> bool:
+        return time.monotonic() >= self.not_before
+
+    def started(self):
+        self.started_at = time.monotonic()
+
+    def failed(self) -> float:
+        if self.started_at and time.monotonic() - self.started_at >= config.BACKOFF_RESET:
+            self.failures = 0
+        self.failures += 1
+        delay = min(config.BACKOFF_MAX, config.BACKOFF_BASE * 2 ** (self.failures - 1))
+        self.not_before = time.monotonic() + delay
+        return delay
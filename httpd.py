@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# --- MINIMAL ASYNC HTTP SERVER ---
+# Just enough HTTP/1.1 (keep-alive, Content-Length bodies) for the webhook,
+# health and metrics endpoints and the router → worker hop, without pulling in
+# a web framework. The webhook port is public, so a client gets
+# READ_TIMEOUT seconds to send a whole request (and IDLE_TIMEOUT between
+# keep-alive requests), lines are capped at MAX_LINE_BYTES and headers at
+# MAX_HEADERS; anything slower or bigger is answered and disconnected.
+
+MAX_BODY_BYTES = 2 * 1024 * 1024
+MAX_LINE_BYTES = 8 * 1024
+MAX_HEADERS = 100
+READ_TIMEOUT = 30.0
+IDLE_TIMEOUT = 75.0
+REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 408: "Request Timeout", 409: "Conflict", 413: "Payload Too Large",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class Request:
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+class Response:
+    def __init__(self, status: int = 200, body=b"", content_type: str = "text/plain; charset=utf-8"):
+        if isinstance(body, (dict, list)):
+            body, content_type = json.dumps(body, ensure_ascii=False), "application/json"
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.content_type = content_type
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+class HttpServer:
+    def __init__(self, max_body: int = MAX_BODY_BYTES, read_timeout: float = READ_TIMEOUT,
+                 idle_timeout: float = IDLE_TIMEOUT):
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = set()
+
+    def route(self, method: str, path: str, handler: Handler):
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self, host: str, port: int):
+        # `limit` bounds readline(): a longer line raises instead of buffering without end
+        self._server = await asyncio.start_server(self._serve_connection, host, port, limit=MAX_LINE_BYTES)
+        logger.info(f"HTTP server listening on {host}:{port}")
+
+    async def stop(self):
+        """Stops accepting new connections and closes the open (keep-alive) ones."""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        for writer in list(self._connections):
+            writer.close()
+        self._server = None
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write(writer, request, keep_alive=False)
+                    break
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self._write(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """A Request, a Response to send before closing (bad / too big / too slow), or None (closed)."""
+        try:
+            # An idle keep-alive connection is simply closed
+            request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ValueError:   # longer than MAX_LINE_BYTES
+            return Response(400, "request line too long")
+        if not request_line:
+            return None
+        try:
+            return await asyncio.wait_for(self._read_rest(reader, request_line), self.read_timeout)
+        except asyncio.TimeoutError:
+            return Response(408, REASONS[408])
+        except ValueError:
+            return Response(431, "header line too long")
+
+    async def _read_rest(self, reader: asyncio.StreamReader, request_line: bytes):
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return Response(400, "bad request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                return Response(431, "too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            return Response(400, "bad content-length")
+        if length < 0:
+            return Response(400, "bad content-length")
+        if length > self.max_body:
+            return Response(413, "body too large")
+        body = await reader.readexactly(length) if length else b""
+        return Request(method.upper(), target, headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self.routes)
+            return Response(405 if known_path else 404, REASONS[405 if known_path else 404])
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"HTTP handler for {request.method} {request.path} failed: {e}")
+            return Response(500, REASONS[500])
+
+    async def _write(self, writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + response.body)
+        # A client that stops reading can't hold the connection (and its buffer) forever
+        await asyncio.wait_for(writer.drain(), self.read_timeout)
+
+class HttpClient:
+    """Keep-alive client for plain-HTTP calls between our own processes."""
+
+    def __init__(self, timeout: Optional[float] = 10, pool_size: int = 32):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle: Dict[Tuple[str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+
+    async def request(self, method: str, url: str, body: bytes = b"", headers: Dict[str, str] = None,
+                      timeout: Optional[float] = ...) -> Tuple[int, bytes]:
+        """Returns (status, body). `timeout=None` waits indefinitely."""
+        timeout = self.timeout if timeout is ... else timeout
+        parts = urlsplit(url)
+        key = (parts.hostname, parts.port or 80)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        head = f"{method.upper()} {target} HTTP/1.1\r\nHost: {parts.netloc}\r\nContent-Length: {len(body)}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items()) + "\r\n"
+        payload = head.encode("latin-1") + body
+
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            reader, writer = idle.pop() if idle else await asyncio.wait_for(asyncio.open_connection(*key), timeout)
+            try:
+                status, response_body, keep_alive = await asyncio.wait_for(
+                    self._exchange(reader, writer, payload), timeout
+                )
+            except (_StaleConnection, ConnectionError) as e:
+                writer.close()
+                if reused:
+                    continue  # the server closed an idle keep-alive connection before reading it
+                if isinstance(e, ConnectionError):
+                    raise
+                raise ConnectionError(f"{url}: connection closed without a response")
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive and len(self._idle.setdefault(key, [])) < self.pool_size:
+                self._idle[key].append((reader, writer))
+            else:
+                writer.close()
+            return status, response_body
+
+    async def _exchange(self, reader, writer, payload: bytes):
+        writer.write(payload)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise _StaleConnection()
+        status = int(status_line.split(b" ", 2)[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        body = await reader.readexactly(length) if length else b""
+        return status, body, headers.get("connection", "").lower() != "close"
+
+    async def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+class _StaleConnection(Exception):
+    pass
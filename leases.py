@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import sqlite3
+import asyncio
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+import httpd
+
+# --- LEADER LEASES ---
+# A lease is (holder, version) stored somewhere every node can reach. All
+# writes are compare-and-set on the version, so two nodes can never both win
+# the same round. Expiry is NOT judged from timestamps in the store (clocks on
+# different machines disagree): a contender remembers when it first saw a
+# version on its own monotonic clock, and the lease is expired once that
+# version stays unchanged for a full TTL (see cluster_runner.py).
+
+# Where the lease lives (read by cluster_runner.py and by the bot's fencing
+# watchdog, which inherits the runner's environment):
+#   sheet  → the Google Sheet lock (default, as before; needs minutes-long timings)
+#   server → a `python leases.py serve` instance at LEASE_SERVER_URL
+#   sqlite → LEASE_DB_FILE, only safe when every node runs on the same host:
+#            SQLite locking over a network filesystem (NFS, SMB, most cloud
+#            shares) is unreliable, and two nodes could both win the lease
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "sheet").strip().lower()
+LEASE_NAME = os.getenv("LEASE_NAME", "payment-bot")
+LEASE_DB_FILE = os.getenv("LEASE_DB_FILE", "leader_lease.db")
+LEASE_SERVER_URL = os.getenv("LEASE_SERVER_URL", "http://127.0.0.1:9300")
+# The lease server's table is saved here on every change, so a restarted
+# server never hands out versions (fencing tokens) it already used
+LEASE_SERVER_STATE = os.getenv("LEASE_SERVER_STATE", "lease_server.json")
+
+SHEET_NAME = os.getenv("LEADER_SHEET_NAME", "BotLeaderLock")  # Google Sheet
+SHEET_TAB = os.getenv("LEADER_SHEET_TAB", "Sheet1")           # usually "Sheet1"
+SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "credentials.json")
+
+class Lease(NamedTuple):
+    holder: str     # "" = free
+    version: int    # bumped by every acquire / renew / release
+
+class LeaseBackend:
+    def read(self) -> Lease:
+        raise NotImplementedError
+
+    def compare_and_set(self, expected_version: int, holder: str, new_version: int = None) -> Optional[Lease]:
+        """Writes `holder` (version + 1, or `new_version` to jump ahead) only if the
+        stored version is still `expected_version`. Returns the new lease, or None
+        if someone else wrote first."""
+        raise NotImplementedError
+
+# --- SQLITE (one host only; see LEASE_BACKEND) ---
+class SQLiteLeaseBackend(LeaseBackend):
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL DEFAULT '',
+                    version INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO leases (name) VALUES (?)", (name,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Rollback journal (not WAL): WAL needs shared memory, which network filesystems lack
+        return sqlite3.connect(self.path, timeout=2)
+
+    def read(self) -> Lease:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT holder, version FROM leases WHERE name = ?", (self.name,)).fetchone()
+        finally:
+            conn.close()
+        return Lease(*row) if row else Lease("", 0)
+
+    def compare_and_set(self, expected_version: int, holder: str, new_version: int = None) -> Optional[Lease]:
+        new_version = new_version or expected_version + 1
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE leases SET holder = ?, version = ?, updated_at = ? WHERE name = ? AND version = ?",
+                (holder, new_version, datetime.now(timezone.utc).isoformat(), self.name, expected_version),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return Lease(holder, new_version) if cursor.rowcount == 1 else None
+
+# --- LEASE SERVER (`python leases.py serve`) ---
+class LeaseServer:
+    """Lease table behind HTTP; CAS is atomic because the event loop is single-threaded.
+    Every change is written to `state_file` before it is acknowledged."""
+
+    def __init__(self, state_file: str = None):
+        self.state_file = state_file
+        self.leases = {}
+        if state_file and os.path.exists(state_file):
+            with open(state_file, encoding="utf-8") as f:
+                self.leases = {name: Lease(*lease) for name, lease in json.load(f).items()}
+        self.http = httpd.HttpServer()
+        self.http.route("GET", "/lease", self.get_lease)
+        self.http.route("POST", "/lease", self.set_lease)
+
+    def _lease(self, name: str) -> Lease:
+        return self.leases.get(name, Lease("", 0))
+
+    async def get_lease(self, request: httpd.Request) -> httpd.Response:
+        return httpd.Response(200, self._lease(request.query.get("name", ""))._asdict())
+
+    async def set_lease(self, request: httpd.Request) -> httpd.Response:
+        body = request.json()
+        current = self._lease(body["name"])
+        if current.version != body["expected_version"]:
+            return httpd.Response(409, current._asdict())
+        new_version = body.get("new_version") or current.version + 1
+        self.leases[body["name"]] = Lease(body["holder"], new_version)
+        self._save()
+        return httpd.Response(200, self.leases[body["name"]]._asdict())
+
+    def _save(self):
+        if not self.state_file:
+            return
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({name: list(lease) for name, lease in self.leases.items()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_file)
+
+    async def serve(self, host: str, port: int):
+        await self.http.start(host, port)
+        await asyncio.Event().wait()
+
+class HttpLeaseBackend(LeaseBackend):
+    def __init__(self, url: str, name: str, timeout: float = 2):
+        self.url = url.rstrip("/") + "/lease"
+        self.name = name
+        self.timeout = timeout
+
+    def read(self) -> Lease:
+        query = urllib.parse.urlencode({"name": self.name})
+        with urllib.request.urlopen(f"{self.url}?{query}", timeout=self.timeout) as resp:
+            return Lease(**json.load(resp))
+
+    def compare_and_set(self, expected_version: int, holder: str, new_version: int = None) -> Optional[Lease]:
+        body = json.dumps({"name": self.name, "expected_version": expected_version, "holder": holder,
+                           "new_version": new_version})
+        request = urllib.request.Request(
+            self.url, data=body.encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+                return Lease(**json.load(resp))
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                return None
+            raise
+
+# --- GOOGLE SHEET (the original lock; slow, so only with long TTLs) ---
+class SheetLeaseBackend(LeaseBackend):
+    """Row 2 holds leader_id | heartbeat_utc | note | version. Sheets has no
+    CAS, so a write is read back to confirm it won; a racing writer can still
+    slip in between, which the long TTLs make unlikely."""
+
+    def __init__(self, sheet_name: str, tab: str, service_account_file: str):
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+
+        scope = ['https://spreadsheets.google.com/feeds',
+                 'https://www.googleapis.com/auth/drive']
+        creds = ServiceAccountCredentials.from_json_keyfile_name(service_account_file, scope)
+        sh = gspread.authorize(creds).open(sheet_name)
+        try:
+            self.ws = sh.worksheet(tab)
+        except gspread.WorksheetNotFound:
+            self.ws = sh.add_worksheet(title=tab, rows=10, cols=5)
+            self.ws.update("A1:D1", [["leader_id", "heartbeat_utc", "note", "version"]])
+
+    def read(self) -> Lease:
+        vals = self.ws.get_values("A2:D2")
+        row = vals[0] if vals else []
+        holder = row[0] if len(row) > 0 else ""
+        try:
+            version = int(row[3]) if len(row) > 3 and row[3] else 0
+        except ValueError:
+            version = 0
+        return Lease(holder, version)
+
+    def compare_and_set(self, expected_version: int, holder: str, new_version: int = None) -> Optional[Lease]:
+        if self.read().version != expected_version:
+            return None
+        new_version = new_version or expected_version + 1
+        heartbeat = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        note = "leader alive" if holder else "released"
+        self.ws.update("A2:D2", [[holder, heartbeat, note, new_version]])
+        lease = Lease(holder, new_version)
+        return lease if self.read() == lease else None
+
+def from_env() -> LeaseBackend:
+    if LEASE_BACKEND == "sqlite":
+        return SQLiteLeaseBackend(LEASE_DB_FILE, LEASE_NAME)
+    if LEASE_BACKEND == "server":
+        return HttpLeaseBackend(LEASE_SERVER_URL, LEASE_NAME)
+    if LEASE_BACKEND == "sheet":
+        return SheetLeaseBackend(SHEET_NAME, SHEET_TAB, SERVICE_ACCOUNT_FILE)
+    raise ValueError(f"Unknown LEASE_BACKEND {LEASE_BACKEND!r} (sqlite | server | sheet)")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["serve"]:
+        sys.exit("usage: python leases.py serve   (LEASE_SERVER_HOST / LEASE_SERVER_PORT)")
+    host = os.getenv("LEASE_SERVER_HOST", "0.0.0.0")
+    port = int(os.getenv("LEASE_SERVER_PORT", "9300"))
+    print(f"Lease server listening on {host}:{port}")
+    try:
+        asyncio.run(LeaseServer(LEASE_SERVER_STATE).serve(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,230 @@
+import time
+import asyncio
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+import config
+import httpd
+
+logger = logging.getLogger(__name__)
+
+# --- METRICS ---
+# Counters, latency histograms and gauges in the Prometheus text format on
+# GET /metrics: on the webhook server in webhook mode, on
+# METRICS_LISTEN:METRICS_PORT in polling mode. Code is instrumented with
+#   @metrics.handler()          bot handlers  → bot_handler_duration_seconds{handler}
+#   @metrics.timed("db")        any function  → db_duration_seconds{name}
+#   with metrics.timer(...):    a block (e.g. one Bot API request)
+#   metrics.count(...)          plain events (retries, sends…)
+# Every timed call that raises also counts <family>_errors_total{…, error}.
+# With METRICS_ENABLED=0 the decorators return the function unchanged and the
+# helpers return immediately, so instrumented code costs nothing extra.
+
+ENABLED = config.METRICS_ENABLED
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, labels: LabelKey, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(labels)} {value:g}"
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values: Dict[LabelKey, list] = {}   # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, labels: LabelKey, value: float):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+                break
+        else:
+            row[len(self.buckets)] += 1
+        row[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, row in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), row):
+                cumulative += n
+                yield f"{self.name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {row[-1]:.6f}"
+            yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+
+_metrics: Dict[str, object] = {}
+_gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+# Labels a handler adds about itself while it runs (see label())
+_handler_labels: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("handler_labels", default=None)
+
+def _format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+def counter(name: str, help_text: str) -> Counter:
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = Counter(name, help_text)
+    return metric
+
+def histogram(name: str, help_text: str) -> Histogram:
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = Histogram(name, help_text)
+    return metric
+
+def gauge(name: str, help_text: str, read: Callable[[], float]):
+    """A value read at scrape time (queue depths, in-flight counts)."""
+    if ENABLED:
+        _gauges[name] = (help_text, read)
+
+def count(metric: str, amount: float = 1, **labels):
+    # Not `name`: that is a label of its own (count("db_retries_total", name=...))
+    if ENABLED:
+        counter(metric, metric.replace("_", " ")).inc(tuple(sorted(labels.items())), amount)
+
+def label(**labels):
+    """Adds labels to the running @handler's observation (e.g. handle_text's stage)."""
+    if ENABLED:
+        current = _handler_labels.get()
+        if current is not None:
+            current.update(labels)
+
+class _Timing:
+    def __init__(self, family: str, help_text: str):
+        self.duration = histogram(f"{family}_duration_seconds", help_text)
+        self.errors = counter(f"{family}_errors_total", f"{family} calls that raised")
+
+    def record(self, labels: LabelKey, started: float, error: Optional[BaseException]):
+        self.duration.observe(labels, time.perf_counter() - started)
+        if error is not None:
+            self.errors.inc(labels + (("error", type(error).__name__),))
+
+def _instrument(fn, family: str, help_text: str, labels: LabelKey, labels_fn=None, scoped=False):
+    timing = _Timing(family, help_text)
+
+    def _labels(args, kwargs, extra) -> LabelKey:
+        if labels_fn is not None:
+            try:
+                extra = {**labels_fn(*args, **kwargs), **extra}
+            except Exception:
+                pass
+        return labels + tuple(sorted((k, str(v)) for k, v in extra.items()))
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            extra = {}
+            token = _handler_labels.set(extra) if scoped else None
+            started, error = time.perf_counter(), None
+            try:
+                return await fn(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                if token is not None:
+                    _handler_labels.reset(token)
+                timing.record(_labels(args, kwargs, extra), started, error)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started, error = time.perf_counter(), None
+            try:
+                return fn(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                timing.record(_labels(args, kwargs, {}), started, error)
+    return wrapper
+
+def timed(family: str, name: str = None):
+    """Decorator: latency histogram + error counter under <family>_…{name}."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        return _instrument(fn, family, f"{family} call latency", (("name", name or fn.__name__),))
+    return decorate
+
+def handler(name: str = None, labels: Callable[..., Dict[str, str]] = None):
+    """Decorator for bot handlers; `labels(update, context)` adds labels (e.g. the callback action)."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        return _instrument(fn, "bot_handler", "Handler latency", (("handler", name or fn.__name__),),
+                           labels_fn=labels, scoped=True)
+    return decorate
+
+@contextmanager
+def timer(family: str, name: str):
+    if not ENABLED:
+        yield
+        return
+    timing = _Timing(family, f"{family} call latency")
+    started, error = time.perf_counter(), None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        timing.record((("name", name),), started, error)
+
+# --- EXPOSITION ---
+def render() -> str:
+    lines = []
+    for metric in list(_metrics.values()):
+        lines.extend(metric.render())
+    for name, (help_text, read) in list(_gauges.items()):
+        try:
+            value = read()
+        except Exception as e:
+            logger.warning(f"Gauge {name} failed: {e}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(request: httpd.Request) -> httpd.Response:
+    return httpd.Response(200, render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def add_route(server: httpd.HttpServer):
+    if ENABLED:
+        server.route("GET", "/metrics", serve_metrics)
+
+async def start_server() -> Optional[httpd.HttpServer]:
+    """Polling mode: /metrics on its own port (webhook mode adds the route to the webhook server)."""
+    if not ENABLED or config.METRICS_PORT <= 0:
+        return None
+    server = httpd.HttpServer()
+    add_route(server)
+    try:
+        await server.start(config.METRICS_LISTEN, config.METRICS_PORT)
+    except OSError as e:
+        logger.error(f"Can't serve /metrics on port {config.METRICS_PORT}: {e}")
+        return None
+    return server
@@ -1,7 +1,24 @@
-﻿import logging
+﻿import time
+_BOOT_START = time.perf_counter()
+
+import asyncio
+import logging
 import config
-import handlers
-import db
+import utils
+import catalog
+import chat_processor
+import webhook
+import sharding
+import fencing
+import standby
+import health
+import backups
+import metrics
+import tracing
+import funnel
+import receipts
+handlers = utils.timed_import("handlers")
+db = utils.timed_import("db")
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -16,15 +33,50 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def post_init(app):
+    """Runs right before polling starts; Google imports are warmed off the event loop."""
+    if config.PREWARM_GOOGLE_IMPORTS:
+        asyncio.get_running_loop().run_in_executor(None, utils.prewarm_google_imports)
+    health.start_heartbeat()
+    backups.start_scheduler()
+    tracing.start_flusher()
+    funnel.start_scheduler()
+    receipts.start_worker(app.bot)
+    metrics.gauge("bot_update_queue_depth", "Updates received but not yet picked up", app.update_queue.qsize)
+    metrics.gauge("bot_updates_in_flight", "Updates being processed", health.in_flight)
+    if isinstance(app.update_processor, chat_processor.PerChatUpdateProcessor):
+        metrics.gauge("bot_active_chats", "Chats with updates in flight", lambda: app.update_processor.active_chats)
+    if config.BOT_MODE != "webhook":
+        await metrics.start_server()  # webhook mode serves /metrics on the webhook server
+    standby.report_ready()
+
 def main():
     if not config.BOT_TOKEN:
         logger.error("No BOT_TOKEN found in config!")
         return
     
     # Initialize DB
+    db_start = time.perf_counter()
     db.init_db()
+    db_ms = (time.perf_counter() - db_start) * 1000
+
+    # Compile the course/FAQ catalog up front and hot-reload it on file changes
+    catalog.load()
+    catalog.start_watcher()
 
-    app = ApplicationBuilder().token(config.BOT_TOKEN).build()
+    builder = ApplicationBuilder().token(config.BOT_TOKEN).post_init(post_init)
+    if config.TELEGRAM_API_BASE_URL:
+        base = config.TELEGRAM_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(base).base_file_url(base.replace("/bot", "/file/bot", 1))
+    if fencing.enabled() or config.BOT_STANDBY or metrics.ENABLED or tracing.ENABLED:
+        # Every Bot API call, getUpdates included, checks the token first (and is timed / traced)
+        builder = builder.request(fencing.FencedRequest(connection_pool_size=256))
+        builder = builder.get_updates_request(fencing.FencedRequest())
+    if config.CONCURRENT_UPDATES > 0:
+        # Parallel across chats, ordered within a chat
+        builder = builder.concurrent_updates(
+            chat_processor.PerChatUpdateProcessor(config.CONCURRENT_UPDATES, config.MAX_QUEUED_UPDATES))
+    app = builder.build()
 
     # Handlers from handlers.py
     app.add_handler(CommandHandler("start", handlers.start_command))
@@ -37,6 +89,15 @@ def main():
     app.add_handler(CommandHandler("del_coupon", handlers.admin_del_coupon))
     app.add_handler(CommandHandler("coupons", handlers.admin_list_coupons))
     app.add_handler(CommandHandler("cancel", handlers.cancel_broadcast_command))
+    app.add_handler(CommandHandler("backup", handlers.admin_backup_command))
+    app.add_handler(CommandHandler("health", handlers.admin_health_command))
+    app.add_handler(CommandHandler("trace", handlers.admin_trace_command))
+    app.add_handler(CommandHandler("revenue", handlers.admin_revenue_command))
+    app.add_handler(CommandHandler("export", handlers.admin_export_command))
+    app.add_handler(CommandHandler("find", handlers.admin_find_command))
+    app.add_handler(CommandHandler("receipt", handlers.admin_receipt_command))
+    app.add_handler(CommandHandler("pending", handlers.admin_pending_command))
+    app.add_handler(CommandHandler("bulk", handlers.admin_bulk_command))
     app.add_handler(CallbackQueryHandler(handlers.handle_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_text))
     app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, handlers.handle_receipt))
@@ -45,8 +106,31 @@ def main():
     # job_queue = app.job_queue
     # job_queue.run_repeating(handlers.check_abandoned_users_job, interval=3600, first=60)
 
+    ready_ms = (time.perf_counter() - _BOOT_START) * 1000
+    logger.info(utils.format_import_report("Startup imports"))
+    logger.info(f"⏱️ Startup: db init {db_ms:.0f}ms, ready to serve after {ready_ms:.0f}ms")
+
+    if config.BOT_STANDBY:
+        standby.prewarm()
+        standby.wait_for_promotion()
+
+    # Under cluster_runner: refuse to start if a newer leadership term exists
+    try:
+        fencing.claim()
+    except fencing.StaleFencingToken as e:
+        logger.error(f"Not starting: {e}")
+        raise SystemExit(standby.STALE_TOKEN_EXIT)
+    fencing.start_watchdog()
+
     print("🤖 Bot (Refactored) is running...")
-    app.run_polling()
+    if config.BOT_MODE == "webhook":
+        server = webhook.WebhookServer(app)
+        if config.SHARD_COUNT > 1:
+            sharding.add_worker_routes(server)
+            logger.info(f"Serving shard {config.SHARD_INDEX} of {config.SHARD_COUNT}")
+        webhook.run_webhook(server)
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
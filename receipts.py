@@ -0,0 +1,143 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from telegram.constants import ParseMode
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+# --- RECEIPT ARCHIVE / DUPLICATES ---
+# handle_receipt records every receipt in the `receipts` table with Telegram's
+# file_unique_id, which is the same for the same file whoever forwards it. A
+# background worker then downloads new receipts (and Telegram's thumbnail of
+# them) into RECEIPT_ARCHIVE_DIR, content-addressed:
+#   <dir>/ab/cd/abcd…<ext>      (sha256 of the bytes; the same bytes are stored once)
+# and records the hash, which also catches a screenshot saved and uploaded
+# again. Both are indexed, so forward_to_admin flags matches in the admin
+# caption with two lookups; a match found only after the request was
+# forwarded is sent as a reply to the admins' copies. /receipt reads the
+# archive, so the evidence outlives the registration state.
+
+MAX_HASH_ATTEMPTS = 3
+THUMB_EXT = ".jpg"   # Telegram thumbnails are JPEG
+_SAFE_EXT = re.compile(r"\.[a-z0-9]{1,8}")
+
+def receipt_ext(file_name: Optional[str], mime_type: Optional[str], is_photo: bool) -> str:
+    """The archive file extension for a received photo / document."""
+    if is_photo:
+        return ".jpg"
+    ext = os.path.splitext(file_name or "")[1].lower()
+    if not _SAFE_EXT.fullmatch(ext):
+        ext = {"application/pdf": ".pdf", "image/png": ".png", "image/jpeg": ".jpg"}.get(mime_type, ".bin")
+    return ext
+
+def archive_path(content_hash: str, ext: str) -> str:
+    return os.path.join(config.RECEIPT_ARCHIVE_DIR, content_hash[:2], content_hash[2:4], content_hash + (ext or ""))
+
+def store(data: bytes, ext: str) -> str:
+    """Writes the bytes to the archive unless already there; returns their hash (blocking)."""
+    content_hash = hashlib.sha256(data).hexdigest()
+    path = archive_path(content_hash, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)   # readers never see a half-written file
+    return content_hash
+
+def archived_file(receipt: Dict, thumb: bool = False) -> Optional[str]:
+    """Path of an archived receipt (or its thumbnail), None if not archived (yet)."""
+    content_hash = receipt.get("thumb_hash") if thumb else receipt.get("content_hash")
+    if not content_hash:
+        return None
+    path = archive_path(content_hash, THUMB_EXT if thumb else receipt.get("ext"))
+    return path if os.path.exists(path) else None
+
+_task: Optional[asyncio.Task] = None
+
+def warning_html(duplicates: Optional[List[Dict]]) -> str:
+    """The caption block for the duplicates of a receipt ("" when there are none)."""
+    if not duplicates:
+        return ""
+    text = "\n⚠️ <b>إيصال مكرر محتمل! نفس الإيصال أُرسل من قبل:</b>\n"
+    for d in duplicates:
+        kind = "نفس الملف" if d["match"] == "file" else "نفس المحتوى"
+        when = datetime.fromtimestamp(d["received_at"]).strftime("%Y-%m-%d %H:%M")
+        text += f"- <code>{d['user_id']}</code> · {when} · {kind}\n"
+    return text
+
+async def _archive(bot, file_id: str, ext: str) -> Tuple[str, int]:
+    tg_file = await bot.get_file(file_id)
+    data = bytes(await tg_file.download_as_bytearray())
+    return await asyncio.to_thread(store, data, ext), len(data)
+
+async def _flag_late(bot, receipt_id: int, user_id: int):
+    """Tells the admins about content matches of a receipt that was already forwarded."""
+    duplicates = await asyncio.to_thread(db.find_duplicate_receipts, receipt_id)
+    if not any(d["match"] == "content" for d in duplicates):
+        return
+    state = await asyncio.to_thread(db.get_user_state, user_id)
+    if state.get("receipt_id") != receipt_id or not state.get("admin_messages"):
+        return   # decided already, or forward_to_admin has not run yet (it will look them up)
+
+    def _store(s):
+        if s.get("receipt_id") != receipt_id:
+            return False
+        s["receipt_duplicates"] = duplicates
+    await asyncio.to_thread(db.mutate_user_state, user_id, _store)
+
+    text = f"🔁 المستخدم <code>{user_id}</code>:" + warning_html(duplicates)
+    for admin_id, message_id, _ in state["admin_messages"]:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text, parse_mode=ParseMode.HTML, reply_to_message_id=message_id)
+        except Exception as e:
+            logger.warning(f"Failed to flag duplicate receipt to admin {admin_id}: {e}")
+
+async def archive_pending(bot) -> int:
+    """Archives one batch of new receipts; returns how many were tried."""
+    rows = await asyncio.to_thread(db.get_unhashed_receipts, config.RECEIPT_HASH_BATCH, MAX_HASH_ATTEMPTS)
+    for receipt_id, user_id, file_id, ext, thumb_file_id in rows:
+        digest = size = thumb_hash = None
+        try:
+            digest, size = await _archive(bot, file_id, ext or ".bin")
+        except Exception as e:
+            logger.warning(f"Could not download receipt {receipt_id} of {user_id}: {e}")
+        if digest and thumb_file_id:
+            try:
+                thumb_hash, _ = await _archive(bot, thumb_file_id, THUMB_EXT)
+            except Exception as e:
+                logger.warning(f"Could not download the thumbnail of receipt {receipt_id}: {e}")
+        await asyncio.to_thread(db.set_receipt_hash, receipt_id, digest, size, thumb_hash)
+        if digest:
+            try:
+                await _flag_late(bot, receipt_id, user_id)
+            except Exception as e:
+                logger.error(f"Duplicate check of receipt {receipt_id} failed: {e}")
+    return len(rows)
+
+async def _hash_forever(bot):
+    while True:
+        await asyncio.sleep(config.RECEIPT_HASH_INTERVAL)
+        try:
+            while await archive_pending(bot) >= config.RECEIPT_HASH_BATCH:
+                pass
+        except Exception as e:
+            logger.error(f"Receipt archiving failed: {e}")
+
+def start_worker(bot):
+    """Starts the background archiver on the running event loop (one process per deployment)."""
+    global _task
+    if config.RECEIPT_HASH_INTERVAL <= 0 or (config.SHARD_COUNT > 1 and config.SHARD_INDEX != 0):
+        return
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_hash_forever(bot))
@@ -0,0 +1,213 @@
+import logging
+from typing import Callable, Dict, FrozenSet, NamedTuple, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+# --- REGISTRATION STATE MACHINE ---
+# Every text-driven stage maps to a Stage: `validate` parses the message (raising
+# InvalidInput to re-ask without touching state), `apply` mutates the state and
+# returns the Transition, `next` lists the stages it may move to. Entry prompts
+# are keyed by the stage being entered; the payment menu / admin hand-off are
+# wired in handlers.STAGE_ACTIONS.
+
+PAYMENT_CHOICE = "awaiting_payment_choice"
+COMPLETED = "completed"
+
+CONFIRM_WORDS = ["موافق", "ok", "تمام", "نعم", "yes"]
+
+SKIP_COUPON_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("⏭️ تخطي والمتابعة", callback_data="skip_coupon")]])
+
+class InvalidInput(Exception):
+    def __init__(self, message: str, reply_markup=None):
+        super().__init__(message)
+        self.message = message
+        self.reply_markup = reply_markup
+
+class Transition(NamedTuple):
+    stage: str
+    message: Optional[str] = None   # sent before the entry prompt of `stage`
+    prompt: bool = True             # False → `message` replaces the entry prompt
+
+class Stage(NamedTuple):
+    apply: Callable[[object, Dict], Transition]
+    next: FrozenSet[str]
+    validate: Optional[Callable[[str, Dict], object]] = None
+
+PROMPTS = {
+    "awaiting_email": "ممتاز! الآن يرجى إدخال عنوان بريدك الإلكتروني:",
+    "awaiting_email_confirmation": "لتأكيد البريد الإلكتروني، يرجى كتابته مرة أخرى:",
+    "awaiting_whatsapp": "يرجى إدخال رقم الواتساب مع مفتاح الدولة (مثال: +966500000000):",
+}
+
+# --- VALIDATORS ---
+def _validate_email(text: str, state: Dict) -> str:
+    # General structure check
+    if "@" not in text or "." not in text:
+        raise InvalidInput("يرجى إدخال بريد إلكتروني صحيح (مثال: name@example.com):")
+    if state.get("course") in config.GMAIL_COURSES and not text.lower().endswith("@gmail.com"):
+        raise InvalidInput("يرجى إدخال بريد إلكتروني من Gmail فقط (مثال: name@gmail.com):")
+    return text
+
+def _validate_count(text: str, state: Dict) -> int:
+    try:
+        k = int(text)
+        if k <= 0:
+            raise ValueError()
+    except ValueError:
+        raise InvalidInput("من فضلك اكتب عدداً صحيحاً أكبر من صفر. مثال: 1 أو 2 أو 3")
+    return k
+
+def _validate_coupon(text: str, state: Dict) -> Tuple[int, str]:
+    """Returns (discount percent, code); (0, "") when the user skips."""
+    if text == "تخطي":
+        return 0, ""
+    discount = db.get_coupon(text, state.get("course"))
+    if not discount:
+        raise InvalidInput(
+            "❌ الكوبون غير صحيح أو منتهي الصلاحية.\nيرجى إعادة كتابة الكوبون بالشكل الصحيح أو اضغط على تخطي:",
+            reply_markup=SKIP_COUPON_KEYBOARD,
+        )
+    return discount, text.upper()
+
+# --- TRANSITIONS ---
+def _apply_name(text, state):
+    state["name"] = text
+    return Transition("awaiting_email")
+
+def _apply_email(text, state):
+    if state.get("course") in config.GMAIL_COURSES:
+        # Store temporarily and ask for confirmation
+        state["temp_email"] = text
+        return Transition("awaiting_email_confirmation")
+    state["email"] = text
+    return Transition("awaiting_whatsapp")
+
+def _apply_email_confirmation(text, state):
+    first_email = state.pop("temp_email", "") or ""
+    if text.strip().lower() == first_email.strip().lower():
+        state["email"] = first_email
+        return Transition("awaiting_whatsapp")
+    return Transition(
+        "awaiting_email",
+        "عذراً، البريد الإلكتروني غير متطابق.\nيرجى إدخال البريد الإلكتروني من البداية:",
+        prompt=False,
+    )
+
+def _apply_whatsapp(text, state):
+    state["whatsapp"] = text
+    seat = config.SEAT_COURSES.get(state.get("course"))
+    if seat:
+        return Transition(f"awaiting_{seat['prefix']}_count")
+    return Transition(PAYMENT_CHOICE)
+
+def _set_field(field):
+    def _apply(text, state):
+        state[field] = text
+        return Transition(COMPLETED)
+    return _apply
+
+def _apply_coupon(coupon, state):
+    discount, code = coupon
+    if not discount:
+        return Transition(PAYMENT_CHOICE)
+    state["discount_percent"] = discount
+    state["coupon_code"] = code
+    return Transition(PAYMENT_CHOICE, f"✅ كود صحيح! تم تطبيق خصم {discount}% بنجاح.")
+
+def _seat_stages(prefix: str) -> Dict[str, Stage]:
+    count_field, names_field = f"{prefix}_count", f"{prefix}_names"
+    confirm_stage = f"confirm_{prefix}_names"
+
+    def _store_names(text, state):
+        names = [n.strip() for n in text.split(",") if n.strip()]
+        state[names_field] = ", ".join(names)
+        expected = state.get(count_field, 0)
+        return len(names), expected
+
+    def _apply_count(k, state):
+        state[count_field] = k
+        return Transition(f"awaiting_{prefix}_names")
+
+    def _apply_names(text, state):
+        got, expected = _store_names(text, state)
+        if expected and got != expected:
+            return Transition(
+                confirm_stage,
+                f"تنبّه: كتبت {got} اسم/أسماء بينما العدد هو {expected}. "
+                "لو صحيح اضغط موافق، أو اكتب الأسماء من جديد.\n\nاكتب: موافق  — أو  أعد إدخال الأسماء.",
+                prompt=False,
+            )
+        return Transition(PAYMENT_CHOICE)
+
+    def _apply_confirm(text, state):
+        if text.strip().lower() in CONFIRM_WORDS:
+            return Transition(PAYMENT_CHOICE)
+        # treat as new names input
+        got, expected = _store_names(text, state)
+        if expected and got != expected:
+            return Transition(
+                confirm_stage,
+                f"ما زال العدد لا يطابق ({got} اسم مقابل {expected}). "
+                "لو مناسب اكتب: موافق — أو أعد إدخال الأسماء.",
+                prompt=False,
+            )
+        return Transition(PAYMENT_CHOICE)
+
+    return {
+        f"awaiting_{prefix}_count": Stage(_apply_count, frozenset({f"awaiting_{prefix}_names"}), _validate_count),
+        f"awaiting_{prefix}_names": Stage(_apply_names, frozenset({confirm_stage, PAYMENT_CHOICE})),
+        confirm_stage: Stage(_apply_confirm, frozenset({confirm_stage, PAYMENT_CHOICE})),
+    }
+
+def _build_stages() -> Dict[str, Stage]:
+    seat_count_stages = {f"awaiting_{seat['prefix']}_count" for seat in config.SEAT_COURSES.values()}
+    stages = {
+        "awaiting_name": Stage(_apply_name, frozenset({"awaiting_email"})),
+        "awaiting_email": Stage(
+            _apply_email, frozenset({"awaiting_email_confirmation", "awaiting_whatsapp"}), _validate_email
+        ),
+        "awaiting_email_confirmation": Stage(
+            _apply_email_confirmation, frozenset({"awaiting_whatsapp", "awaiting_email"})
+        ),
+        "awaiting_whatsapp": Stage(_apply_whatsapp, frozenset({PAYMENT_CHOICE} | seat_count_stages)),
+        "awaiting_amount": Stage(_set_field("amount_paid"), frozenset({COMPLETED})),
+        "awaiting_wu_details": Stage(_set_field("wu_details"), frozenset({COMPLETED})),
+        "awaiting_vodafone_details": Stage(_set_field("vodafone_details"), frozenset({COMPLETED})),
+        "awaiting_coupon": Stage(_apply_coupon, frozenset({PAYMENT_CHOICE}), _validate_coupon),
+    }
+    for seat in config.SEAT_COURSES.values():
+        stages.update(_seat_stages(seat["prefix"]))
+        PROMPTS[f"awaiting_{seat['prefix']}_count"] = seat["count_prompt"]
+        PROMPTS[f"awaiting_{seat['prefix']}_names"] = seat["names_prompt"]
+    return stages
+
+STAGES = _build_stages()
+
+def advance(stage_name: str, text: str, state: Dict) -> Optional[Transition]:
+    """Runs one transition and updates `state` in place only if it succeeds.
+    Returns None for stages that don't take text; raises InvalidInput when the
+    message should be re-asked."""
+    stage = STAGES.get(stage_name)
+    if stage is None:
+        return None
+    value = stage.validate(text, state) if stage.validate else text
+    new_state = dict(state)
+    transition = stage.apply(value, new_state)
+    if transition.stage not in stage.next:
+        raise RuntimeError(f"Invalid transition {stage_name} -> {transition.stage}")
+    new_state["stage"] = transition.stage
+    state.clear()
+    state.update(new_state)
+    return transition
+
+def seat_count(state: Dict) -> int:
+    """Number of seats for multi-seat courses, 0 for single-seat ones."""
+    seat = config.SEAT_COURSES.get(state.get("course"))
+    if not seat:
+        return 0
+    return max(1, int(state.get(f"{seat['prefix']}_count") or 1))
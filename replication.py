@@ -0,0 +1,246 @@
+import os
+import hmac
+import json
+import zlib
+import sqlite3
+import asyncio
+import logging
+import tempfile
+import threading
+from typing import Dict, Optional, Tuple
+
+import config
+import db
+import httpd
+
+logger = logging.getLogger(__name__)
+
+# --- DATABASE REPLICATION ---
+# Keeps a copy of bot_state.db on every other node so a failover to another
+# machine resumes with the leader's state. cluster_runner.py runs one
+# Replicator per node:
+#   - leader: whenever the database changed (PRAGMA data_version), takes an
+#     online backup (consistent mid-write, WAL included), compresses it and
+#     POSTs it to every REPLICATION_PEERS node
+#   - others: accept POST /replica and copy the snapshot into their local
+#     database with the backup API, in one transaction (no file swap, so a
+#     bind-mounted bot_state.db and open connections are fine)
+# Snapshots carry the leader's fencing token (its term) and a sequence number;
+# a node ignores anything not newer than what it already applied, so a deposed
+# leader can't overwrite its successor's data. The newest (term, seq) is kept
+# in the replication_state table of the local database, written into the
+# snapshot before it is copied in, so it survives runner restarts. A peer that
+# refuses a snapshot because it already has newer data is not up to date: that
+# is logged as an error and the snapshot is offered again every round. The
+# state database is small, so whole snapshots are cheap and need no SQLite
+# extension.
+
+REPLICA_PATH = "/replica"
+SECRET_HEADER = "X-Replica-Secret"
+TERM_HEADER = "X-Replica-Term"
+SEQ_HEADER = "X-Replica-Seq"
+MAX_SNAPSHOT_BYTES = 256 * 1024 * 1024
+
+def enabled() -> bool:
+    return bool(config.REPLICATION_PEERS)
+
+class Replicator:
+    def __init__(self, db_file: str = None):
+        self.db_file = db_file or db.DB_FILE
+        self.term = 0                         # fencing token while leading, 0 while following
+        self.applied: Tuple[int, int] = _load_applied(self.db_file)  # (term, seq) of the newest snapshot in the local file
+        self._lock = threading.Lock()         # role changes wait for a snapshot being applied
+        self._thread: Optional[threading.Thread] = None
+        self._refused: Dict[str, object] = {}  # peer -> what it last answered with a 409 (logged once)
+
+    # --- called by cluster_runner.py ---
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._main(started),),
+                                        name="replication", daemon=True)
+        self._thread.start()
+        started.wait(5)
+
+    def lead(self, term: int):
+        """Stops accepting snapshots and starts shipping; call before the bot starts."""
+        with self._lock:
+            self.term = term
+            if (term, 0) > self.applied:
+                self.applied = (term, 0)
+                try:
+                    _store_applied(self.db_file, self.applied)
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not record replication term {term}: {e}")
+
+    def follow(self):
+        """Stops shipping and accepts snapshots again; call once the bot has stopped."""
+        with self._lock:
+            self.term = 0
+
+    # --- replication thread ---
+    async def _main(self, started: threading.Event):
+        server = httpd.HttpServer(max_body=MAX_SNAPSHOT_BYTES)
+        server.route("POST", REPLICA_PATH, self._receive)
+        try:
+            await server.start(config.REPLICATION_LISTEN, config.REPLICATION_PORT)
+        except OSError as e:
+            logger.error(f"Can't accept replica snapshots on port {config.REPLICATION_PORT}: {e}")
+        started.set()
+        await self._ship_forever()
+
+    async def _receive(self, request: httpd.Request) -> httpd.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER.lower(), ""), config.REPLICATION_SECRET):
+            return httpd.Response(403, "forbidden")
+        try:
+            term = int(request.headers[TERM_HEADER.lower()])
+            seq = int(request.headers[SEQ_HEADER.lower()])
+        except (KeyError, ValueError):
+            return httpd.Response(400, "missing term / seq")
+        try:
+            applied = await asyncio.to_thread(self._apply, term, seq, request.body)
+        except (zlib.error, sqlite3.DatabaseError) as e:
+            logger.error(f"Rejected replica snapshot {term}/{seq}: {e}")
+            return httpd.Response(400, "bad snapshot")
+        if not applied:
+            return httpd.Response(409, {"leading": bool(self.term), "applied": self.applied})
+        return httpd.Response(200, {"applied": self.applied})
+
+    def _apply(self, term: int, seq: int, payload: bytes) -> bool:
+        if self.term or (term, seq) <= self.applied:
+            return False
+        with _temp_db(self.db_file) as tmp:
+            with open(tmp, "wb") as f:
+                f.write(zlib.decompress(payload))
+            src = sqlite3.connect(tmp)
+            try:
+                check = src.execute("PRAGMA quick_check").fetchone()[0]
+                if check != "ok":
+                    raise sqlite3.DatabaseError(f"quick_check: {check}")
+                # Copied in with the data, so the file and its (term, seq) always agree
+                _write_applied(src, (term, seq))
+                with self._lock:
+                    if self.term or (term, seq) <= self.applied:
+                        return False
+                    dst = sqlite3.connect(self.db_file, timeout=30)
+                    try:
+                        src.backup(dst)
+                    finally:
+                        dst.close()
+                    self.applied = (term, seq)
+            finally:
+                src.close()
+        logger.info(f"📥 Applied replica snapshot {term}/{seq} ({len(payload) // 1024} KB)")
+        return True
+
+    def _snapshot(self) -> bytes:
+        with _temp_db(self.db_file) as tmp:
+            src = sqlite3.connect(self.db_file, timeout=30)
+            dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
+            with open(tmp, "rb") as f:
+                return zlib.compress(f.read(), 6)
+
+    async def _ship_forever(self):
+        client = httpd.HttpClient(timeout=config.REPLICATION_TIMEOUT, pool_size=2)
+        conn, term, version, seq, payload = None, 0, None, 0, b""
+        acked: Dict[str, int] = {}   # peer -> last seq it has (-1: must be sent again)
+        while True:
+            await asyncio.sleep(config.REPLICATION_INTERVAL)
+            if not self.term:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                continue
+            try:
+                if conn is None or term != self.term:
+                    # New term: snapshot once straight away, then on every change
+                    conn = conn or sqlite3.connect(self.db_file)
+                    term, version, seq = self.term, None, 0
+                    acked.clear()
+                current = conn.execute("PRAGMA data_version").fetchone()[0]
+                if current != version:
+                    payload = await asyncio.to_thread(self._snapshot)
+                    version, seq = current, seq + 1
+                behind = [peer for peer in config.REPLICATION_PEERS if acked.get(peer) != seq]
+                await asyncio.gather(*(self._ship(client, peer, term, seq, payload, acked) for peer in behind))
+            except Exception as e:
+                logger.warning(f"Replication round failed: {e}")
+
+    async def _ship(self, client: httpd.HttpClient, peer: str, term: int, seq: int, payload: bytes,
+                    acked: Dict[str, int]):
+        headers = {SECRET_HEADER: config.REPLICATION_SECRET, TERM_HEADER: str(term), SEQ_HEADER: str(seq),
+                   "Content-Type": "application/octet-stream"}
+        try:
+            status, body = await client.request("POST", peer + REPLICA_PATH, payload, headers)
+        except (OSError, asyncio.TimeoutError) as e:
+            if acked.get(peer) != -1:
+                logger.warning(f"Replica {peer} unreachable: {e}")
+            acked[peer] = -1   # retried every round until it takes a snapshot
+            return
+        if status == 200:
+            acked[peer] = seq
+            self._refused.pop(peer, None)
+        elif status == 409:
+            try:
+                answer = json.loads(body)
+            except ValueError:
+                answer = {}
+            if answer.get("leading"):
+                acked[peer] = seq  # the peer is serving (its runner won a lease); it takes no snapshots
+                return
+            # The peer holds a snapshot from a term at or above ours: it is not getting our data
+            acked[peer] = -1
+            if self._refused.get(peer) != answer.get("applied"):
+                self._refused[peer] = answer.get("applied")
+                logger.error(f"Replica {peer} refused snapshot {term}/{seq}: it already applied "
+                             f"{answer.get('applied')}; replication to it is stalled")
+        else:
+            logger.warning(f"Replica {peer} refused snapshot {term}/{seq}: {status} {body[:200]!r}")
+            acked[peer] = -1
+
+def _write_applied(conn: sqlite3.Connection, applied: Tuple[int, int]):
+    conn.execute("CREATE TABLE IF NOT EXISTS replication_state (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                 "term INTEGER NOT NULL, seq INTEGER NOT NULL)")
+    conn.execute("INSERT OR REPLACE INTO replication_state (id, term, seq) VALUES (1, ?, ?)", applied)
+    conn.commit()
+
+def _store_applied(db_file: str, applied: Tuple[int, int]):
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        _write_applied(conn, applied)
+    finally:
+        conn.close()
+
+def _load_applied(db_file: str) -> Tuple[int, int]:
+    if not os.path.exists(db_file):
+        return (0, 0)
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        row = conn.execute("SELECT term, seq FROM replication_state WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        row = None   # no snapshot applied or term led yet
+    finally:
+        conn.close()
+    return tuple(row) if row else (0, 0)
+
+class _temp_db:
+    """A scratch database file next to `path` (same filesystem), removed with its -wal / -shm."""
+
+    def __init__(self, path: str):
+        self.dir = os.path.dirname(os.path.abspath(path))
+
+    def __enter__(self) -> str:
+        fd, self.path = tempfile.mkstemp(prefix=".replica-", suffix=".db", dir=self.dir)
+        os.close(fd)
+        return self.path
+
+    def __exit__(self, *exc):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            try:
+                os.remove(self.path + suffix)
+            except OSError:
+                pass
@@ -0,0 +1,94 @@
+import re
+import time
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+import catalog
+import db
+import utils
+import registration
+
+logger = logging.getLogger(__name__)
+
+# --- REVENUE LEDGER ---
+# Each approval is written to the `approvals` ledger with the price the user
+# was quoted (saved when they picked the payment method, recomputed from the
+# catalog for older states), its currency, method, coupon and discount. The
+# transaction that marks the admin decision done writes it and adds it to
+# revenue_daily, so an approval can't finish without its ledger row and
+# /revenue sums a handful of per-day rows whatever the range. USD values use the catalog's usd_rates at
+# approval time; amounts in currencies without a rate are counted as unconverted.
+
+DEFAULT_RANGE = "30d"
+
+def approval_entry(request_id: str, user_id: int, user_info: Dict, admin_id: int) -> Dict:
+    """The ledger row for an approval, for db.finish_admin_decision."""
+    quote = user_info.get("quote") or utils.quote_price(
+        user_info.get("payment_method_key"),
+        user_info.get("course"),
+        seats=registration.seat_count(user_info),
+        discount_percent=user_info.get("discount_percent", 0),
+    ) or {}
+    currency = quote.get("currency")
+    now = time.time()
+    return {
+        "request_id": request_id,
+        "user_id": user_id,
+        "approved_at": now,
+        "day": datetime.fromtimestamp(now).strftime("%Y-%m-%d"),
+        "course": user_info.get("course"),
+        "seats": quote.get("seats"),
+        "method_key": user_info.get("payment_method_key"),
+        "currency": currency,
+        "list_amount": quote.get("list_amount"),
+        "discount_percent": user_info.get("discount_percent", 0),
+        "coupon_code": user_info.get("coupon_code"),
+        "amount": quote.get("amount"),
+        "usd_rate": catalog.current().usd_rates.get(currency),
+        "amount_paid": user_info.get("amount_paid"),
+        "admin_id": admin_id,
+    }
+
+def parse_range(text: Optional[str]) -> Optional[Tuple[str, str, str]]:
+    """(first_day, last_day, label) for today / yesterday / Nd / YYYY-MM / YYYY-MM-DD[..YYYY-MM-DD] / all."""
+    text = (text or DEFAULT_RANGE).strip().lower()
+    today = date.today()
+    if text == "today":
+        return today.isoformat(), today.isoformat(), "اليوم"
+    if text == "yesterday":
+        day = (today - timedelta(days=1)).isoformat()
+        return day, day, "أمس"
+    if text == "all":
+        return "0000-00-00", "9999-12-31", "كل الفترات"
+    m = re.fullmatch(r"(\d+)d", text)
+    if m:
+        days = max(1, int(m.group(1)))
+        return (today - timedelta(days=days - 1)).isoformat(), today.isoformat(), f"آخر {days} يوم"
+    if re.fullmatch(r"\d{4}-\d{2}", text):
+        return f"{text}-01", f"{text}-31", text
+    m = re.fullmatch(r"(\d{4}-\d{2}-\d{2})(?:\.\.(\d{4}-\d{2}-\d{2}))?", text)
+    if m:
+        first, last = m.group(1), m.group(2) or m.group(1)
+        return first, last, first if first == last else f"{first} → {last}"
+    return None
+
+def report(first_day: str, last_day: str) -> Dict:
+    """Totals per currency, per method and per course over the range."""
+    by_currency: Dict[str, Dict] = {}
+    by_method: Dict[str, Dict] = {}
+    by_course: Dict[str, int] = {}
+    total = {"approvals": 0, "usd": 0.0, "unconverted": 0}
+    for currency, method_key, course, approvals, amount, discount, usd, unconverted in db.get_revenue(first_day, last_day):
+        row = by_currency.setdefault(currency, {"approvals": 0, "amount": 0.0, "discount": 0.0})
+        row["approvals"] += approvals
+        row["amount"] += amount
+        row["discount"] += discount
+        method = by_method.setdefault(method_key, {"approvals": 0, "usd": 0.0})
+        method["approvals"] += approvals
+        method["usd"] += usd
+        by_course[course] = by_course.get(course, 0) + approvals
+        total["approvals"] += approvals
+        total["usd"] += usd
+        total["unconverted"] += unconverted
+    return {"currencies": by_currency, "methods": by_method, "courses": by_course, "total": total}
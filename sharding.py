@@ -0,0 +1,332 @@
+import os
+import re
+import hmac
+import sys
+import json
+import signal
+import asyncio
+import logging
+import subprocess
+from typing import Dict, List, Optional
+
+import config
+import db
+import httpd
+import health
+import fencing
+import standby
+
+logger = logging.getLogger(__name__)
+
+# --- SHARDED WORKERS ---
+# `python sharding.py` starts SHARD_COUNT newbot.py workers (webhook mode, on
+# localhost) and an ingress router that owns the public webhook. Every update
+# goes to the worker that owns its chat, so one user's updates are always
+# ordered by the same PerChatUpdateProcessor and hit the same warm caches.
+# Workers share the SQLite database; admin commands that depend on per-process
+# state (/broadcast, /cancel, the runtime part of /stats) fan out to every
+# worker over the /internal/* endpoints.
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Admin decisions act on the registering user's row, so they go to that user's shard
+_DECISION_CALLBACK = re.compile(r"^(?:approve|reject)_(-?\d+)")
+
+_CHAT_UPDATES = ("message", "edited_message", "channel_post", "edited_channel_post",
+                 "my_chat_member", "chat_member", "chat_join_request")
+_USER_UPDATES = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer")
+
+def shard_for(chat_id: int, shard_count: int = None) -> int:
+    return chat_id % (shard_count or config.SHARD_COUNT)
+
+def owns(chat_id: int) -> bool:
+    """Whether this worker's partition contains `chat_id`."""
+    return config.SHARD_COUNT <= 1 or shard_for(chat_id) == config.SHARD_INDEX
+
+def update_chat_id(data: Dict) -> Optional[int]:
+    """The chat an update (raw webhook JSON) belongs to; None if it has none."""
+    query = data.get("callback_query")
+    if query:
+        match = _DECISION_CALLBACK.match(query.get("data") or "")
+        if match:
+            return int(match.group(1))
+        chat = (query.get("message") or {}).get("chat") or query.get("from") or {}
+        return chat.get("id")
+    for key in _CHAT_UPDATES:
+        if data.get(key):
+            return (data[key].get("chat") or {}).get("id")
+    for key in _USER_UPDATES:
+        if data.get(key):
+            return (data[key].get("from") or data[key].get("user") or {}).get("id")
+    return None
+
+def worker_url(index: int) -> str:
+    return f"http://{config.SHARD_HOST}:{config.SHARD_BASE_PORT + index}"
+
+# --- WORKER SIDE ---
+def add_worker_routes(server):
+    """Registers the /internal/* endpoints on a worker's webhook.WebhookServer."""
+    import handlers  # imported late: handlers itself calls into this module
+
+    def _authorized(request: httpd.Request) -> bool:
+        return hmac.compare_digest(request.headers.get(SECRET_HEADER.lower(), ""), config.WEBHOOK_SECRET)
+
+    async def stats(request: httpd.Request) -> httpd.Response:
+        if not _authorized(request):
+            return httpd.Response(403, "bad secret token")
+        processor = server.app.update_processor
+        return httpd.Response(200, {
+            "shard": config.SHARD_INDEX,
+            "updates": server.updates_received,
+            "active_chats": getattr(processor, "active_chats", 0),
+            "known_users": sum(1 for uid in handlers.BROADCAST_AUDIENCES["all"]() if owns(uid)),
+            "broadcasting": handlers.broadcast_running,
+        })
+
+    async def broadcast(request: httpd.Request) -> httpd.Response:
+        if not _authorized(request):
+            return httpd.Response(403, "bad secret token")
+        body = request.json()
+        audience = handlers.BROADCAST_AUDIENCES.get(body.get("audience"))
+        if audience is None or not body.get("text"):
+            return httpd.Response(400, "unknown audience or empty text")
+        user_ids = [uid for uid in audience() if owns(uid)]
+        result = await handlers.send_broadcast(server.app.bot, user_ids, body["text"])
+        return httpd.Response(200, result)
+
+    async def cancel(request: httpd.Request) -> httpd.Response:
+        if not _authorized(request):
+            return httpd.Response(403, "bad secret token")
+        handlers.cancel_local_broadcast()
+        return httpd.Response(200, {"shard": config.SHARD_INDEX})
+
+    server.http.route("GET", "/internal/stats", stats)
+    server.http.route("POST", "/internal/broadcast", broadcast)
+    server.http.route("POST", "/internal/broadcast/cancel", cancel)
+
+# --- FAN-OUT (called by whichever worker received the admin command) ---
+_client: Optional[httpd.HttpClient] = None
+
+def _worker_client() -> httpd.HttpClient:
+    global _client
+    if _client is None:
+        _client = httpd.HttpClient(timeout=config.SHARD_FORWARD_TIMEOUT)
+    return _client
+
+async def _call_all(method: str, path: str, payload: Dict = None, timeout=...) -> List[Optional[Dict]]:
+    """Calls every worker; an unreachable / failing worker yields None."""
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    headers = {SECRET_HEADER: config.WEBHOOK_SECRET, "Content-Type": "application/json"}
+
+    async def _one(index):
+        try:
+            status, response = await _worker_client().request(
+                method, worker_url(index) + path, body, headers, timeout=timeout
+            )
+            if status != 200:
+                raise RuntimeError(f"HTTP {status}: {response[:200]!r}")
+            return json.loads(response)
+        except Exception as e:
+            logger.error(f"Shard {index} {method} {path} failed: {e}")
+            return None
+
+    return await asyncio.gather(*(_one(i) for i in range(config.SHARD_COUNT)))
+
+async def collect_stats() -> List[Optional[Dict]]:
+    return await _call_all("GET", "/internal/stats")
+
+async def broadcast(audience: str, text: str) -> Dict:
+    """Runs the broadcast on every shard at once and sums what they report."""
+    results = await _call_all("POST", "/internal/broadcast", {"audience": audience, "text": text}, timeout=None)
+    total = {"sent": 0, "failed": 0, "cancelled": False, "unreachable": []}
+    for index, result in enumerate(results):
+        if result is None:
+            total["unreachable"].append(index)
+            continue
+        total["sent"] += result["sent"]
+        total["failed"] += result["failed"]
+        total["cancelled"] = total["cancelled"] or result["cancelled"]
+    return total
+
+async def cancel_broadcast():
+    await _call_all("POST", "/internal/broadcast/cancel")
+
+# --- INGRESS ROUTER ---
+class Router:
+    def __init__(self):
+        self.client = httpd.HttpClient(timeout=config.SHARD_FORWARD_TIMEOUT)
+        self.forwarded = [0] * config.SHARD_COUNT
+        self.http = httpd.HttpServer()
+        self.http.route("POST", config.WEBHOOK_PATH, self.forward)
+        self.http.route("GET", "/healthz", self.healthz)
+        self.http.route("GET", "/shards", self.shards)
+
+    async def forward(self, request: httpd.Request) -> httpd.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER.lower(), ""), config.WEBHOOK_SECRET):
+            return httpd.Response(403, "bad secret token")
+        try:
+            chat_id = update_chat_id(request.json())
+        except (ValueError, AttributeError):
+            return httpd.Response(400, "malformed update")
+        # Updates without a chat (e.g. poll updates) all go to shard 0
+        index = shard_for(chat_id) if chat_id is not None else 0
+        try:
+            status, _ = await self.client.request(
+                "POST", worker_url(index) + config.WEBHOOK_PATH, request.body,
+                {SECRET_HEADER: config.WEBHOOK_SECRET, "Content-Type": "application/json"},
+            )
+        except Exception as e:
+            logger.warning(f"Shard {index} did not accept an update: {e}")
+            return httpd.Response(503, f"shard {index} unavailable")
+        if status == 200:
+            self.forwarded[index] += 1
+        return httpd.Response(status)
+
+    async def healthz(self, request: httpd.Request) -> httpd.Response:
+        return httpd.Response(200, {"status": "ok"})
+
+    async def shards(self, request: httpd.Request) -> httpd.Response:
+        return httpd.Response(200, {"forwarded": self.forwarded})
+
+def _spawn_worker(index: int, as_standby: bool = False) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BOT_STANDBY="1" if as_standby else "0",
+        FENCING_TOKEN=str(config.FENCING_TOKEN),
+        FENCING_HOLDER=config.FENCING_HOLDER,
+        BOT_HEALTH_FILE="",  # workers are probed on /healthz; the file is the router's
+        SHARD_INDEX=str(index),
+        SHARD_COUNT=str(config.SHARD_COUNT),
+        BOT_MODE="webhook",
+        WEBHOOK_LISTEN=config.SHARD_HOST,
+        WEBHOOK_PORT=str(config.SHARD_BASE_PORT + index),
+        WEBHOOK_URL="",  # only the router registers the webhook
+        WEBHOOK_SECRET=config.WEBHOOK_SECRET,
+    )
+    logger.info(f"Starting shard {index} on {worker_url(index)}{' (standby)' if as_standby else ''}")
+    stdin = subprocess.PIPE if as_standby else None
+    return subprocess.Popen([sys.executable, "newbot.py"], env=env, stdin=stdin, text=True)
+
+async def _register_webhook():
+    from telegram import Bot, Update
+
+    kwargs = {}
+    if config.TELEGRAM_API_BASE_URL:
+        kwargs["base_url"] = config.TELEGRAM_API_BASE_URL.rstrip("/")
+    async with Bot(config.BOT_TOKEN, **kwargs) as bot:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+    logger.info(f"Webhook registered at {config.WEBHOOK_URL}")
+
+# Consecutive failed /healthz probes (503 or no answer in time) before a worker is restarted
+WORKER_HEALTH_STRIKES = 3
+
+async def _probe_worker(client: httpd.HttpClient, index: int) -> Optional[str]:
+    """What is wrong with a running worker, or None. A refused connection is
+    not counted: the worker is still starting, or poll() will see it exit."""
+    try:
+        status, body = await client.request("GET", worker_url(index) + "/healthz", timeout=5)
+    except asyncio.TimeoutError:
+        return "/healthz timed out"
+    except OSError:
+        return None
+    if status != 200:
+        return json.loads(body or b"{}").get("problem") or f"/healthz answered {status}"
+    return None
+
+async def _supervise(workers: List[Optional[subprocess.Popen]], backoffs: List[health.Backoff],
+                     strikes: List[int], client: httpd.HttpClient):
+    """Restarts exited workers (with backoff, so a crash loop doesn't spin) and
+    recycles workers that keep failing their health probe."""
+    for index, proc in enumerate(workers):
+        if proc is not None and proc.poll() is not None:
+            delay = backoffs[index].failed()
+            logger.error(f"Shard {index} exited with {proc.returncode}; restarting in {delay:.0f}s")
+            workers[index] = proc = None
+        if proc is None:
+            if backoffs[index].ready():
+                workers[index] = _spawn_worker(index)
+                backoffs[index].started()
+                strikes[index] = 0
+            continue
+        reason = await _probe_worker(client, index)
+        strikes[index] = strikes[index] + 1 if reason else 0
+        if strikes[index] >= WORKER_HEALTH_STRIKES:
+            logger.error(f"Shard {index} unhealthy ({reason}); recycling it")
+            proc.terminate()
+            strikes[index] = 0
+
+async def run_router():
+    db.init_db()
+    if config.BOT_STANDBY:
+        # Hot standby: warm workers now, hand each the token once we are promoted
+        workers = [_spawn_worker(i, as_standby=True) for i in range(config.SHARD_COUNT)]
+        await asyncio.get_running_loop().run_in_executor(None, standby.wait_for_promotion)
+    # The router registers the webhook, so it is fenced like a single bot;
+    # its workers get the same token
+    fencing.claim()
+    fencing.start_watchdog()
+    if config.BOT_STANDBY:
+        for proc in workers:
+            proc.stdin.write(standby.promotion_line(config.FENCING_TOKEN, config.FENCING_HOLDER))
+            proc.stdin.flush()
+    else:
+        workers = [_spawn_worker(i) for i in range(config.SHARD_COUNT)]
+    router = Router()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await router.http.start(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+    # The runner probes the router's own heartbeat; workers are probed below
+    health.start_heartbeat()
+    backoffs = [health.Backoff() for _ in workers]
+    for backoff in backoffs:
+        backoff.started()
+    strikes = [0] * len(workers)
+    try:
+        if config.WEBHOOK_URL:
+            await _register_webhook()
+        logger.info(f"🤖 Router up: {config.SHARD_COUNT} shards behind {config.WEBHOOK_PATH}")
+        if config.FENCING_TOKEN:
+            print(f"{standby.READY_MARKER} {config.FENCING_TOKEN}", flush=True)
+        while not stop_event.is_set():
+            # A dead worker black-holes its partition, so it comes back as soon as its backoff allows
+            await _supervise(workers, backoffs, strikes, router.client)
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await router.http.stop()
+        await router.client.close()
+        workers = [proc for proc in workers if proc is not None]
+        for proc in workers:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in workers:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        logger.info("Router stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    if not config.BOT_TOKEN:
+        logger.error("No BOT_TOKEN found in config!")
+        sys.exit(1)
+    try:
+        asyncio.run(run_router())
+    except KeyboardInterrupt:
+        pass
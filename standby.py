@@ -0,0 +1,49 @@
+import sys
+import json
+import time
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- HOT STANDBY ---
+# cluster_runner.py keeps a standby bot (BOT_STANDBY=1) on every node that is
+# not the leader: imports loaded, DB opened, catalog compiled, Application
+# built and Google sessions authorized, but not polling. Promotion is a single
+# JSON line on the bot's stdin carrying the new term's fencing token (a plain
+# signal can't carry the token, and Windows has no SIGUSR1). Once serving, the
+# bot prints READY_MARKER on stdout so the runner can time the takeover.
+
+READY_MARKER = "BOT-READY"
+# Exit status of a bot whose term token is below the one stored in the DB
+# (the lease store's version went backwards); the runner moves its lease
+# version past the stored token and starts the bot again
+STALE_TOKEN_EXIT = 76
+
+def promotion_line(token: int, holder: str) -> str:
+    return json.dumps({"token": token, "holder": holder}) + "\n"
+
+def prewarm():
+    """Pays up front for everything a promoted bot would otherwise pay on its first updates."""
+    import utils  # not at module level: cluster_runner imports this module without the bot
+
+    start = time.perf_counter()
+    utils.prewarm_google_imports()
+    utils.prewarm_google_sessions()
+    logger.info(f"🔥 Standby warmed up in {(time.perf_counter() - start) * 1000:.0f}ms; waiting for promotion")
+
+def wait_for_promotion():
+    """Blocks until the runner promotes this process, then adopts the term's token."""
+    line = sys.stdin.readline()
+    if not line:
+        raise SystemExit("Runner went away before promoting this standby")
+    message = json.loads(line)
+    config.FENCING_TOKEN = int(message["token"])
+    config.FENCING_HOLDER = message["holder"]
+    logger.info(f"⚡ Promoted to leader (fencing token {config.FENCING_TOKEN})")
+
+def report_ready():
+    # Shard workers stay quiet; their router reports for the whole set
+    if config.FENCING_TOKEN and config.SHARD_COUNT <= 1:
+        print(f"{READY_MARKER} {config.FENCING_TOKEN}", flush=True)
@@ -0,0 +1,17 @@
+import os
+import sys
+
+# The modules live at the repository root (run as `python newbot.py`), not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import db
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    """A fresh database for the test (db functions open DB_FILE on every call)."""
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "bot_state.db"))
+    monkeypatch.setattr(db, "FENCING_TOKEN", 0)
+    db.init_db()
+    return db.DB_FILE
@@ -0,0 +1,77 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from telegram import Bot
+
+import config
+import httpd
+import webhook
+
+TOKEN = "123456:TEST"
+
+class FakeBotApi:
+    """A local stand-in for the Bot API (what TELEGRAM_API_BASE_URL points the bot at)."""
+
+    def __init__(self):
+        self.calls = []
+        self.http = httpd.HttpServer()
+        for method in ("getMe", "sendMessage"):
+            self.http.route("POST", f"/bot{TOKEN}/{method}", self._handler(method))
+
+    def _handler(self, method):
+        async def handle(request):
+            self.calls.append((method, request.body))
+            if method == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "Test", "username": "test_bot"}
+            else:
+                result = {"message_id": 1, "date": 0, "chat": {"id": 42, "type": "private"}, "text": "hi"}
+            return httpd.Response(200, {"ok": True, "result": result})
+        return handle
+
+    async def start(self) -> str:
+        await self.http.start("127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.http._server.sockets[0].getsockname()[1]}/bot"
+
+def test_bot_calls_go_to_the_stand_in():
+    async def main():
+        api = FakeBotApi()
+        base = await api.start()
+        bot = Bot(TOKEN, base_url=base)
+        try:
+            async with bot:
+                api.calls.clear()   # initialize() already called getMe
+                me = await bot.get_me()
+                await bot.send_message(chat_id=42, text="hi")
+        finally:
+            await api.http.stop()
+        return me, api.calls
+    me, calls = asyncio.run(main())
+    assert me.username == "test_bot"
+    assert [name for name, _ in calls] == ["getMe", "sendMessage"]
+
+def test_webhook_checks_the_secret_and_queues_updates(monkeypatch):
+    monkeypatch.setattr(config, "WEBHOOK_SECRET", "s3cret")
+    update = {"update_id": 7, "message": {"message_id": 1, "date": 0, "chat": {"id": 42, "type": "private"},
+                                           "text": "/start"}}
+
+    async def main():
+        app = SimpleNamespace(update_queue=asyncio.Queue(), bot=None, running=True)
+        server = webhook.WebhookServer(app)
+        server.ready = True
+        await server.http.start("127.0.0.1", 0)
+        url = f"http://127.0.0.1:{server.http._server.sockets[0].getsockname()[1]}{config.WEBHOOK_PATH}"
+        client = httpd.HttpClient(timeout=2)
+        try:
+            denied = await client.request("POST", url, json.dumps(update).encode())
+            accepted = await client.request("POST", url, json.dumps(update).encode(),
+                                            {"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+        finally:
+            await client.close()
+            await server.http.stop()
+        return denied[0], accepted[0], app.update_queue.get_nowait().update_id
+    assert asyncio.run(main()) == (403, 200, 7)
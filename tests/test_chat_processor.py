@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from telegram import Update
+
+import chat_processor
+
+def _message(update_id: int, chat_id: int, text: str = "hi") -> Update:
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": text}}, None)
+
+def test_same_chat_in_order_other_chats_not_blocked():
+    async def main():
+        processor = chat_processor.PerChatUpdateProcessor(2, max_queued=16)
+        release = asyncio.Event()
+        log = []
+        running = 0
+        peak = 0
+
+        async def work(update, wait):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            log.append(("start", update.update_id))
+            if wait:
+                await release.wait()
+            log.append(("end", update.update_id))
+            running -= 1
+
+        # A burst from chat 1 (the first one blocks) and one update from chat 2
+        burst = [_message(i, 1) for i in (1, 2, 3)]
+        tasks = [asyncio.create_task(processor.process_update(u, work(u, u.update_id == 1))) for u in burst]
+        other = _message(4, 2)
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(processor.process_update(other, work(other, False)), 1)
+        assert ("end", 4) in log and ("start", 2) not in log
+        assert processor.active_chats == 1
+
+        release.set()
+        await asyncio.gather(*tasks)
+        return log, peak, processor.active_chats
+
+    log, peak, active = asyncio.run(main())
+    assert [i for event, i in log if event == "start" and i != 4] == [1, 2, 3]
+    assert peak <= 2 and active == 0
+
+def test_cancel_does_not_queue_behind_the_chat():
+    update = _message(1, 1, "/cancel@some_bot")
+    assert chat_processor.chat_key(update) is None
+    assert chat_processor.chat_key(_message(2, 1, "/start")) == 1
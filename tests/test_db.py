@@ -0,0 +1,48 @@
+import db
+
+# --- COMPARE-AND-SET ---
+def test_compare_and_set_needs_the_current_version(db_file):
+    assert db.compare_and_set_user_state(1, {"stage": "awaiting_name"}, None)
+    state, version = db.get_user_state_versioned(1)
+    assert (state, version) == ({"stage": "awaiting_name"}, 1)
+
+    assert db.compare_and_set_user_state(1, {"stage": "awaiting_email"}, version)
+    assert not db.compare_and_set_user_state(1, {"stage": "stale"}, version)
+    assert not db.compare_and_set_user_state(1, {"stage": "stale"}, None)   # the row exists
+    assert db.get_user_state_versioned(1) == ({"stage": "awaiting_email"}, 2)
+
+def test_mutate_reruns_on_a_fresh_copy_after_a_conflict(db_file):
+    db.update_user_state(1, {"stage": "awaiting_name", "n": 0})
+    seen = []
+
+    def bump(state):
+        seen.append(dict(state))
+        if len(seen) == 1:
+            db.update_user_state(1, {"stage": "awaiting_name", "n": 10})   # a concurrent writer wins
+        state["n"] += 1
+
+    assert db.mutate_user_state(1, bump) == {"stage": "awaiting_name", "n": 11}
+    assert [s["n"] for s in seen] == [0, 10]
+    assert db.get_user_state(1)["n"] == 11
+
+def test_mutate_gives_up_after_the_retries(db_file):
+    db.update_user_state(1, {"n": 0})
+
+    def always_conflicts(state):
+        db.update_user_state(1, {"n": state["n"] + 100})
+        state["n"] += 1
+
+    assert db.mutate_user_state(1, always_conflicts, retries=3) is None
+    assert db.get_user_state(1) == {"n": 300}
+
+def test_a_deleted_row_is_not_recreated(db_file):
+    db.update_user_state(1, {"stage": "completed"})
+    state, version = db.get_user_state_versioned(1)
+    db.delete_user_state(1, outcome="approved")
+    # A writer that read before the delete loses the swap instead of resurrecting a ghost row
+    assert not db.compare_and_set_user_state(1, dict(state, admin_messages=[]), version)
+    assert db.get_user_state_versioned(1) == ({}, None)
+
+    # mutate functions that check what they read skip the write altogether
+    assert db.mutate_user_state(1, lambda s: False if s.get("stage") != "completed" else None) is None
+    assert db.get_user_state_versioned(1) == ({}, None)
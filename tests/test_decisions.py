@@ -0,0 +1,86 @@
+import asyncio
+import datetime
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import db
+import utils
+
+# --- CLAIMS ---
+def test_first_claim_wins(db_file):
+    assert db.claim_admin_decision("r1", 1, "approve", 10, "Ali") is None
+    other = db.claim_admin_decision("r1", 1, "reject", 11, "Omar")
+    assert (other["status"], other["admin_name"], other["action"]) == ("in_progress", "Ali", "approve")
+
+    db.finish_admin_decision("r1")
+    assert db.claim_admin_decision("r1", 1, "reject", 11, "Omar")["status"] == "done"
+
+def test_failed_claim_can_be_retaken(db_file):
+    assert db.claim_admin_decision("r1", 1, "approve", 10, "Ali") is None
+    db.finish_admin_decision("r1", "failed")
+    assert db.claim_admin_decision("r1", 1, "reject", 11, "Omar") is None
+    decision = db.get_admin_decision("r1")
+    assert (decision["status"], decision["admin_name"], decision["action"]) == ("in_progress", "Omar", "reject")
+
+def test_stale_in_progress_claim_expires(db_file):
+    assert db.claim_admin_decision("r1", 1, "approve", 10, "Ali") is None
+    assert db.claim_admin_decision("r1", 1, "approve", 11, "Omar") is not None
+
+    conn = sqlite3.connect(db_file)
+    long_ago = datetime.datetime.now() - datetime.timedelta(seconds=db.config.DECISION_CLAIM_TTL + 60)
+    conn.execute("UPDATE admin_decisions SET decided_at = ?", (long_ago,))
+    conn.commit()
+    conn.close()
+    assert db.claim_admin_decision("r1", 1, "approve", 11, "Omar") is None
+    assert db.get_admin_decision("r1")["admin_name"] == "Omar"
+
+def test_retaken_claim_keeps_the_action_of_its_done_steps(db_file):
+    assert db.claim_admin_decision("r1", 1, "approve", 10, "Ali") is None
+    db.add_decision_step("r1", "coupon")
+    db.add_decision_step("r1", "drive")
+    db.finish_admin_decision("r1", "failed")
+    assert db.claim_admin_decision("r1", 1, "reject", 11, "Omar") is None
+    decision = db.get_admin_decision("r1")
+    assert (decision["action"], decision["admin_name"], decision["steps"]) == ("approve", "Omar", {"coupon", "drive"})
+
+# --- DECISION PIPELINE ---
+class FlakyBot:
+    """Fails the first `failures` messages to the user, records the rest."""
+
+    def __init__(self, user_id: int, failures: int):
+        self.user_id = user_id
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == self.user_id and self.failures:
+            self.failures -= 1
+            raise ConnectionError("network down")
+        self.sent.append((chat_id, text))
+
+def test_retaken_decision_only_runs_the_missing_steps(db_file, monkeypatch):
+    pytest.importorskip("telegram")
+    import handlers
+
+    redeemed, granted = [], []
+    monkeypatch.setattr(db, "redeem_coupon", redeemed.append)
+    monkeypatch.setattr(utils, "grant_expert_drive_access", lambda email: granted.append(email) or True)
+    user_info = {"stage": "completed", "course": "expert", "email": "a@example.com", "coupon_code": "SAVE10"}
+    db.update_user_state(1, user_info)
+    bot = FlakyBot(1, failures=1)
+    context = SimpleNamespace(bot=bot)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(handlers._decide(context, "approve", 1, user_info, "r1", 10, "Ali"))
+    decision = db.get_admin_decision("r1")
+    assert decision["status"] == "failed" and decision["steps"] == {"coupon", "drive"}
+
+    # Another admin clicks reject on the failed request: the approval is finished instead
+    assert asyncio.run(handlers._decide(context, "reject", 1, user_info, "r1", 11, "Omar")) is None
+    decision = db.get_admin_decision("r1")
+    assert (decision["status"], decision["action"], decision["admin_name"]) == ("done", "approve", "Omar")
+    assert redeemed == ["SAVE10"] and granted == ["a@example.com"]
+    assert bot.sent and all(chat_id == 1 for chat_id, _ in bot.sent)
+    assert db.get_user_state(1) == {}
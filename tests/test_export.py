@@ -0,0 +1,58 @@
+import csv
+import gzip
+import os
+
+import pytest
+
+pytest.importorskip("telegram")
+
+import db
+import export
+
+# --- EXPORTS ---
+def _approve(request_id, user_id, day):
+    db.claim_admin_decision(request_id, user_id, "approve", 10, "Ali")
+    db.finish_admin_decision(request_id, "done", {
+        "request_id": request_id, "user_id": user_id, "approved_at": 0.0, "day": day, "course": "expert",
+        "seats": None, "method_key": "vodafone_eg", "currency": "EGP", "list_amount": 1000,
+        "discount_percent": 0, "coupon_code": None, "amount": 1000, "usd_rate": None,
+        "amount_paid": "ألف", "admin_id": 10,
+    })
+
+def test_csv_export(db_file):
+    _approve("r1", 1, "2026-01-02")
+    _approve("r2", 2, "2026-02-02")
+    result = export.write_export("approvals", export.ExportFilter("2026-01-01", "2026-01-31"))
+    try:
+        with gzip.open(result["path"], "rt", encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.reader(f))
+    finally:
+        os.remove(result["path"])
+    assert result["rows"] == 1 and result["filename"] == "approvals_2026-01-01_2026-01-31.csv.gz"
+    assert rows[0] == export.APPROVAL_COLUMNS
+    assert rows[1][0] == "r1" and rows[1][export.APPROVAL_COLUMNS.index("amount_paid")] == "ألف"
+
+def test_registrations_export_filters(db_file):
+    db.update_user_state(1, {"stage": "completed", "course": "expert", "name": "A"})
+    db.update_user_state(2, {"stage": "awaiting_receipt", "course": "kids", "name": "B"})
+    result = export.write_export("registrations", export.ExportFilter(course="kids"))
+    try:
+        with gzip.open(result["path"], "rt", encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.reader(f))
+    finally:
+        os.remove(result["path"])
+    assert result["rows"] == 1 and rows[1][0] == "2"
+
+def test_parquet_export(db_file, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(export, "PARQUET_BATCH", 2)   # several row groups
+    for i in range(5):
+        _approve(f"r{i}", i, "2026-01-02")
+    result = export.write_export("approvals", export.ExportFilter(), fmt="parquet")
+    try:
+        table = pq.read_table(result["path"])
+    finally:
+        os.remove(result["path"])
+    assert result["rows"] == 5 and table.num_rows == 5
+    assert table.column_names == export.APPROVAL_COLUMNS
+    assert table.column("amount_paid").to_pylist() == ["ألف"] * 5
@@ -0,0 +1,30 @@
+import pytest
+
+import cluster_runner
+import db
+import leases
+
+def test_stale_fencing_token_is_not_a_conflict(db_file, monkeypatch):
+    db.advance_fencing_token(5)
+    monkeypatch.setattr(db, "FENCING_TOKEN", 4)
+    with pytest.raises(db.StaleFencingToken):
+        db.compare_and_set_user_state(1, {"stage": "awaiting_name"}, None)
+    assert db.get_user_state_versioned(1) == ({}, None)
+
+def test_writes_check_the_token_in_their_transaction(db_file, monkeypatch):
+    monkeypatch.setattr(db, "FENCING_TOKEN", 3)
+    db.advance_fencing_token(3)
+    db.update_user_state(1, {"stage": "awaiting_name"})
+    db.advance_fencing_token(4)   # a newer term registered its token
+    with pytest.raises(db.StaleFencingToken):
+        db.mutate_user_state(1, lambda state: state.update(stage="awaiting_email"))
+    assert db.get_user_state(1) == {"stage": "awaiting_name"}
+
+def test_new_leader_moves_its_lease_past_the_stored_token(tmp_path, db_file):
+    db.advance_fencing_token(40)   # the lease store started over below what the db has seen
+    backend = leases.SQLiteLeaseBackend(str(tmp_path / "lease.db"), "bot")
+    elector = cluster_runner.Elector(backend, "node-a")
+    elector.tick()
+    assert elector.is_leader and elector.term_token == 41
+    assert backend.read() == leases.Lease("node-a", 41)
+    assert not elector.advance_past(40)   # already past it
@@ -0,0 +1,26 @@
+import sqlite3
+
+import db
+
+def test_events_log_stage_changes_only(db_file):
+    db.update_user_state(1, {"stage": "awaiting_name"})
+    db.update_user_state(1, {"stage": "awaiting_name", "name": "x"})
+    db.update_user_state(1, {"stage": "awaiting_email", "name": "x"})
+    conn = sqlite3.connect(db_file)
+    stages = conn.execute("SELECT from_stage, to_stage FROM events WHERE user_id = 1 ORDER BY id").fetchall()
+    conn.close()
+    assert stages == [(None, "awaiting_name"), ("awaiting_name", "awaiting_email")]
+
+def test_rollups_fold_each_event_once(db_file):
+    db.update_user_state(1, {"stage": "awaiting_name", "course": "expert"})
+    db.update_user_state(1, {"stage": "awaiting_email", "course": "expert"})
+    db.update_user_state(2, {"stage": "awaiting_name", "course": "kids"})
+    assert db.rollup_events(batch=2) == 2
+    assert db.rollup_events() == 1
+    assert db.rollup_events() == 0
+
+    daily = {(course, stage): (entered, exited) for course, stage, entered, exited, _
+             in db.get_funnel_rollup("funnel_daily", "0000")}
+    assert daily == {("expert", "awaiting_name"): (1, 1), ("expert", "awaiting_email"): (1, 0),
+                     ("kids", "awaiting_name"): (1, 0)}
+    assert [row[1] for row in db.get_funnel_rollup("funnel_hourly", "0000", course="kids")] == ["awaiting_name"]
@@ -0,0 +1,82 @@
+import asyncio
+
+import httpd
+
+async def _serve(server: httpd.HttpServer):
+    await server.start("127.0.0.1", 0)
+    return server._server.sockets[0].getsockname()[1]
+
+async def _raw(port: int, payload: bytes, wait: float = 2.0) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(payload)
+    await writer.drain()
+    try:
+        return await asyncio.wait_for(reader.read(), wait)
+    finally:
+        writer.close()
+
+def _status(raw: bytes) -> int:
+    return int(raw.split(b" ", 2)[1]) if raw else 0
+
+def _run(coro_fn, server=None):
+    server = server or httpd.HttpServer()
+
+    async def main():
+        async def echo(request):
+            return httpd.Response(200, {"path": request.path, "body": request.body.decode()})
+        server.route("POST", "/echo", echo)
+        port = await _serve(server)
+        try:
+            return await coro_fn(port)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+def test_keep_alive_round_trips():
+    async def go(port):
+        client = httpd.HttpClient(timeout=2)
+        try:
+            first = await client.request("POST", f"http://127.0.0.1:{port}/echo", b"one")
+            second = await client.request("POST", f"http://127.0.0.1:{port}/echo", b"two")
+            missing = await client.request("GET", f"http://127.0.0.1:{port}/nope")
+            wrong_method = await client.request("GET", f"http://127.0.0.1:{port}/echo")
+        finally:
+            await client.close()
+        return first, second, missing, wrong_method
+    first, second, missing, wrong_method = _run(go)
+    assert first == (200, b'{"path": "/echo", "body": "one"}')
+    assert second[0] == 200 and b"two" in second[1]
+    assert missing[0] == 404 and wrong_method[0] == 405
+
+def test_slow_headers_get_408():
+    server = httpd.HttpServer(read_timeout=0.2)
+    raw = _run(lambda port: _raw(port, b"POST /echo HTTP/1.1\r\nHost: x\r\n"), server)
+    assert _status(raw) == 408
+
+def test_slow_body_gets_408():
+    server = httpd.HttpServer(read_timeout=0.2)
+    raw = _run(lambda port: _raw(port, b"POST /echo HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc"), server)
+    assert _status(raw) == 408
+
+def test_idle_connection_is_closed():
+    server = httpd.HttpServer(idle_timeout=0.2)
+    assert _run(lambda port: _raw(port, b""), server) == b""
+
+def test_long_request_line_is_rejected():
+    raw = _run(lambda port: _raw(port, b"GET /" + b"a" * (httpd.MAX_LINE_BYTES + 10) + b" HTTP/1.1\r\n\r\n"))
+    assert _status(raw) == 400
+
+def test_long_header_line_is_rejected():
+    raw = _run(lambda port: _raw(port, b"GET / HTTP/1.1\r\nX-Big: " + b"a" * (httpd.MAX_LINE_BYTES + 10) + b"\r\n\r\n"))
+    assert _status(raw) == 431
+
+def test_too_many_headers_are_rejected():
+    headers = b"".join(b"X-H%d: v\r\n" % i for i in range(httpd.MAX_HEADERS + 1))
+    raw = _run(lambda port: _raw(port, b"GET / HTTP/1.1\r\n" + headers + b"\r\n"))
+    assert _status(raw) == 431
+
+def test_oversized_and_bad_bodies_are_rejected():
+    server = httpd.HttpServer(max_body=16)
+    too_big = _run(lambda port: _raw(port, b"POST /echo HTTP/1.1\r\nContent-Length: 17\r\n\r\n"), server)
+    negative = _run(lambda port: _raw(port, b"POST /echo HTTP/1.1\r\nContent-Length: -1\r\n\r\n"))
+    assert _status(too_big) == 413 and _status(negative) == 400
@@ -0,0 +1,70 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import cluster_runner
+import httpd
+import leases
+
+def test_sqlite_compare_and_set(tmp_path):
+    path = str(tmp_path / "lease.db")
+    a, b = leases.SQLiteLeaseBackend(path, "bot"), leases.SQLiteLeaseBackend(path, "bot")
+    assert a.read() == leases.Lease("", 0)
+    assert a.compare_and_set(0, "node-a") == leases.Lease("node-a", 1)
+    assert b.compare_and_set(0, "node-b") is None          # a lost race leaves the lease alone
+    assert b.read() == leases.Lease("node-a", 1)
+    assert b.compare_and_set(1, "node-b", new_version=10) == leases.Lease("node-b", 10)
+    assert leases.SQLiteLeaseBackend(path, "other").read() == leases.Lease("", 0)
+
+def test_lease_server_compare_and_set_survives_a_restart(tmp_path):
+    state_file = str(tmp_path / "lease_server.json")
+
+    def post(server, **body):
+        request = httpd.Request("POST", "/lease", {}, json.dumps(dict(name="bot", **body)).encode())
+        response = asyncio.run(server.set_lease(request))
+        return response.status, json.loads(response.body)
+
+    server = leases.LeaseServer(state_file)
+    assert post(server, expected_version=0, holder="node-a") == (200, {"holder": "node-a", "version": 1})
+    assert post(server, expected_version=0, holder="node-b") == (409, {"holder": "node-a", "version": 1})
+
+    restarted = leases.LeaseServer(state_file)   # never hands out version 1 again
+    assert post(restarted, expected_version=1, holder="node-b") == (200, {"holder": "node-b", "version": 2})
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+def test_standby_takes_over_only_after_the_version_stalls(tmp_path, monkeypatch, db_file):
+    clock = Clock()
+    monkeypatch.setattr(cluster_runner, "time", SimpleNamespace(monotonic=clock.monotonic))
+    backend = leases.SQLiteLeaseBackend(str(tmp_path / "lease.db"), "bot")
+    leader = cluster_runner.Elector(backend, "node-a")
+    standby = cluster_runner.Elector(backend, "node-b")
+
+    leader.tick()
+    assert leader.is_leader and backend.read().holder == "node-a"
+
+    # Renewed within the TTL: the standby keeps waiting
+    for _ in range(3):
+        clock.now += cluster_runner.LEASE_TTL * 0.6
+        leader.tick()
+        standby.tick()
+        assert not standby.is_leader
+
+    # The leader goes silent: the standby takes over one TTL after it last saw the version move
+    standby.tick()
+    clock.now += cluster_runner.LEASE_TTL * 0.6
+    standby.tick()
+    assert not standby.is_leader
+    clock.now += cluster_runner.LEASE_TTL * 0.6
+    standby.tick()
+    assert standby.is_leader and backend.read().holder == "node-b"
+
+    # The old leader finds out on its next renew
+    clock.now += cluster_runner.RENEW_EVERY
+    leader.tick()
+    assert not leader.is_leader
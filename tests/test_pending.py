@@ -0,0 +1,16 @@
+import db
+
+def test_pending_queue_follows_the_stage(db_file):
+    db.update_user_state(1, {"stage": "awaiting_receipt", "course": "expert"})
+    db.update_user_state(2, {"stage": "completed", "course": "kids"})
+    assert db.get_pending_page(0, 10)[0] == 1
+
+    db.mutate_user_state(1, lambda s: s.update(stage="completed"))
+    total, rows = db.get_pending_page(0, 10)
+    assert total == 2 and [user_id for user_id, _, _ in rows] == [2, 1]
+    assert rows[1][2]["course"] == "expert"
+    assert db.get_pending_page(1, 10)[1][0][0] == 1
+
+    db.delete_user_state(2, outcome="approved")
+    db.mutate_user_state(1, lambda s: s.update(stage="awaiting_receipt"))
+    assert db.get_pending_page(0, 10) == (0, [])
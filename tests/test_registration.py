@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("telegram")
+
+import config
+import registration
+
+def test_registration_walks_the_stages():
+    state = {"stage": "awaiting_name", "course": "expert"}
+    assert registration.advance("awaiting_name", "Sara", state).stage == "awaiting_email"
+    assert registration.advance("awaiting_email", "sara@gmail.com", state).stage == "awaiting_email_confirmation"
+    assert registration.advance("awaiting_email_confirmation", "SARA@gmail.com ", state).stage == "awaiting_whatsapp"
+    assert registration.advance("awaiting_whatsapp", "+249912345678", state).stage == registration.PAYMENT_CHOICE
+    assert state == {"stage": registration.PAYMENT_CHOICE, "course": "expert", "name": "Sara",
+                     "email": "sara@gmail.com", "whatsapp": "+249912345678"}
+
+def test_invalid_input_leaves_the_state_alone():
+    state = {"stage": "awaiting_email", "course": "expert"}
+    with pytest.raises(registration.InvalidInput):
+        registration.advance("awaiting_email", "sara@example.com", state)   # Gmail only for this course
+    assert state == {"stage": "awaiting_email", "course": "expert"}
+
+def test_mismatched_confirmation_starts_the_email_again():
+    state = {"stage": "awaiting_email_confirmation", "course": "expert", "temp_email": "a@gmail.com"}
+    transition = registration.advance("awaiting_email_confirmation", "b@gmail.com", state)
+    assert transition.stage == "awaiting_email" and not transition.prompt
+    assert "temp_email" not in state and "email" not in state
+
+def test_seat_names_must_match_the_count_or_be_confirmed():
+    course, seat = next(iter(config.SEAT_COURSES.items()))
+    prefix = seat["prefix"]
+    state = {"stage": f"awaiting_{prefix}_count", "course": course}
+    with pytest.raises(registration.InvalidInput):
+        registration.advance(f"awaiting_{prefix}_count", "0", state)
+    registration.advance(f"awaiting_{prefix}_count", "2", state)
+    assert registration.advance(f"awaiting_{prefix}_names", "Ali", state).stage == f"confirm_{prefix}_names"
+    assert registration.advance(f"confirm_{prefix}_names", "ok", state).stage == registration.PAYMENT_CHOICE
+    assert registration.seat_count(state) == 2
+
+def test_stages_without_text_input():
+    state = {"stage": registration.PAYMENT_CHOICE}
+    assert registration.advance(registration.PAYMENT_CHOICE, "hello", state) is None
+    assert state == {"stage": registration.PAYMENT_CHOICE}
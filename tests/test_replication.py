@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+import config
+import db
+import httpd
+import replication
+
+def _post(replica: replication.Replicator, term: int, seq: int, payload: bytes, secret: str = None):
+    headers = {
+        replication.SECRET_HEADER.lower(): config.REPLICATION_SECRET if secret is None else secret,
+        replication.TERM_HEADER.lower(): str(term),
+        replication.SEQ_HEADER.lower(): str(seq),
+    }
+    response = asyncio.run(replica._receive(httpd.Request("POST", replication.REPLICA_PATH, headers, payload)))
+    return response.status, json.loads(response.body) if response.body.startswith(b"{") else response.body
+
+def test_follower_applies_only_newer_snapshots(db_file, tmp_path, monkeypatch):
+    follower_file = str(tmp_path / "follower.db")
+    db.update_user_state(1, {"stage": "awaiting_name"})
+    leader = replication.Replicator(db_file)
+    first = leader._snapshot()
+    db.update_user_state(1, {"stage": "awaiting_email"})
+    second = leader._snapshot()
+
+    follower = replication.Replicator(follower_file)
+    assert _post(follower, 2, 1, first, secret="wrong")[0] == 403
+    assert _post(follower, 2, 2, second) == (200, {"applied": [2, 2]})
+    assert _post(follower, 2, 1, first)[0] == 409    # older seq of the same term
+    assert _post(follower, 2, 2, first)[0] == 409    # same (term, seq) again
+    assert _post(follower, 1, 9, first)[0] == 409    # a deposed leader's term
+    status, body = _post(follower, 3, 0, second)
+    assert status == 200 and body == {"applied": [3, 0]}
+
+    # What was applied, and its (term, seq), survive a restart of the follower
+    restarted = replication.Replicator(follower_file)
+    assert restarted.applied == (3, 0)
+    assert _post(restarted, 2, 5, first) == (409, {"leading": False, "applied": [3, 0]})
+    monkeypatch.setattr(db, "DB_FILE", follower_file)
+    assert db.get_user_state(1) == {"stage": "awaiting_email"}
+
+def test_leader_refuses_snapshots(db_file, tmp_path):
+    snapshot = replication.Replicator(db_file)._snapshot()
+    node = replication.Replicator(str(tmp_path / "node.db"))
+    node.lead(5)
+    assert _post(node, 9, 1, snapshot) == (409, {"leading": True, "applied": [5, 0]})
+    node.follow()
+    assert _post(node, 9, 1, snapshot)[0] == 200
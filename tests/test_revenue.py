@@ -0,0 +1,32 @@
+from datetime import date, timedelta
+
+import pytest
+
+import db
+
+def test_finish_records_the_approval_once(db_file):
+    entry = {"request_id": "r1", "user_id": 1, "approved_at": 0.0, "day": "2026-01-02", "course": "expert",
+             "seats": None, "method_key": "vodafone_eg", "currency": "EGP", "list_amount": 1000,
+             "discount_percent": 20, "coupon_code": "X", "amount": 800, "usd_rate": 0.02,
+             "amount_paid": "800", "admin_id": 10}
+    db.claim_admin_decision("r1", 1, "approve", 10, "Ali")
+    db.finish_admin_decision("r1", "done", entry)
+    db.finish_admin_decision("r1", "done", entry)
+    assert db.get_admin_decision("r1")["status"] == "done"
+    assert db.get_revenue("2026-01-01", "2026-01-31") == [("EGP", "vodafone_eg", "expert", 1, 800, 200, 16.0, 0)]
+
+def test_parse_range():
+    pytest.importorskip("telegram")
+    import revenue
+
+    today = date.today()
+    assert revenue.parse_range("today")[:2] == (today.isoformat(), today.isoformat())
+    yesterday = (today - timedelta(days=1)).isoformat()
+    assert revenue.parse_range("yesterday")[:2] == (yesterday, yesterday)
+    assert revenue.parse_range(None)[:2] == ((today - timedelta(days=29)).isoformat(), today.isoformat())
+    assert revenue.parse_range("0d")[:2] == (today.isoformat(), today.isoformat())
+    assert revenue.parse_range("2026-02")[:2] == ("2026-02-01", "2026-02-31")
+    assert revenue.parse_range("2026-02-03")[:2] == ("2026-02-03", "2026-02-03")
+    assert revenue.parse_range(" 2026-02-03..2026-03-01 ")[:2] == ("2026-02-03", "2026-03-01")
+    assert revenue.parse_range("ALL")[:2] == ("0000-00-00", "9999-12-31")
+    assert revenue.parse_range("last week") is None
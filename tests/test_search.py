@@ -0,0 +1,24 @@
+import pytest
+
+import db
+
+def test_search_index_keeps_finished_registrations(db_file):
+    if not db.FTS_AVAILABLE:
+        pytest.skip("this SQLite build has no FTS5")
+    db.update_user_state(1, {"stage": "completed", "name": "أحمد علي", "whatsapp": "+249 912 345 678",
+                             "email": "ahmed@example.com", "course": "expert"})
+    db.update_user_state(2, {"stage": "awaiting_email", "name": "Sara"})
+
+    assert [r["user_id"] for r in db.search_registrations("احمد")] == [1]        # hamza folded
+    assert [r["user_id"] for r in db.search_registrations("0912345678")] == [1]  # other phone prefix
+    assert [r["user_id"] for r in db.search_registrations("sar")] == [2]         # prefix match
+    assert db.search_registrations("nobody") == []
+
+    db.delete_user_state(1, outcome="approved")
+    (hit,) = db.search_registrations("ahmed")
+    assert hit["stage"] == "approved" and hit["name"] == "أحمد علي"
+
+def test_search_text_is_normalized():
+    assert db.normalize_search_text("إِبْرَاهِيم") == db.normalize_search_text("ابراهيم")
+    assert db.normalize_search_text(["Ali", "مريم"]) == "ali مريم"
+    assert db._match_query('a"b c') == '"a"* "b"* "c"*'
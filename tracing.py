@@ -0,0 +1,201 @@
+import time
+import secrets
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+# --- REGISTRATION TRACING ---
+# Every registration carries a trace_id in its user_states row (set by /start,
+# added on first sight to older rows). Each handler run for that user is a
+# step (@tracing.step); external calls inside it (Sheets, Drive, every Bot API
+# request) are spans (@tracing.span / `with tracing.span_block(...)`). Spans
+# are buffered in memory and written off the event loop to the trace_spans
+# table every TRACE_FLUSH_INTERVAL seconds; /trace <user_id> shows the timeline.
+# Spans only record inside a step, so work for no particular user costs nothing.
+
+ENABLED = config.TRACING_ENABLED
+
+_current: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("trace_step", default=None)
+_trace_ids: "OrderedDict[int, str]" = OrderedDict()   # user_id -> trace_id (recently seen)
+_MAX_CACHED = 5000
+_buffer: List[tuple] = []
+_flush_lock = threading.Lock()
+_flusher: Optional[asyncio.Task] = None
+
+def new_trace_id() -> str:
+    return secrets.token_hex(6)
+
+def _remember(user_id: int, trace_id: str):
+    _trace_ids[user_id] = trace_id
+    _trace_ids.move_to_end(user_id)
+    while len(_trace_ids) > _MAX_CACHED:
+        _trace_ids.popitem(last=False)
+
+def bind(user_id: int, state: Optional[Dict]):
+    """Tells the running step whose registration it works on (from a state the handler already loaded)."""
+    if not ENABLED or not state or not state.get("trace_id"):
+        return
+    _remember(user_id, state["trace_id"])
+    ctx = _current.get()
+    if ctx is not None and ctx["user_id"] == user_id:
+        ctx["trace_id"] = state["trace_id"]
+
+def note(detail: str):
+    """Adds detail to the running step's name (e.g. the stage handle_text is in)."""
+    ctx = _current.get()
+    if ctx is not None and detail:
+        ctx["detail"] = detail
+
+def _resolve(user_id: int) -> Optional[str]:
+    if user_id in _trace_ids:
+        return _trace_ids[user_id]
+    state = db.get_user_state(user_id)
+    if not state:
+        return None
+    if not state.get("trace_id"):
+        # Registration from before tracing: give it a trace from here on
+        def _assign(s):
+            if not s or s.get("trace_id"):
+                return False
+            s["trace_id"] = new_trace_id()
+        state = db.mutate_user_state(user_id, _assign) or db.get_user_state(user_id)
+    trace_id = state.get("trace_id")
+    if trace_id:
+        _remember(user_id, trace_id)
+    return trace_id
+
+def _finish(ctx: Dict, started: float, duration_ms: float, status: str):
+    try:
+        trace_id = ctx["trace_id"] or _resolve(ctx["user_id"])
+    except Exception as e:
+        logger.warning(f"Could not resolve the trace of {ctx['user_id']}: {e}")
+        return
+    if not trace_id:
+        return
+    step = f"{ctx['name']}[{ctx['detail']}]" if ctx.get("detail") else ctx["name"]
+    # Rows: (trace_id, user_id, step, step_at, name, started_at, duration_ms, status); the step's
+    # own row has name == step, its spans share its step_at
+    _buffer.append((trace_id, ctx["user_id"], step, started, step, started, duration_ms, status))
+    for name, span_started, span_ms, span_status in ctx["spans"]:
+        _buffer.append((trace_id, ctx["user_id"], step, started, name, span_started, span_ms, span_status))
+
+def step(name: str = None, user: Callable[..., Optional[int]] = None):
+    """Decorator for handlers. `user(update, context)` picks the registration
+    (default: the update's chat); returning None skips tracing that call."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        step_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            try:
+                user_id = user(*args, **kwargs) if user else args[0].effective_chat.id
+            except Exception:
+                user_id = None
+            if user_id is None:
+                return await fn(*args, **kwargs)
+            ctx = {"user_id": user_id, "trace_id": None, "name": step_name, "detail": None, "spans": []}
+            token = _current.set(ctx)
+            started, t0, status = time.time(), time.perf_counter(), "ok"
+            try:
+                return await fn(*args, **kwargs)
+            except BaseException as e:
+                status = type(e).__name__
+                raise
+            finally:
+                _current.reset(token)
+                _finish(ctx, started, (time.perf_counter() - t0) * 1000, status)
+        return wrapper
+    return decorate
+
+@contextmanager
+def span_block(name: str):
+    ctx = _current.get()
+    if ctx is None:
+        yield
+        return
+    started, t0, status = time.time(), time.perf_counter(), "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        ctx["spans"].append((name, started, (time.perf_counter() - t0) * 1000, status))
+
+def span(name: str = None):
+    """Decorator for external calls (sync or async); recorded when called inside a step.
+    Sync functions run via asyncio.to_thread still count (the context is copied)."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        span_name = name or fn.__name__
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span_block(span_name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span_block(span_name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# --- STORE ---
+def flush():
+    """Writes buffered spans (blocking; the flusher runs it off the loop)."""
+    global _buffer
+    with _flush_lock:
+        if not _buffer:
+            return
+        batch, _buffer = _buffer, []
+        db.add_trace_spans(batch)
+
+async def _flush_forever():
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(config.TRACE_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(flush)
+            if time.time() - last_prune > 3600:
+                last_prune = time.time()
+                await asyncio.to_thread(db.prune_trace_spans, time.time() - config.TRACE_RETENTION_DAYS * 86400)
+        except Exception as e:
+            logger.warning(f"Failed to store trace spans: {e}")
+
+def start_flusher():
+    global _flusher
+    if ENABLED and (_flusher is None or _flusher.done()):
+        _flusher = asyncio.get_running_loop().create_task(_flush_forever())
+
+def timeline(user_id: int, trace_id: str = None) -> Dict:
+    """The user's latest (or the given) trace: {trace_id, steps: [{..., spans: [...]}]}."""
+    flush()
+    trace_id = trace_id or db.get_latest_trace_id(user_id)
+    if not trace_id:
+        return {"trace_id": None, "steps": []}
+    steps: Dict[tuple, Dict] = {}
+    spans = []
+    for step_name, step_at, name, started_at, duration_ms, status in db.get_trace_spans(trace_id):
+        row = {"name": name, "started_at": started_at, "duration_ms": duration_ms, "status": status}
+        if name == step_name and started_at == step_at:
+            steps[(step_name, step_at)] = dict(row, spans=[])
+        else:
+            spans.append(((step_name, step_at), row))
+    for key, row in spans:
+        if key in steps:
+            steps[key]["spans"].append(row)
+    return {"trace_id": trace_id, "steps": sorted(steps.values(), key=lambda s: s["started_at"])}
@@ -1,50 +1,142 @@
 import os
 import json
+import time
 import logging
+import functools
+import importlib
+import threading
 import html as _html
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
 import config
+import catalog
+import fencing
+import metrics
+import tracing
 
 logger = logging.getLogger(__name__)
 
 # --- KNOWN USERS HELPERS ---
-def load_known_users():
-    if os.path.exists(config.KNOWN_USERS_FILE):
-        with open(config.KNOWN_USERS_FILE, "r") as f:
+# With sharded workers each shard writes its own file (no cross-process
+# read-modify-write races); readers take the union with the original file.
+def _known_users_file(shard_index: int) -> str:
+    root, ext = os.path.splitext(os.path.basename(config.KNOWN_USERS_FILE))
+    return os.path.join(config.KNOWN_USERS_SHARD_DIR, f"{root}.shard{shard_index}{ext}")
+
+def _read_known_users(path: str) -> set:
+    if os.path.exists(path):
+        with open(path, "r") as f:
             try:
                 return set(json.load(f))
             except:
                 return set()
     return set()
 
+def load_known_users():
+    users = _read_known_users(config.KNOWN_USERS_FILE)
+    if config.SHARD_COUNT > 1:
+        root, ext = os.path.splitext(config.KNOWN_USERS_FILE)
+        for index in range(config.SHARD_COUNT):
+            users |= _read_known_users(_known_users_file(index))
+            users |= _read_known_users(f"{root}.shard{index}{ext}")   # written before KNOWN_USERS_SHARD_DIR
+    return users
+
 def save_known_user(chat_id):
-    users = load_known_users()
+    path = config.KNOWN_USERS_FILE
+    if config.SHARD_COUNT > 1:
+        if chat_id in _read_known_users(path):
+            return
+        path = _known_users_file(config.SHARD_INDEX)
+        os.makedirs(config.KNOWN_USERS_SHARD_DIR, exist_ok=True)
+    users = _read_known_users(path)
     if chat_id not in users:
         users.add(chat_id)
-        with open(config.KNOWN_USERS_FILE, "w") as f:
+        with open(path, "w") as f:
             json.dump(list(users), f)
 
+# --- LAZY IMPORTS ---
+# gspread / oauth2client / googleapiclient take seconds to import, so they are
+# loaded on first Google call (or pre-warmed after polling starts) instead of
+# at bot startup. Every timed import is recorded for the startup report.
+GOOGLE_MODULES = ("gspread", "oauth2client.service_account", "googleapiclient.discovery")
+
+IMPORT_TIMINGS: Dict[str, float] = {}
+_import_lock = threading.Lock()
+
+def timed_import(name: str):
+    """Imports a module (once) and records how long the first import took."""
+    with _import_lock:
+        already_loaded = name in IMPORT_TIMINGS
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        if not already_loaded:
+            IMPORT_TIMINGS[name] = time.perf_counter() - start
+    return module
+
+def prewarm_google_imports():
+    """Loads the Google client libraries ahead of the first Sheets/Drive call."""
+    for name in GOOGLE_MODULES:
+        try:
+            timed_import(name)
+        except Exception as e:
+            logger.warning(f"Failed to pre-warm {name}: {e}")
+    logger.info(format_import_report("Google imports pre-warmed", GOOGLE_MODULES))
+
+def format_import_report(title: str, names=None) -> str:
+    names = [n for n in (names or IMPORT_TIMINGS) if n in IMPORT_TIMINGS]
+    parts = [f"{n} {IMPORT_TIMINGS[n] * 1000:.0f}ms" for n in names]
+    return f"⏱️ {title}: " + (", ".join(parts) if parts else "nothing imported")
+
+_credentials_cache = {}
+_gspread_client = None
+_google_lock = threading.Lock()
+
+def _service_account_credentials(scope):
+    """One credentials object per scope, so its access token is fetched once and reused."""
+    key = tuple(scope)
+    with _google_lock:
+        if key not in _credentials_cache:
+            sa = timed_import("oauth2client.service_account")
+            _credentials_cache[key] = sa.ServiceAccountCredentials.from_json_keyfile_name(
+                config.SERVICE_ACCOUNT_FILE, scope
+            )
+        return _credentials_cache[key]
+
 # --- GOOGLE SERVICES ---
 def get_gspread_client():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name(config.SERVICE_ACCOUNT_FILE, scope)
-    return gspread.authorize(creds)
+    global _gspread_client
+    fencing.check()
+    if _gspread_client is None:
+        gspread = timed_import("gspread")
+        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+        client = gspread.authorize(_service_account_credentials(scope))
+        with _google_lock:
+            _gspread_client = _gspread_client or client
+    return _gspread_client
 
 def get_drive_service():
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
-        config.SERVICE_ACCOUNT_FILE,
-        ['https://www.googleapis.com/auth/drive']
-    )
-    return build('drive', 'v3', credentials=creds)
+    fencing.check()
+    discovery = timed_import("googleapiclient.discovery")
+    creds = _service_account_credentials(['https://www.googleapis.com/auth/drive'])
+    # Service objects aren't thread-safe, so each call builds its own
+    return discovery.build('drive', 'v3', credentials=creds)
+
+def prewarm_google_sessions():
+    """Authorizes the Sheets and Drive sessions (token fetch + first TLS handshake)."""
+    start = time.perf_counter()
+    try:
+        get_gspread_client().open(config.GOOGLE_SHEET_NAME)
+        _service_account_credentials(['https://www.googleapis.com/auth/drive']).get_access_token()
+        logger.info(f"Google sessions authorized in {(time.perf_counter() - start) * 1000:.0f}ms")
+    except Exception as e:
+        logger.warning(f"Failed to pre-authorize Google sessions: {e}")
 
+@metrics.timed("google")
+@tracing.span("drive.grant_expert")
 def grant_expert_drive_access(email: str) -> bool:
     try:
         service = get_drive_service()
@@ -62,8 +154,11 @@ def grant_expert_drive_access(email: str) -> bool:
         return True
     except Exception as e:
         logger.error(f"Failed to grant Expert Drive access to {email}: {e}")
+        metrics.count("google_errors_total", name="grant_expert_drive_access", error=type(e).__name__)
         return False
 
+@metrics.timed("google")
+@tracing.span("drive.grant_highschool")
 def grant_highschool_drive_access(email: str) -> bool:
     try:
         service = get_drive_service()
@@ -81,136 +176,84 @@ def grant_highschool_drive_access(email: str) -> bool:
         return True
     except Exception as e:
         logger.error(f"Failed to grant Highschool Drive access to {email}: {e}")
+        metrics.count("google_errors_total", name="grant_highschool_drive_access", error=type(e).__name__)
         return False
 
 # --- TEXT & FORMATTING HELPERS ---
 def _format_amount(n: int):
     return "{:,.0f}".format(n)
 
-def build_payment_text(method_key, course_key, kids_count=0, hs_count=0, discount_percent=0):
-    method = method_key
-    if method not in config.PRICES:
+def payment_method_name(method_key: str) -> str:
+    """Human-friendly method tag saved in the user state / sheet."""
+    return config.PAYMENT_METHODS.get(method_key, {}).get("name", method_key)
+
+def build_payment_text(method_key, course_key, seats=0, discount_percent=0):
+    """seats is the order size for config.SEAT_COURSES, 0 for single-seat courses."""
+    cat = catalog.current()
+    return _render_payment_text(cat, method_key, course_key, seats, discount_percent or 0)
+
+def quote_price(method_key, course_key, seats=0, discount_percent=0) -> Optional[Dict]:
+    """The price the user is shown: unit_amount, seats, list_amount, amount (after discount), currency."""
+    cat = catalog.current()
+    if method_key not in cat.prices:
+        return None
+    return _quote(cat, method_key, course_key, seats, discount_percent or 0)
+
+def _quote(cat, method_key, course_key, seats, discount_percent) -> Dict:
+    price_map = cat.prices[method_key]
+    unit_amount = price_map.get(course_key, 0)
+    seats = max(1, seats) if config.SEAT_COURSES.get(course_key) else 1
+    list_amount = unit_amount * seats
+    total = list_amount
+    if discount_percent > 0:
+        total = list_amount - (list_amount * discount_percent) / 100
+        # Make it integer if possible
+        if int(total) == total:
+            total = int(total)
+    return {"unit_amount": unit_amount, "seats": seats, "list_amount": list_amount, "amount": total,
+            "currency": price_map["currency"]}
+
+@functools.lru_cache(maxsize=512)
+def _render_payment_text(cat, method_key, course_key, seats, discount_percent):
+    """Memoized per (catalog version, method, course, seats, discount); seats is 0 for single-seat courses."""
+    method = config.PAYMENT_METHODS.get(method_key)
+    if not method or method_key not in cat.prices:
         return "عذراً، طريقة الدفع غير متاحة حالياً."
 
-    price_map = config.PRICES[method]
-    unit = price_map["currency"]
-    
-    unit_amount = 0
-    if course_key == "kids":
-        unit_amount = price_map["kids"]
-    elif course_key == "highschool":
-        unit_amount = price_map.get("highschool", 0)
-    else:
-        unit_amount = price_map.get(course_key, 0)
-        
-    total = unit_amount
+    price = _quote(cat, method_key, course_key, seats, discount_percent)
+    unit = price["currency"]
+    unit_amount = price["unit_amount"]
+    total = price["amount"]
+
     per_note = ""
-    
-    if course_key == "kids":
-        k = max(1, int(kids_count or 1))
-        total = unit_amount * k
-        per_note = f" (لكل طفل {unit_amount} {unit})"
-    elif course_key == "highschool":
-        k = max(1, int(hs_count or 1))
-        total = unit_amount * k
-        per_note = f" (لكل متدرب {unit_amount} {unit})"
-    
+    seat = config.SEAT_COURSES.get(course_key)
+    if seat:
+        per_note = f" ({seat['unit_label']} {unit_amount} {unit})"
+
     # Apply discount
     discount_msg = ""
-    if discount_percent and discount_percent > 0:
-        original = total
-        discount_amount = (total * discount_percent) / 100
-        total = total - discount_amount
-        # Make it integer if possible
-        if int(total) == total:
-            total = int(total)
+    if discount_percent > 0:
+        original = price["list_amount"]
         discount_msg = f"🎉 **تم تطبيق خصم {discount_percent}%!**\n💰 السعر الأصلي: {_format_amount(original)} {unit}\n"
 
-    # Method-specific static fields
-    header = ""
-    body = ""
-    
-    if method == "saudi":
-        header = "الدفع عبر تحويل بنكي مباشر (السعودية):"
-        body = (
-            "الاسم:  علي محمد فضل الله بادي\n"
-            "البنك:  البنك الأهلي السعودي\n"
-            "الآيبان:  SA2410000011100312428804\n"
-            "رقم الحساب:  11100312428804\n"
-            "رمز سويفت:  NCBKSAJE"
-        )
-    elif method == "uae":
-        header = "الدفع عبر تحويل بنكي مباشر (الإمارات):"
-        body = (
-            "اسم صاحب الحساب:  MORWAN MOHAMED\n"
-            "اسم البنك:  بنك الماريه المحلي\n"
-            "رقم الحساب:  5270516520000001\n"
-            "الآيبان:  AE570975270516520000001\n"
-            "العملة:  AED"
-        )
-    elif method == "wu_mg":
-        header = "الدفع عبر Western Union / MoneyGram:"
-        body = (
-            "الاسم:  BADOR IBRAHIM ALFAKI KHALID\n"
-            "الدولة:  RWANDA\n"
-            "رقم الهاتف:  +250735721744"
-        )
-    elif method == "rwanda":
-        header = "الدفع عبر محفظة الهاتف (رواندا):"
-        body = (
-            "مفتاح رواندا:  250\n"
-            "محفظة مومو:  0795342923\n"
-            "محفظة ايرتيل:  0735721744"
-        )
-    elif method == "bankak":
-        header = "الدفع عبر بنكك (السودان):"
-        body = (
-            "رقم حساب بنكك:  3277030\n"
-            "باسم:  بدر إبراهيم"
-        )
-    elif method == "vodafone_eg":
-        header = "الدفع عبر فودافون كاش / انستا باي (مصر):"
-        body = (
-            f"رقم فودافون كاش / انستا باي : محمد خالد {config.VODAFONE_EG_NUMBER}\n"
-            "بعد التحويل، يُرجى إرسال لقطة شاشة (Screenshot) لعملية الدفع لتأكيد الاستلام و منحك الوصول لمحتوى الدورة مباشرة. شكرًا لك 🌟"
-        )
-    elif method == "iban":
-        header = "التحويل البنكي عبر IBAN (دولي):"
-        body = (
-            f"اسم صاحب الحساب:  {config.IBAN_ACCOUNT_NAME}\n"
-            f"اسم البنك:  {config.IBAN_BANK_NAME}\n"
-            f"الآيبان (IBAN):  {config.IBAN_NUMBER}\n"
-            f"سويفت (SWIFT):  {config.IBAN_SWIFT}\n"
-            f"ملاحظات التحويل:  {config.IBAN_NOTES}"
-        )
-    elif method == "paypal":
-        header = "الدفع عبر PayPal:"
-        body = (
-            f"رابط الدفع:  {config.PAYPAL_LINK}\n"
-            f"ملاحظات:  {config.PAYPAL_NOTES}\n"
-            "بعد الدفع أرسل صورة الإيصال هنا مباشرة."
-        )
-    else:
-        header, body = "طريقة الدفع", ""
-
     lines = []
-    lines.append(f"💳 {header}\n")
-    lines.append(body + "\n")
-    
+    lines.append(f"💳 {method['header']}\n")
+    lines.append(method["details"] + "\n")
+
     if discount_msg:
         lines.append(discount_msg)
         lines.append(f"🏷️ **السعر بعد الخصم:** { _format_amount(total) } {unit}{per_note}\n")
-    elif course_key == "kids" or course_key == "highschool":
-        lines.append(f"\nالرسوم: { _format_amount(total) } {unit}{per_note}\n")
     else:
-        lines.append(f"\nالرسوم: { _format_amount(total) } {unit}\n")
+        lines.append(f"\nالرسوم: { _format_amount(total) } {unit}{per_note}\n")
 
     lines.append("\nبعد الدفع، أرسل صورة إيصال الدفع هنا مباشرة.\n")
-    if method == "wu_mg":
-        lines.append("ثم أرسل في رسالة واحدة: الاسم الكامل / الدولة / الرقم المرجعي (MTCN).\n")
+    if method.get("footer"):
+        lines.append(method["footer"])
 
     return "\n".join(lines)
 
+@metrics.timed("google")
+@tracing.span("sheets.append_row")
 def save_to_google_sheet(user_info):
     try:
         client = get_gspread_client()
@@ -246,7 +289,7 @@ def save_to_google_sheet(user_info):
 
         merged_details = " | ".join(merged_details_parts) if merged_details_parts else ""
 
-        course_title = config.COURSES.get(course_key, {}).get("title", "غير محدد")
+        course_title = catalog.current().course_title(course_key)
 
         row = [
             user_info.get("name", "N/A"),
@@ -267,6 +310,8 @@ def save_to_google_sheet(user_info):
         logger.error(f"Failed to save to Google Sheet: {e}")
         raise
 
+@metrics.timed("google")
+@tracing.span("sheets.update_status")
 def update_status_in_sheet(row_number, new_status):
     try:
         client = get_gspread_client()
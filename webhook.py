@@ -0,0 +1,103 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from telegram import Update
+from telegram.ext import Application
+
+import config
+import health
+import httpd
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- WEBHOOK MODE ---
+# Telegram POSTs updates to WEBHOOK_PATH; they are checked against the secret
+# token and pushed straight into the Application's update queue. /healthz is up
+# as soon as the port is bound, /readyz only while updates are being accepted,
+# so an ingress / load balancer can route around starting or draining workers.
+
+class WebhookServer:
+    def __init__(self, app: Application):
+        self.app = app
+        self.ready = False
+        self.updates_received = 0
+        self.http = httpd.HttpServer()
+        self.http.route("POST", config.WEBHOOK_PATH, self.receive_update)
+        self.http.route("GET", "/healthz", self.healthz)
+        self.http.route("GET", "/readyz", self.readyz)
+        metrics.add_route(self.http)
+
+    async def receive_update(self, request: httpd.Request) -> httpd.Response:
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, config.WEBHOOK_SECRET):
+            return httpd.Response(403, "bad secret token")
+        if not self.ready:
+            # Telegram retries non-2xx deliveries, so nothing is lost while draining
+            return httpd.Response(503, "not ready")
+        try:
+            update = Update.de_json(request.json(), self.app.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return httpd.Response(400, "malformed update")
+        await self.app.update_queue.put(update)
+        self.updates_received += 1
+        return httpd.Response(200)
+
+    async def healthz(self, request: httpd.Request) -> httpd.Response:
+        snap = health.snapshot()
+        return httpd.Response(503 if snap["problem"] else 200, snap)
+
+    async def readyz(self, request: httpd.Request) -> httpd.Response:
+        if self.ready and self.app.running:
+            return httpd.Response(200, {"status": "ready"})
+        return httpd.Response(503, {"status": "not ready"})
+
+    async def run(self, stop_event: asyncio.Event = None):
+        """Serves until SIGINT/SIGTERM (or stop_event), then drains and shuts down."""
+        stop_event = stop_event or asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C raises KeyboardInterrupt instead
+
+        await self.http.start(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+        app = self.app
+        try:
+            await app.initialize()
+            if app.post_init:
+                await app.post_init(app)
+            await app.start()
+            if config.WEBHOOK_URL:
+                await app.bot.set_webhook(
+                    url=config.WEBHOOK_URL,
+                    secret_token=config.WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+                )
+                logger.info(f"Webhook registered at {config.WEBHOOK_URL}")
+            self.ready = True
+            logger.info("🤖 Bot is serving updates via webhook")
+            await stop_event.wait()
+        finally:
+            # Stop taking updates first, then let queued ones finish
+            self.ready = False
+            await self.http.stop()
+            if app.running:
+                await app.stop()
+                if app.post_stop:
+                    await app.post_stop(app)
+            await app.shutdown()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+            logger.info("Webhook server stopped")
+
+def run_webhook(server: WebhookServer):
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass